@@ -37,16 +37,22 @@ class Settings:
             # add to the dict
             temp_dict[key] = value
 
-        # check if the number of read settings equals the number of settings 
-        # that should be in the dict
-        if len(temp_dict.keys()) == len(self.settings_dict.keys()):
-            ret = True
-            self.settings_dict = temp_dict
-            self.print_values()
-        else:
-            ret = False
-
-        return ret
+        # Settings that were added after the file was written are missing from it.
+        # They get their defaults from settings_dict, and the file is written back with them,
+        # so that they can be changed there.
+        missing_keys = [key for key in self.settings_dict.keys() if key not in temp_dict]
+        for key in missing_keys:
+            # converted the same way as if they had been read from the file
+            temp_dict[key] = self.dtype_dict[key](str(self.settings_dict[key]))
+
+        # keep the order of settings_dict
+        self.settings_dict = {key: temp_dict[key] for key in self.settings_dict.keys()}
+        if missing_keys:
+            print(f'Added the missing settings to {self.path} with their defaults: {", ".join(missing_keys)}')
+            self.write()
+        self.print_values()
+
+        return True
 
     def get_value(self, key):
         return self.settings_dict[key]
@@ -1,5 +1,10 @@
 import cv2
+import os
+import json
+import hashlib
 import numpy as np
+from sky_filter import CACHE_DIRECTORY
+from yuv_frames import PAIR_CHANNELS
 
 def get_cropping_and_scaling_parameters(original_resolution: tuple, new_resolution: int) -> dict:
     """
@@ -40,8 +45,190 @@ def crop_and_scale(frame, cropping_start, cropping_end, scale_factor):
     frame = cv2.resize(frame, (0, 0), fx=scale_factor, fy=scale_factor)
     return frame
 
+def load_camera_calibration(path: str) -> dict:
+    """
+    Loads a camera calibration from a json file, e.g. the results of cv2.calibrateCamera:
+        {"resolution": [640, 480],
+         "camera_matrix": [[fx, 0, cx], [0, fy, cy], [0, 0, 1]],
+         "distortion_coefficients": [k1, k2, p1, p2, k3]}
+    resolution is the resolution of the frames the camera was calibrated at.
+    """
+    with open(path) as json_file:
+        calibration = json.load(json_file)
+    calibration['camera_matrix'] = np.array(calibration['camera_matrix'], dtype=np.float64)
+    calibration['distortion_coefficients'] = np.array(calibration['distortion_coefficients'], dtype=np.float64)
+    return calibration
+
+# Results on a synthetic 300 frame flight (python crop_and_scale.py), seen through a lens with barrel distortion
+# (k1 = -.25, k2 = .05), measured on a desktop x86 core. Times are per 640x480 BGR frame, errors in degrees.
+#
+# resolution  crop_and_scale  CropScaler  CropScaler undistorted   roll err distorted / undistorted  pitch err
+# 100x100     138 us          137 us      194 us                   0.20 / 0.17                        0.15 / 0.16
+# 200x200     366 us          357 us      524 us                   0.15 / 0.09                        0.10 / 0.08
+#
+# The distortion bends the horizon the most near the edges of the frame, so undistorting mostly helps the roll,
+# once the inference resolution is high enough to see the bend. cv2.remap costs about 1.4 times as much as
+# cv2.resize here, which has a faster path for plain scaling, so CropScaler only remaps when it has to.
+
+class CropScaler:
+    """
+    Crops, undistorts and scales frames to the inference resolution in a single cv2.remap,
+    into the same preallocated image every frame.
+    The map pair tells for every pixel of the small image where it comes from in the frame, and
+    is built once per resolution and calibration, then saved to disk so that it does not have to be
+    built every time the program starts.
+    Without a calibration, the result is the same as crop_and_scale, with the same parameters, and
+    BGR frames are resized instead, which is faster than the remap when there is nothing to undistort.
+    With a calibration, the small image is the crop of the undistorted frame, with the same camera matrix,
+    so that straight lines such as the horizon stay straight out to the edges of the frame.
+    """
+    def __init__(self, original_resolution: tuple, new_resolution: tuple, calibration: dict = None,
+                    yuyv: bool = False, cache_directory: str = CACHE_DIRECTORY):
+        """
+        original_resolution: resolution of the original, unscaled frame
+        new_resolution: resolution for performing inferences (see get_cropping_and_scaling_parameters)
+        calibration: camera calibration from load_camera_calibration, or None to not undistort the frames
+        yuyv: if True, the frames are raw YUYV frames (see yuv_frames.as_yuyv), and the small images
+        three channel Y, U, V images
+        cache_directory: folder in which the maps are saved
+        """
+        self.parameters = get_cropping_and_scaling_parameters(original_resolution, new_resolution)
+        self.yuyv = yuyv
+        self.cache_directory = cache_directory
+        cropping_start = self.parameters['cropping_start']
+        cropping_end = self.parameters['cropping_end']
+        scale_factor = self.parameters['scale_factor']
+        self.size = (int(np.round((cropping_end - cropping_start) * scale_factor)),
+                        int(np.round(original_resolution[1] * scale_factor)))
+
+        # the small image, overwritten by every call
+        self.output = np.empty((self.size[1], self.size[0], 3), dtype=np.uint8)
+        if yuyv:
+            self.pairs = np.empty((self.size[1], self.size[0], 4), dtype=np.uint8)
+
+        self.map1, self.map2 = None, None
+        if calibration is None and not yuyv:
+            return
+        # load the maps from disk if they have been built before
+        key = f'{original_resolution[0]}x{original_resolution[1]}_{self.size[0]}x{self.size[1]}_{cropping_start}'
+        if calibration is not None:
+            calibration_bytes = calibration['camera_matrix'].tobytes() + calibration['distortion_coefficients'].tobytes() + \
+                                np.array(calibration['resolution']).tobytes()
+            key += '_' + hashlib.sha1(calibration_bytes).hexdigest()[:12]
+        if yuyv:
+            key += '_yuyv'
+        path = f'{cache_directory}/crop_scaler_{key}.npz'
+        if os.path.exists(path):
+            maps = np.load(path)
+            self.map1, self.map2 = maps['map1'], maps['map2']
+        else:
+            self.map1, self.map2 = self._build_maps(original_resolution, calibration)
+            if not os.path.exists(cache_directory):
+                os.makedirs(cache_directory)
+            np.savez(path, map1=self.map1, map2=self.map2)
+
+    def _build_maps(self, original_resolution: tuple, calibration: dict) -> tuple:
+        """
+        Returns the map pair of cv2.remap, in the fixed point format of cv2.convertMaps, which remaps faster.
+        """
+        # The pixels of the small image are sampled at the same points of the crop as cv2.resize would.
+        scale_factor = self.parameters['scale_factor']
+        x = (np.arange(self.size[0]) + .5) / scale_factor - .5 + self.parameters['cropping_start']
+        y = (np.arange(self.size[1]) + .5) / scale_factor - .5
+        x, y = np.meshgrid(x, y)
+
+        if calibration is not None:
+            # the camera matrix at the resolution of the frames
+            camera_matrix = calibration['camera_matrix'].copy()
+            camera_matrix[0] *= original_resolution[0] / calibration['resolution'][0]
+            camera_matrix[1] *= original_resolution[1] / calibration['resolution'][1]
+            # The points sampled in the undistorted frame are moved to where the lens puts them in the frame.
+            rays = np.stack(((x - camera_matrix[0, 2]) / camera_matrix[0, 0],
+                                (y - camera_matrix[1, 2]) / camera_matrix[1, 1],
+                                np.ones_like(x)), axis=-1).reshape(-1, 1, 3)
+            points, _ = cv2.projectPoints(rays, np.zeros(3), np.zeros(3), camera_matrix,
+                                            calibration['distortion_coefficients'])
+            x = points[:, 0, 0].reshape(self.size[1], self.size[0])
+            y = points[:, 0, 1].reshape(self.size[1], self.size[0])
+
+        if self.yuyv:
+            # Each pair of pixels shares one U and one V, so the frame is sampled as an image of pairs:
+            # Y0, U, Y1, V. Pixel x of the frame is at x / 2, where the first pixel of a pair lies.
+            # The Y of the second pixel of each pair is left out; there are still more than enough pixels
+            # left for the inference resolution.
+            x = x / 2
+        return cv2.convertMaps(x.astype(np.float32), y.astype(np.float32), cv2.CV_16SC2)
+
+    def crop_and_scale(self, frame: np.ndarray, dst: np.ndarray = None) -> np.ndarray:
+        """
+        Returns the small image of the frame. The same buffer is returned on every call,
+        so it has to be copied to be kept past the next frame.
+        dst: an image like self.output to write the small image into instead
+        """
+        if dst is None:
+            dst = self.output
+        if self.yuyv:
+            pairs = frame.reshape(frame.shape[0], frame.shape[1] // 2, 4)
+            cv2.remap(pairs, self.map1, self.map2, cv2.INTER_LINEAR, dst=self.pairs, borderMode=cv2.BORDER_REPLICATE)
+            cv2.mixChannels([self.pairs], [dst], PAIR_CHANNELS)
+        elif self.map1 is None:
+            cropped_frame = frame[:, self.parameters['cropping_start']:self.parameters['cropping_end']]
+            scale_factor = self.parameters['scale_factor']
+            # With the scale factor rather than the size, which cv2.resize would turn into a slightly different
+            # scale factor when the size was rounded. dst has the size this gives (self.size).
+            dst = cv2.resize(cropped_frame, (0, 0), dst=dst, fx=scale_factor, fy=scale_factor)
+        else:
+            cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR, dst=dst, borderMode=cv2.BORDER_REPLICATE)
+        return dst
+
 if __name__ == "__main__":
+    from timeit import default_timer as timer
+    from horizon_benchmark import make_flight, run_benchmark, print_stats, FOV, RESOLUTION
+
+    ITERATIONS = 20
+
+    # A lens with barrel distortion, whose focal length matches the degrees per pixel of the synthetic frames.
+    focal_length = RESOLUTION[0] / np.radians(FOV)
+    calibration = {'resolution': RESOLUTION,
+                    'camera_matrix': np.array([[focal_length, 0, (RESOLUTION[0] - 1) / 2],
+                                                [0, focal_length, (RESOLUTION[1] - 1) / 2],
+                                                [0, 0, 1]]),
+                    'distortion_coefficients': np.array([-.25, .05, 0, 0, 0])}
+
+    print('Rendering synthetic flight...')
+    frames, rolls, pitches = make_flight()
+    # the frames as seen through the lens: each pixel of the distorted frame comes from where the lens
+    # took it from in the undistorted frame
+    x, y = np.meshgrid(np.arange(RESOLUTION[0], dtype=np.float32), np.arange(RESOLUTION[1], dtype=np.float32))
+    points = cv2.undistortPoints(np.stack((x, y), axis=-1).reshape(-1, 1, 2), calibration['camera_matrix'],
+                                    calibration['distortion_coefficients'], P=calibration['camera_matrix'])
+    map_x = points[:, 0, 0].reshape(x.shape)
+    map_y = points[:, 0, 1].reshape(y.shape)
+    distorted_frames = [cv2.remap(frame, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+                        for frame in frames]
+
+    for inference_resolution in [(100, 100), (200, 200)]:
+        crop_and_scale_parameters = get_cropping_and_scaling_parameters(RESOLUTION, inference_resolution)
+        crop_scaler = CropScaler(RESOLUTION, inference_resolution)
+        undistorting_crop_scaler = CropScaler(RESOLUTION, inference_resolution, calibration)
+        for name, function in [('crop_and_scale', lambda frame: crop_and_scale(frame, **crop_and_scale_parameters)),
+                                ('CropScaler', crop_scaler.crop_and_scale),
+                                ('CropScaler, undistorted', undistorting_crop_scaler.crop_and_scale)]:
+            t1 = timer()
+            for n in range(ITERATIONS):
+                for frame in frames:
+                    function(frame)
+            print(f'{name} {inference_resolution}: {(timer() - t1) / ITERATIONS / len(frames) * 1e6:.0f} us')
+
+        stats = run_benchmark(distorted_frames, rolls, pitches, inference_resolution)
+        print_stats(f'distorted {inference_resolution}', stats)
+        stats = run_benchmark(distorted_frames, rolls, pitches, inference_resolution, calibration=calibration)
+        print_stats(f'undistorted {inference_resolution}', stats)
+
+    # show the region of interest of a sample image
     path = 'training_data/sample_images/sample_horizon_corrected.png'
+    if not os.path.exists(path):
+        exit()
     input_frame = cv2.imread(path)
     input_frame_resolution = input_frame.shape[1::-1]
     print(input_frame_resolution)
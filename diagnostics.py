@@ -0,0 +1,163 @@
+######## Diagnostic visualization of the HorizonDetector #########
+# HorizonDetector.find_horizon only takes a snapshot of its intermediate images and points
+# when it runs in diagnostic_mode. Rendering the snapshot (scaling up, drawing every point,
+# showing the windows) happens here, away from the detector, so that it does not hold up the main loop.
+
+import cv2
+import numpy as np
+from threading import Thread, Condition
+from timeit import default_timer as timer
+
+from draw_display import draw_horizon
+from edge_validation import BLOCK_SIZE, get_edge_blocks
+
+# rate at which DiagnosticsDisplay renders snapshots
+DIAGNOSTICS_FPS = 5
+# height of the rendered diagnostic images
+DIAGNOSTICS_HEIGHT = 500
+
+class DiagnosticSnapshot:
+    """
+    Copies of the intermediate images of HorizonDetector and the points it found in one frame.
+    mask, bgr2gray, blue_filtered_greyscale: the images, of the band if the frame was searched in a band
+    transform: the affine transform that maps the frame onto the band, or None
+    x_abbr, y_abbr: all horizon points, x_filtered, y_filtered: the points used for the fit
+    reference: roll, pitch and exclusion threshold in pixels of the horizon the points had to be close to, or None
+    frame_shape: shape of the frame
+    fov: field of view of the camera
+    """
+    __slots__ = ('mask', 'bgr2gray', 'blue_filtered_greyscale', 'transform', 'x_abbr', 'y_abbr',
+                    'x_filtered', 'y_filtered', 'reference', 'frame_shape', 'fov')
+
+    def __init__(self, points: dict, frame_shape: tuple, fov: float):
+        """
+        points: the points dictionary of HorizonDetector. The images are copied,
+        since the detector reuses their buffers for the next frame.
+        """
+        self.mask = points['mask'].copy()
+        self.bgr2gray = points['bgr2gray'].copy()
+        self.blue_filtered_greyscale = points['blue_filtered_greyscale'].copy()
+        self.transform = points['transform']
+        self.x_abbr = points['x_abbr']
+        self.y_abbr = points['y_abbr']
+        self.x_filtered = points['x_filtered']
+        self.y_filtered = points['y_filtered']
+        self.reference = points['reference']
+        self.frame_shape = frame_shape
+        self.fov = fov
+
+def render_diagnostics(snapshot: DiagnosticSnapshot) -> dict:
+    """
+    Draws the diagnostic visualization of a snapshot.
+    Returns the images keyed by window name: 'mask' (the diagnostic image with the points
+    and the reference horizon), 'edges' and 'blue_filtered_greyscale'.
+    """
+    frame_shape = snapshot.frame_shape
+    mask = snapshot.mask
+    # the blocks that count as edges, scaled back up to pixels
+    edges = get_edge_blocks(snapshot.bgr2gray)
+    edges = cv2.resize(edges, (edges.shape[1] * BLOCK_SIZE, edges.shape[0] * BLOCK_SIZE),
+                        interpolation=cv2.INTER_NEAREST)[:snapshot.bgr2gray.shape[0], :snapshot.bgr2gray.shape[1]]
+    blue_filtered_greyscale = snapshot.blue_filtered_greyscale
+
+    # if the points were found in a band, place the band back in the frame
+    transform = snapshot.transform
+    if transform is not None:
+        dsize = (frame_shape[1], frame_shape[0])
+        flags = cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP
+        mask = cv2.warpAffine(mask, transform, dsize, flags=flags)
+        blue_filtered_greyscale = cv2.warpAffine(blue_filtered_greyscale, transform, dsize, flags=flags)
+        edges = cv2.warpAffine(edges, transform, dsize, flags=flags)
+
+    # scale up the diagnostic image to make it easier to see
+    scale_factor = DIAGNOSTICS_HEIGHT / frame_shape[0]
+    desired_width = int(np.round(frame_shape[1] * scale_factor))
+    desired_dimensions = (desired_width, DIAGNOSTICS_HEIGHT)
+    mask = cv2.resize(mask, desired_dimensions)
+    # convert the diagnostic image to color
+    mask = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+
+    # draw the abbreviated points
+    for x, y in zip(snapshot.x_abbr, snapshot.y_abbr):
+        center = (int(np.round(x * scale_factor)), int(np.round(y * scale_factor)))
+        cv2.circle(mask, center, 5, (0,0,255), -1)
+    # draw the filtered points
+    for x, y in zip(snapshot.x_filtered, snapshot.y_filtered):
+        center = (int(np.round(x * scale_factor)), int(np.round(y * scale_factor)))
+        cv2.circle(mask, center, 5, (0,255,0), -1)
+    # draw the reference horizon (predicted or from the pyramid), if there is one
+    if snapshot.reference is not None:
+        reference_roll, reference_pitch, exclusion_pixels = snapshot.reference
+        exclusion_thresh = exclusion_pixels / frame_shape[0] * snapshot.fov
+        lower_pitch = reference_pitch + exclusion_thresh
+        draw_horizon(mask, reference_roll, lower_pitch, snapshot.fov, (0,150,255),  False)
+        upper_pitch = reference_pitch - exclusion_thresh
+        draw_horizon(mask, reference_roll, upper_pitch, snapshot.fov, (0,150,255),  False)
+        cv2.putText(mask, 'Horizon Lock',(20,40),cv2.FONT_HERSHEY_COMPLEX_SMALL,1,(0,150,255),1,cv2.LINE_AA)
+
+    images = {}
+    images['mask'] = mask
+    images['edges'] = cv2.resize(edges, desired_dimensions)
+    images['blue_filtered_greyscale'] = cv2.resize(blue_filtered_greyscale, desired_dimensions)
+    return images
+
+class DiagnosticsDisplay:
+    """
+    Renders the latest snapshot of the detector in a background thread, at most fps times per second,
+    and shows the rendered images when show is called from the main thread
+    (OpenCV windows should only be used from the main thread).
+    """
+    def __init__(self, fps: float = DIAGNOSTICS_FPS):
+        self.period = 1 / fps
+        self.condition = Condition()
+        self.snapshot = None
+        self.images = None
+        self.time_of_last_snapshot = None
+        self.run = True
+        Thread(target=self._render_snapshots, daemon=True).start()
+
+    def wants_snapshot(self) -> bool:
+        """
+        Returns True if it is time for a new snapshot, so that the detector
+        only takes snapshots at the rate they are rendered.
+        """
+        return self.time_of_last_snapshot is None or timer() - self.time_of_last_snapshot >= self.period
+
+    def publish(self, snapshot: DiagnosticSnapshot):
+        """
+        Hands a snapshot over to the rendering thread. Replaces any snapshot that has not been rendered yet.
+        """
+        with self.condition:
+            self.snapshot = snapshot
+            self.time_of_last_snapshot = timer()
+            self.condition.notify()
+
+    def show(self):
+        """
+        Shows the most recently rendered images, if there are new ones.
+        """
+        with self.condition:
+            images = self.images
+            self.images = None
+        if images is None:
+            return
+        for window_name, image in images.items():
+            cv2.imshow(window_name, image)
+
+    def stop(self):
+        with self.condition:
+            self.run = False
+            self.condition.notify()
+
+    def _render_snapshots(self):
+        while True:
+            with self.condition:
+                while self.run and self.snapshot is None:
+                    self.condition.wait()
+                if not self.run:
+                    return
+                snapshot = self.snapshot
+                self.snapshot = None
+            images = render_diagnostics(snapshot)
+            with self.condition:
+                self.images = images
@@ -3,7 +3,6 @@ import numpy as np
 from math import cos, sin, pi, radians
 
 FULL_ROTATION = 360
-FULL_ROTATION_RADIANS = 2 * pi
 
 def _restrict(val, upper_bound:float=1, lower_bound:float=-1):
     """
@@ -15,42 +14,6 @@ def _restrict(val, upper_bound:float=1, lower_bound:float=-1):
         val = lower_bound
     return val
 
-def _find_points(m: float, b: float, frame_shape: tuple) -> list:
-    """"
-    Given the slope (m), y intercept (b) and the frame shape (frame_shape),
-    find the two points of the line that intersect with the border of the frame.
-    """
-    # special condition if slope is 0
-    if m == 0:
-        b = int(np.round(b))
-        p1 = (0, b)
-        p2 = (frame_shape[1], b)
-        return [p1, p2]
-
-    points_to_return = []
-    # left
-    if 0 < b <= frame_shape[0]:
-        px = 0
-        py = int(np.round(b))
-        points_to_return.append((px, py))
-    # top
-    if 0 < -b / m <= frame_shape[1]:
-        px = int(np.round(-b / m))
-        py = 0
-        points_to_return.append((px, py))
-    # right
-    if 0 < m * frame_shape[1] + b <= frame_shape[0]:
-        px = frame_shape[1]
-        py = int(np.round(m * frame_shape[1] + b))
-        points_to_return.append((px, py))
-    # bottom
-    if 0 < (frame_shape[0] - b) / m <= frame_shape[1]:
-        px = int(np.round((frame_shape[0] - b) / m))
-        py = frame_shape[0]
-        points_to_return.append((px, py))
-
-    return points_to_return
-
 def draw_roi(frame: np.ndarray, crop_and_scale_parameters: dict) -> np.ndarray:
     """
     Draws the region of interest onto the frame, i.e. the region where 
@@ -110,9 +73,6 @@ def draw_horizon(frame: np.ndarray, roll: float , pitch: float,
     # take roll in degrees and express it in terms of radians
     roll = radians(roll)
     
-    # determine if the sky is up or down based on the roll
-    sky_is_up = (roll >= FULL_ROTATION_RADIANS * .75  or (roll > 0 and roll <= FULL_ROTATION_RADIANS * .25))
-    
     # find the distance 
     distance = pitch / fov * frame.shape[0]
 
@@ -121,37 +81,28 @@ def draw_horizon(frame: np.ndarray, roll: float , pitch: float,
     x_perp = distance * cos(angle_perp) + frame.shape[1]/2
     y_perp = distance * sin(angle_perp) + frame.shape[0]/2
 
-    # define the horizon line
-    run = cos(roll)
-    rise = sin(roll)
-    if run != 0:
-        m = rise / run
-        b = y_perp - m * x_perp
-        points = _find_points(m, b, frame.shape)
-        if not points:
-            return
-        else:
-            p1, p2 = points
-       
-    else:
-        p1 = (int(np.round(x_perp)), 0)
-        p2 = (int(np.round(x_perp)), frame.shape[0])
+    # Define the horizon line by its direction instead of its slope, so that vertical
+    # horizons need no special case. Both ends are placed a diagonal away from the
+    # point on the horizon and the line is then clipped to the frame.
+    diagonal = np.hypot(frame.shape[0], frame.shape[1])
+    run = cos(roll) * diagonal
+    rise = sin(roll) * diagonal
+    p1 = (int(np.round(x_perp - run)), int(np.round(y_perp - rise)))
+    p2 = (int(np.round(x_perp + run)), int(np.round(y_perp + rise)))
+    frame_rect = (0, 0, frame.shape[1], frame.shape[0])
+    is_in_frame, p1, p2 = cv2.clipLine(frame_rect, p1, p2)
+    if not is_in_frame:
+        return
 
     cv2.line(frame, p1, p2, color, 2)
 
-    if draw_groundline and m != 0:
-        m_perp = -1/m
-        b_perp = y_perp - m_perp * x_perp
-        points = _find_points(-1/m, b_perp, frame.shape)
-        above_line = m * points[0][0] + b < points[0][1]
-        if (sky_is_up and above_line) or (not sky_is_up and not above_line):
-            p2 = points[0]
-        else:
-            p2 = points[1]
-        p1x = int(np.round(x_perp))
-        p1y = int(np.round(y_perp))
-        p1 = (p1x, p1y)
-        cv2.line(frame, p1, p2, (0,191,255), 1)
+    if draw_groundline:
+        # the ground lies on the side the perpendicular points to
+        p1 = (int(np.round(x_perp)), int(np.round(y_perp)))
+        p2 = (int(np.round(x_perp - rise)), int(np.round(y_perp + run)))
+        is_in_frame, p1, p2 = cv2.clipLine(frame_rect, p1, p2)
+        if is_in_frame:
+            cv2.line(frame, p1, p2, (0,191,255), 1)
 
 def draw_surfaces(frame, left: float, right: float, top: float, bottom: float, 
                     ail_val: float, elev_val: float, surface_color: tuple):
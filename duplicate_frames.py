@@ -0,0 +1,77 @@
+######## Duplicate frame filter #########
+# The camera thread of CustomVideoCapture overwrites its latest frame as frames come in, and the main loop
+# takes whatever frame is there. When the camera delivers fewer frames than the main loop runs, the loop
+# gets the same frame again and used to look for the horizon in it again. DuplicateFrameFilter tells
+# the main loop when it can keep the horizon of the previous frame instead:
+#   repeat: the frame has the same sequence number as the last one (CustomVideoCapture.read_numbered_frame)
+#   unchanged: a new frame that hardly differs from the last frame the horizon was looked for in,
+#              judged by a thumbnail that averages SIGNATURE_BLOCK x SIGNATURE_BLOCK pixels into one
+#              (e.g. on the ground, or a camera that repeats frames itself)
+# The main loop records which frames were skipped.
+#
+# Cost on a desktop x86 core: the repeat check is a comparison of two integers,
+# the unchanged check about 20 us on a 100x100 frame (the thumbnail and its difference).
+# The unchanged check is off by default (MAX_DIFFERENCE = 0), so only repeated frames are skipped.
+# The frames are compared with the last frame the horizon was looked for in, and a small change of attitude
+# hardly changes the thumbnail: on a fixed synthetic scene (horizon_benchmark.make_frame, 100x100), a change
+# of pitch of .1 degrees differs by about .22 levels, .25 degrees by .56 and .5 degrees by 1.1,
+# while the same frame with sensor noise (sigma 4) differs by about .5. Any threshold above the noise
+# keeps the horizon through changes of a quarter of a degree. Check a non-zero threshold against small
+# changes of attitude on a fixed scene, not against consecutive frames of the synthetic flight, whose texture
+# is drawn anew in every frame.
+
+import cv2
+import numpy as np
+
+# The frames are compared by a thumbnail in which each pixel is the mean of a block of this many pixels
+# square. A whole number, so that cv2.resize can take its fast path for INTER_AREA.
+SIGNATURE_BLOCK = 5
+# mean absolute difference between two thumbnails, in levels per pixel and channel,
+# up to which a new frame counts as unchanged
+MAX_DIFFERENCE = 0
+
+# values recorded with each frame
+REPEAT = 'repeat'
+UNCHANGED = 'unchanged'
+
+class DuplicateFrameFilter:
+    """
+    Usage, for every frame the horizon could be looked for in:
+        if duplicate_filter.is_repeat(frame_number): keep the previous horizon
+        ... crop and scale the frame ...
+        elif duplicate_filter.is_unchanged(frame_number, image): keep the previous horizon
+        else: find the horizon
+    """
+    def __init__(self, max_difference: float = MAX_DIFFERENCE):
+        """
+        max_difference: mean absolute difference between the thumbnails of two frames up to which
+        a new frame counts as unchanged. 0 to only skip repeated frames.
+        """
+        self.max_difference = max_difference
+        self.last_frame_number = None
+        # thumbnail of the last frame the horizon was looked for in
+        self.signature = None
+
+    def is_repeat(self, frame_number: int) -> bool:
+        """
+        Returns True if the frame is the same as the last frame given to is_unchanged.
+        """
+        return frame_number is not None and frame_number == self.last_frame_number
+
+    def is_unchanged(self, frame_number: int, image: np.ndarray) -> bool:
+        """
+        Returns True if the image hardly differs from the last image that was not unchanged,
+        in which case the horizon of that image can be kept.
+        image: the frame as the horizon is looked for in it (cropped and scaled)
+        """
+        self.last_frame_number = frame_number
+        if self.max_difference <= 0:
+            return False
+        signature = cv2.resize(image, None, fx=1/SIGNATURE_BLOCK, fy=1/SIGNATURE_BLOCK, interpolation=cv2.INTER_AREA)
+        if self.signature is not None and self.signature.shape == signature.shape and \
+                cv2.norm(signature, self.signature, cv2.NORM_L1) <= self.max_difference * signature.size:
+            return True
+        # Only frames the horizon is looked for in become the signature, so that a scene
+        # that changes slowly over many frames still counts as changed in the end.
+        self.signature = signature
+        return False
@@ -0,0 +1,131 @@
+######## Edge validation of the horizon points #########
+# HorizonDetector only keeps the points of the sky/ground boundary that lie on a real edge in the image.
+# It used to run Canny over the whole frame and max-pool the result in 5x5 blocks (skimage block_reduce),
+# only to read the pooled map at the ~100 horizon points. Instead, the gradient is now computed
+# only in the blocks of those points: a point lies on an edge when the strongest gradient
+# in its block reaches EDGE_THRESHOLD.
+#
+# The gradient is the same one Canny thresholds (3x3 Sobel, |dx| + |dy|), so the decision
+# matches Canny's in all but the few blocks where Canny's non-maximum suppression or hysteresis
+# would have moved or dropped the edge. It never rejects a point that Canny accepted: the image is padded
+# the way Canny pads it (BORDER_REPLICATE), so that the blocks at the border get the gradients Canny sees.
+#
+# Results on a synthetic 300 frame flight (python edge_validation.py), measured on a desktop x86 core.
+# Canny and pooling here uses a numpy reshape; skimage block_reduce took another 80-180 us on top of it.
+#
+# resolution  points agreeing with Canny  Canny and pooling  sparse
+# 100x100     96.8%                       148 us             83 us
+# 200x200     96.1%                       442 us             74 us
+#
+# python horizon_benchmark.py went from 0.75 to 0.57 ms per frame at 100x100
+# and from 1.21 to 0.83 ms at 200x200, with the same accuracy.
+
+import cv2
+import numpy as np
+
+# size of the blocks in which an edge counts for all points of the block
+BLOCK_SIZE = 5
+# minimum gradient (|dx| + |dy| of the Sobel operator) in a block for its points to lie on an edge.
+# Canny was run with thresholds of 200 and 250.
+EDGE_THRESHOLD = 200
+# a block plus the one pixel border the Sobel operator needs
+PATCH_SIZE = BLOCK_SIZE + 2
+
+def _block_gradients(greyscale: np.ndarray, block_rows: np.ndarray, block_columns: np.ndarray) -> np.ndarray:
+    """
+    Returns the largest Sobel gradient |dx| + |dy| in each of the given blocks, saturated at 255.
+    """
+    # Pad the image by the one pixel the Sobel operator needs, and up to the end of the last blocks
+    # when the size of the image is not a multiple of BLOCK_SIZE, so that every patch lies within it.
+    height, width = greyscale.shape
+    bottom = -(-height // BLOCK_SIZE) * BLOCK_SIZE - height + 1
+    right = -(-width // BLOCK_SIZE) * BLOCK_SIZE - width + 1
+    greyscale = cv2.copyMakeBorder(greyscale, 1, bottom, 1, right, cv2.BORDER_REPLICATE)
+    width = greyscale.shape[1]
+    # the patch of a block starts a pixel before it, which is where the block starts in the padded image
+    top = block_rows * BLOCK_SIZE
+    left = block_columns * BLOCK_SIZE
+
+    # Gather the patches side by side into one PATCH_SIZE high image, so that OpenCV can
+    # run the Sobel operator over all of them at once. The pixels at the sides of each patch
+    # mix with the neighbouring patch, but they are not part of the block.
+    patch_offsets = np.arange(PATCH_SIZE)[:, np.newaxis, np.newaxis] * width + np.arange(PATCH_SIZE)
+    index = (top * width + left)[np.newaxis, :, np.newaxis] + patch_offsets
+    patches = np.take(greyscale, index.reshape(PATCH_SIZE, -1))
+
+    dx = cv2.convertScaleAbs(cv2.Sobel(patches, cv2.CV_16S, 1, 0))
+    dy = cv2.convertScaleAbs(cv2.Sobel(patches, cv2.CV_16S, 0, 1))
+    gradient = cv2.add(dx, dy)
+
+    # the largest gradient within each block
+    gradient = cv2.reduce(gradient[1:-1], 0, cv2.REDUCE_MAX)
+    return gradient.reshape(-1, PATCH_SIZE)[:, 1:-1].max(axis=1)
+
+def is_on_edge(greyscale: np.ndarray, x: np.ndarray, y: np.ndarray, threshold: float = EDGE_THRESHOLD) -> np.ndarray:
+    """
+    Returns for each point (x, y) of the greyscale image whether its block contains an edge.
+    x, y: pixel coordinates
+    """
+    if x.size == 0:
+        return np.zeros(0, dtype=bool)
+    block_rows = (y // BLOCK_SIZE).astype(np.intp)
+    block_columns = (x // BLOCK_SIZE).astype(np.intp)
+    return _block_gradients(greyscale, block_rows, block_columns) >= threshold
+
+def get_edge_blocks(greyscale: np.ndarray, threshold: float = EDGE_THRESHOLD) -> np.ndarray:
+    """
+    Returns the decision of is_on_edge for every block of the image, as an image with one pixel
+    per block that is 255 where the block contains an edge. Only used for the diagnostic display.
+    """
+    height = -(-greyscale.shape[0] // BLOCK_SIZE)
+    width = -(-greyscale.shape[1] // BLOCK_SIZE)
+    block_rows, block_columns = np.divmod(np.arange(height * width), width)
+    edge_blocks = _block_gradients(greyscale, block_rows, block_columns) >= threshold
+    return edge_blocks.reshape(height, width).astype(np.uint8) * 255
+
+if __name__ == "__main__":
+    from timeit import default_timer as timer
+    from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale
+    from find_horizon import HorizonDetector
+    from horizon_benchmark import make_flight
+
+    ITERATIONS = 20
+
+    def canny_blocks(greyscale: np.ndarray) -> np.ndarray:
+        # the previous edge map: Canny, max-pooled in BLOCK_SIZE x BLOCK_SIZE blocks
+        edges = cv2.Canny(greyscale, 200, 250)
+        height = -(-edges.shape[0] // BLOCK_SIZE) * BLOCK_SIZE
+        width = -(-edges.shape[1] // BLOCK_SIZE) * BLOCK_SIZE
+        padded = np.zeros((height, width), dtype=np.uint8)
+        padded[:edges.shape[0], :edges.shape[1]] = edges
+        return padded.reshape(height // BLOCK_SIZE, BLOCK_SIZE, width // BLOCK_SIZE, BLOCK_SIZE).max(axis=(1, 3))
+
+    print('Rendering synthetic flight...')
+    frames, rolls, pitches = make_flight()
+    for inference_resolution in [(100, 100), (200, 200)]:
+        crop_and_scale_parameters = get_cropping_and_scaling_parameters(frames[0].shape[1::-1], inference_resolution)
+        horizon_detector = HorizonDetector(10, 48.8, 1.3, inference_resolution, horizon_lock_band=False)
+        agreed = total = 0
+        canny_time = sparse_time = 0
+        for frame in frames:
+            frame = crop_and_scale(frame, **crop_and_scale_parameters)
+            greyscale = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            points = horizon_detector._find_points(frame, horizon_detector.buffers, frame.shape, {})
+            x = points['x_abbr'].astype(int)
+            y = points['y_abbr'].astype(int)
+
+            t1 = timer()
+            for n in range(ITERATIONS):
+                old_decision = canny_blocks(greyscale)[y // BLOCK_SIZE, x // BLOCK_SIZE] != 0
+            t2 = timer()
+            for n in range(ITERATIONS):
+                new_decision = is_on_edge(greyscale, x, y)
+            t3 = timer()
+            canny_time += (t2 - t1) / ITERATIONS
+            sparse_time += (t3 - t2) / ITERATIONS
+            agreed += np.count_nonzero(old_decision == new_decision)
+            total += x.size
+
+        print(f'{inference_resolution}: {agreed / total * 100:.1f}% of {total} points agree, '
+                f'Canny and pooling: {canny_time / len(frames) * 1e6:.0f} us, '
+                f'sparse: {sparse_time / len(frames) * 1e6:.0f} us per frame')
@@ -2,103 +2,640 @@
 # Author: Tim Huff
 
 import cv2
-import skimage.measure
-import platform
 import numpy as np
-from numpy.linalg import norm
-from math import atan2, cos, sin, pi, degrees, radians
+from math import cos, sin, pi, degrees, radians
+from timeit import default_timer as timer
+from concurrent.futures import ThreadPoolExecutor
 from draw_display import draw_horizon
+from diagnostics import DiagnosticSnapshot
+from sky_filter import SkyFilterLUT
+from smoothing_filters import SMOOTHING_FILTERS
+from crop_and_scale import get_cropping_and_scaling_parameters
+from horizon_fit import fit_line
+from horizon_tracker import HorizonTracker
+from edge_validation import BLOCK_SIZE, is_on_edge
+from subpixel import refine_points
+from otsu_threshold import IncrementalOtsu
+from flow_tracking import track_points, SKY_POINT_DISTANCE
+from tiled_detection import get_tiles
+from horizon_backends import BACKENDS, FULL_FRAME_BACKENDS, BOUNDARY_BACKENDS, PREDICTED_ROLL_BACKENDS
+from sky_segmentation import SkySegmenter
+from yuv_frames import yuv_to_bgr, SKY_LOWER_YUV, SKY_UPPER_YUV
 
 # constants
 FULL_ROTATION = 360
-OPERATING_SYSTEM = platform.system()
-POOLING_KERNEL_SIZE = 5
+# pixels added above and below the exclusion threshold when processing a band around the predicted horizon
+BAND_MARGIN = BLOCK_SIZE
+# The exclusion threshold is this many standard deviations of the predicted horizon,
+# but never less than MIN_EXCLUSION_PIXELS and never more than exclusion_thresh.
+EXCLUSION_SIGMAS = 3
+MIN_EXCLUSION_PIXELS = 2
+# half the height of the strip in which a horizon found at the pyramid resolution is refined,
+# in pixels of the pyramid resolution
+PYRAMID_STRIP_PIXELS = 2
+
+class HorizonResult:
+    """
+    The output of HorizonDetector.find_horizon.
+    roll, pitch, variance and is_good_horizon are None if no horizon could be found.
+    timings: time in seconds spent in each stage of the detector, keyed by stage name.
+    snapshot: a diagnostics.DiagnosticSnapshot of the intermediate images and points,
+    only populated when find_horizon is run in diagnostic_mode.
+    threshold: the level the mask was thresholded at, or None if no mask was made.
+    is_tracked: True if the horizon was tracked with optical flow instead of detected (see flow_tracking.py).
+    """
+    __slots__ = ('roll', 'pitch', 'variance', 'is_good_horizon', 'timings', 'snapshot', 'threshold', 'is_tracked')
+
+    def __init__(self, roll=None, pitch=None, variance=None, is_good_horizon=None, timings=None, snapshot=None,
+                    threshold=None, is_tracked=False):
+        self.roll = roll
+        self.pitch = pitch
+        self.variance = variance
+        self.is_good_horizon = is_good_horizon
+        self.timings = timings
+        self.snapshot = snapshot
+        self.threshold = threshold
+        self.is_tracked = is_tracked
+
+class _BufferPlan:
+    """
+    Preallocated output buffers for every intermediate image of HorizonDetector.find_horizon.
+    Built once for a given frame size and passed as dst to the OpenCV calls,
+    so that no new arrays need to be allocated for each frame.
+    """
+    __slots__ = ('shape', 'bgr2gray', 'hsv', 'hsv_mask', 'blue_filtered_greyscale', 'blur', 'mask')
+
+    def __init__(self, height: int, width: int):
+        self.shape = (height, width)
+        self.bgr2gray = np.empty((height, width), dtype=np.uint8)
+        self.hsv = np.empty((height, width, 3), dtype=np.uint8)
+        self.hsv_mask = np.empty((height, width), dtype=np.uint8)
+        self.blue_filtered_greyscale = np.empty((height, width), dtype=np.uint8)
+        self.blur = np.empty((height, width), dtype=np.uint8)
+        self.mask = np.empty((height, width), dtype=np.uint8)
+
+class _TilePlan:
+    """
+    The tiles of a frame of a given size for filtering the full frame in tiles (see tiled_detection.py),
+    with a _BufferPlan for each tile.
+    """
+    __slots__ = ('shape', 'tiles', 'buffers')
+
+    def __init__(self, height: int, width: int, number_of_tiles: int):
+        self.shape = (height, width)
+        self.tiles = get_tiles(width, number_of_tiles)
+        self.buffers = [_BufferPlan(height, end - start) for start, end, _, _ in self.tiles]
 
 class HorizonDetector:
-    def __init__(self, exclusion_thresh: float, fov: float, acceptable_variance: float, frame_shape: tuple):
+    def __init__(self, exclusion_thresh: float, fov: float, acceptable_variance: float, frame_shape: tuple,
+                    horizon_lock_band: bool = False, sky_filter: str = 'hsv', smoothing_filter: str = 'bilateral',
+                    line_fit: str = 'tls', pyramid_resolution: tuple = None, backend: str = 'contour',
+                    segmentation_model: str = None, subpixel: bool = False, incremental_threshold: bool = False,
+                    flow_tracking_interval: int = 1, tiles: int = 1, color_space: str = 'bgr'):
         """
         exclusion_thresh: parameter that controls how close horizon points have to be
-        to predicted horizon in order to be considered valid
+        to predicted horizon in order to be considered valid. This is the upper limit;
+        the threshold shrinks with the uncertainty of the prediction (see horizon_tracker.py).
         fov: field of view of the camera
         acceptable_variance: minimum acceptable variance for horizon contour points.
         frame_shape: together with fov used to convert exclusion_thresh 
-        from a pitch angle to pixels
+        from a pitch angle to pixels. Also used to preallocate the buffers used by find_horizon.
+        Given as (width, height), i.e. the inference resolution.
+        horizon_lock_band: if True, only a band around the predicted horizon is processed
+        while there is a predicted horizon (horizon lock). Off by default: it saves about a quarter
+        of the time per frame, but the roll error in the band is close to twice that of the full frame.
+        sky_filter: how the blue of the sky is filtered out. 'hsv' converts each frame to HSV,
+        'lut' uses a precomputed lookup table from BGR (see sky_filter.py).
+        smoothing_filter: the filter applied before thresholding the image into sky and ground,
+        one of the keys of smoothing_filters.SMOOTHING_FILTERS.
+        line_fit: how the line is fitted to the horizon points, 'tls' (total least squares),
+        'ransac' or 'huber' (see horizon_fit.py).
+        pyramid_resolution: if given, e.g. (48, 48), a frame without a usable predicted horizon
+        is searched coarse to fine: first at this resolution, then in a narrow strip around
+        that horizon at the full resolution of the frame.
+        backend: how the horizon points are found in the sky/ground mask, 'contour', 'scanline'
+        or 'hough' (see horizon_backends.py).
+        segmentation_model: if given, the path of an ONNX sky segmentation network (see sky_segmentation.py)
+        that replaces the blue filter, the smoothing filter and the Otsu threshold.
+        subpixel: if True, the horizon points are moved off the pixel grid to where the smoothed image
+        crosses the threshold of the mask, before the fit (see subpixel.py).
+        incremental_threshold: if True, Otsu's threshold is estimated once per frame from a subsample
+        of the pixels and searched in full only when the histogram shifts (see otsu_threshold.py).
+        flow_tracking_interval: the horizon is fully detected every this many frames, and tracked
+        with optical flow in the frames in between while it stays good (see flow_tracking.py). 1 to always detect it.
+        tiles: if more than 1, the colors of the full frame are filtered and smoothed in this many tiles side by side,
+        at the same time on a thread pool (see tiled_detection.py). Meant for frames that cover the full width
+        of the camera frame.
+        color_space: the color space of the frames, 'bgr', or 'yuv' for three channel Y, U, V frames
+        (see yuv_frames.py). With 'yuv', the Y plane is the greyscale image, and the sky is filtered out
+        with a box in U and V instead of HSV (or with a lookup table from YUV with sky_filter 'lut').
         """
         self.exclusion_thresh = exclusion_thresh # in degrees of pitch
-        self.exclusion_thresh_pixels = exclusion_thresh * frame_shape[0] // fov
+        self.exclusion_thresh_pixels = exclusion_thresh * frame_shape[1] // fov
         self.fov = fov
         self.acceptable_variance = acceptable_variance
-        self.predicted_roll = None
-        self.predicted_pitch = None
-        self.recent_horizons = [None, None]
+        self.tracker = HorizonTracker()
+
+        # bounds of the blue sky filter in HSV
+        self.lower = np.array([109, 0, 116]) 
+        self.upper = np.array([153, 255, 255]) 
+        self.color_space = color_space
+        if sky_filter == 'lut':
+            self.sky_filter_lut = SkyFilterLUT(self.lower, self.upper, color_space=color_space)
+        else:
+            self.sky_filter_lut = None
+        self.smoothing_filter = SMOOTHING_FILTERS[smoothing_filter]()
+        # Some smoothing filters keep buffers of their own, so each tile has its own filter.
+        self.tiles = tiles
+        self.tile_smoothing_filters = [SMOOTHING_FILTERS[smoothing_filter]() for _ in range(tiles)]
+        if tiles > 1:
+            self.tile_executor = ThreadPoolExecutor(max_workers=tiles)
+        else:
+            self.tile_executor = None
+        self.tile_plan = None
+        if segmentation_model is not None:
+            self.sky_segmenter = SkySegmenter(segmentation_model)
+        else:
+            self.sky_segmenter = None
+        self.find_boundary = BACKENDS[backend]
+        self.find_full_frame_boundary = FULL_FRAME_BACKENDS.get(backend, self.find_boundary)
+        self.is_boundary_backend = backend in BOUNDARY_BACKENDS
+        self.uses_predicted_roll = backend in PREDICTED_ROLL_BACKENDS
+        self.subpixel = subpixel
+        if incremental_threshold:
+            self.threshold_estimator = IncrementalOtsu()
+        else:
+            self.threshold_estimator = None
+        # the threshold of the mask of the current frame, once it is known
+        self.frame_threshold = None
+
+        # the state of the optical flow tracking: the greyscale version of the last frame,
+        # the points and roll of its horizon (if it was good), and the number of frames it has been tracked for
+        self.flow_tracking_interval = flow_tracking_interval
+        self.flow_greyscale = None
+        self.flow_points = None
+        self.flow_roll = None
+        self.frames_since_detection = 0
+
+        # Points further from the line than twice the acceptable mean distance
+        # are treated as outliers by the ransac and huber fits.
+        self.line_fit = line_fit
+        self.inlier_threshold = max(acceptable_variance / 100 * frame_shape[1] * 2, 1)
+
+        # preallocate the buffers for the expected frame size
+        self.buffers = _BufferPlan(frame_shape[1], frame_shape[0])
+
+        # The band buffers are built the first time a band of a given size is processed
+        # and kept by (frame shape, band height), since the height follows the exclusion threshold.
+        self.horizon_lock_band = horizon_lock_band
+        self.band_plans = {}
+        self.band_buffers = None
+        self.band_frame = None
+
+        # buffers for filtering the colors of a whole chunk of frames in find_horizons
+        self.stacked_buffers = None
+
+        # the small frame and its buffers for the first step of the pyramid search
+        if pyramid_resolution is not None:
+            self.pyramid_parameters = get_cropping_and_scaling_parameters(frame_shape, pyramid_resolution)
+            self.pyramid_buffers = _BufferPlan(pyramid_resolution[1], pyramid_resolution[0])
+            self.pyramid_frame = np.empty((pyramid_resolution[1], pyramid_resolution[0], 3), dtype=np.uint8)
+        else:
+            self.pyramid_parameters = None
 
-    def find_horizon(self, frame:np.ndarray, diagnostic_mode:bool=False):
+    def set_smoothing_filter(self, smoothing_filter: str):
+        """
+        Switches to another smoothing filter, one of the keys of smoothing_filters.SMOOTHING_FILTERS.
+        """
+        self.smoothing_filter = SMOOTHING_FILTERS[smoothing_filter]()
+        self.tile_smoothing_filters = [SMOOTHING_FILTERS[smoothing_filter]() for _ in range(self.tiles)]
+
+    def find_horizon(self, frame:np.ndarray, diagnostic_mode:bool=False, threshold:float=None):
         """
         frame: the image in which you want to find the horizon
-        diagnostic_mode: if True, draws a diagnostic visualization. Should only be used for
-        testing, as it slows down performance.
+        diagnostic_mode: if True, the result includes a snapshot of the intermediate images
+        and points, which can be rendered with diagnostics.render_diagnostics.
+        threshold: if given, the mask is thresholded at this level instead of estimating one,
+        e.g. the threshold recorded with the frame, to replay a recording exactly.
+
+        Returns a HorizonResult.
+        """
+        return self._find_horizon(frame, diagnostic_mode, threshold=threshold)
+
+    def find_horizons(self, frames) -> dict:
+        """
+        Finds the horizon in a sequence of frames, e.g. a whole recording.
+        frames: an N x H x W x 3 array of frames, or an iterable of such arrays (chunks)
+        
+        The colour filtering is done for a whole chunk at once. The frames are otherwise
+        processed in order, exactly as if find_horizon was called on each of them,
+        so the predicted horizon is carried from one frame (and chunk) to the next.
+        Returns a dictionary of arrays with one value per frame: roll, pitch and variance 
+        (NaN where no horizon was found) and is_good_horizon.
+        """
+        if isinstance(frames, np.ndarray):
+            frames = (frames,)
+
+        columns = {'roll': [], 'pitch': [], 'variance': [], 'is_good_horizon': []}
+        for chunk in frames:
+            if len(chunk) == 0:
+                continue
+            chunk = np.ascontiguousarray(chunk)
+            number_of_frames, height, width = chunk.shape[:3]
+
+            # filter the colors of all frames at once by stacking them into one tall image
+            stacked_buffers = self.stacked_buffers
+            if stacked_buffers is None or stacked_buffers.shape != (number_of_frames * height, width):
+                stacked_buffers = self.stacked_buffers = _BufferPlan(number_of_frames * height, width)
+            stacked = chunk.reshape(number_of_frames * height, width, 3)
+            if self.sky_segmenter is not None:
+                # run the whole chunk through the segmentation network as one batch
+                bgr2gray = self._get_greyscale(stacked, stacked_buffers.bgr2gray)
+                blue_filtered_greyscale = stacked_buffers.blue_filtered_greyscale
+                if self.color_space == 'yuv':
+                    chunk = yuv_to_bgr(stacked).reshape(chunk.shape)
+                self.sky_segmenter.segment_batch(chunk, blue_filtered_greyscale.reshape(number_of_frames, height, width))
+            else:
+                bgr2gray, blue_filtered_greyscale = self._filter_colors(stacked, stacked_buffers)
+            bgr2gray = bgr2gray.reshape(number_of_frames, height, width)
+            blue_filtered_greyscale = blue_filtered_greyscale.reshape(number_of_frames, height, width)
+
+            roll = np.full(number_of_frames, np.nan)
+            pitch = np.full(number_of_frames, np.nan)
+            variance = np.full(number_of_frames, np.nan)
+            is_good_horizon = np.zeros(number_of_frames, dtype=bool)
+            for n, frame in enumerate(chunk):
+                result = self._find_horizon(frame, colors=(bgr2gray[n], blue_filtered_greyscale[n]))
+                if result.roll is None:
+                    continue
+                roll[n] = result.roll
+                pitch[n] = result.pitch
+                variance[n] = result.variance
+                is_good_horizon[n] = result.is_good_horizon
+            columns['roll'].append(roll)
+            columns['pitch'].append(pitch)
+            columns['variance'].append(variance)
+            columns['is_good_horizon'].append(is_good_horizon)
+
+        for key, values in columns.items():
+            dtype = bool if key == 'is_good_horizon' else float
+            columns[key] = np.concatenate(values) if values else np.empty(0, dtype=dtype)
+        return columns
+
+    def get_tracker_state(self) -> dict:
+        """
+        Returns the state that find_horizon carries from one frame to the next
+        (the state of the HorizonTracker, of the incremental threshold if it is used,
+        and of the optical flow tracking if it is used),
+        as a dictionary of plain python values that can be pickled or saved as json.
+        """
+        state = self.tracker.get_state()
+        if self.threshold_estimator is not None:
+            state['threshold'] = self.threshold_estimator.get_state()
+        if self.flow_tracking_interval > 1:
+            flow = {}
+            flow['greyscale'] = None if self.flow_greyscale is None else self.flow_greyscale.tolist()
+            flow['points'] = None if self.flow_points is None else [values.tolist() for values in self.flow_points]
+            flow['roll'] = self.flow_roll
+            flow['frames_since_detection'] = self.frames_since_detection
+            state['flow'] = flow
+        return state
+
+    def set_tracker_state(self, state: dict):
+        """
+        Restores a state obtained by get_tracker_state, e.g. to continue processing
+        a recording from the middle, where another HorizonDetector left off.
+        """
+        self.tracker.set_state(state)
+        if self.threshold_estimator is not None and 'threshold' in state:
+            self.threshold_estimator.set_state(state['threshold'])
+        # (a greyscale image of another inference resolution is not tracked from, see _track_horizon)
+        if self.flow_tracking_interval > 1 and 'flow' in state:
+            flow = state['flow']
+            self.flow_greyscale = None if flow['greyscale'] is None else np.array(flow['greyscale'], dtype=np.uint8)
+            self.flow_points = None if flow['points'] is None else tuple(np.array(values) for values in flow['points'])
+            self.flow_roll = flow['roll']
+            self.frames_since_detection = flow['frames_since_detection']
+
+    def _find_horizon(self, frame: np.ndarray, diagnostic_mode: bool = False, colors: tuple = None,
+                        threshold: float = None) -> HorizonResult:
+        """
+        Implementation of find_horizon.
+        colors: the greyscale and blue filtered greyscale versions of the frame, 
+        if they have already been computed
+        threshold: the level to threshold the mask at, if it is already known
         """
         # default values to return if no horizon can be found
-        roll, pitch, variance, is_good_horizon = None, None, None, None
+        result = HorizonResult(timings={})
+        self.frame_threshold = threshold
+
+        # The predicted horizon, with the exclusion threshold for this frame
+        # from the uncertainty of the prediction.
+        prediction = None
+        if self.tracker.predicted_roll is not None:
+            prediction = (self.tracker.predicted_roll, self.tracker.predicted_pitch,
+                            self._get_exclusion_pixels(frame.shape))
+
+        # Between full detections, track the horizon of the last frame with optical flow.
+        points, horizon = None, None
+        if self.flow_tracking_interval > 1:
+            points, horizon = self._track_horizon(frame, colors, result.timings)
+        result.is_tracked = points is not None
+
+        # If there is a predicted horizon, look for the horizon only in a band around it.
+        # If the horizon is lost within the band, fall back to searching the full frame.
+        if points is None and self.horizon_lock_band and prediction is not None:
+            points, horizon = self._find_horizon_in_band(frame, prediction, result.timings)
+            if horizon is None or not horizon[3]:
+                points, horizon = None, None
+
+        # In pyramid mode, search the full frame at a low resolution first
+        # and refine that horizon in a strip of the frame.
+        if points is None and self.pyramid_parameters is not None:
+            points, horizon = self._find_horizon_in_pyramid(frame, prediction, result.timings)
+            if horizon is None or not horizon[3]:
+                points, horizon = None, None
+
+        if points is None:
+            # rebuild the buffers if the frame size has changed
+            if self.buffers.shape != frame.shape[:2]:
+                self.buffers = _BufferPlan(*frame.shape[:2])
+            # The segmentation network sees the whole frame at once, and needs no smoothing.
+            blur = None
+            if self.tiles > 1 and self.sky_segmenter is None:
+                colors, blur = self._filter_tiles(frame, self.buffers, colors, result.timings)
+            points = self._find_points(frame, self.buffers, frame.shape, result.timings, 
+                                        reference=prediction, colors=colors, blur=blur)
+            horizon = self._fit_horizon(points, frame.shape)
+
+        # Take a snapshot of the diagnostic information, to be rendered elsewhere
+        # (see diagnostics.py). This only copies a few small images.
+        # Tracked frames have no intermediate images.
+        if diagnostic_mode and not result.is_tracked:
+            result.snapshot = DiagnosticSnapshot(points, frame.shape, self.fov)
+        result.threshold = points.get('threshold')
+
+        # the points to track into the next frame
+        if self.flow_tracking_interval > 1:
+            if not result.is_tracked:
+                self.frames_since_detection = 0
+            if horizon is not None and horizon[3]:
+                self.flow_points = (points['x_filtered'], points['y_filtered'])
+                self.flow_roll = horizon[0]
+            else:
+                self.flow_points = None
+
+        # predict the approximate position of the next horizon
+        if horizon is None:
+            self.tracker.update()
+            return result
+        roll, pitch, variance, is_good_horizon = horizon
+        self.tracker.update(roll, pitch, is_good_horizon)
+
+        # return the calculated values for horizon
+        result.roll = roll
+        result.pitch = pitch
+        result.variance = variance
+        result.is_good_horizon = is_good_horizon
+        return result
 
+    def _track_horizon(self, frame: np.ndarray, colors: tuple, timings: dict) -> tuple:
+        """
+        Moves the points of the horizon of the last frame into this frame with optical flow and fits the horizon
+        to them, unless it is time for a full detection. Keeps the greyscale version of the frame for the next frame.
+        colors: the output of _filter_colors for the frame, if it has already been computed
+        Returns the points and the output of _fit_horizon, or None and None if the horizon
+        was not tracked or is not good.
+        """
+        t1 = timer()
+        greyscale = colors[0] if colors is not None else self._get_greyscale(frame)
+        previous_greyscale = self.flow_greyscale
+        self.flow_greyscale = greyscale.copy()
+        if self.flow_points is None or self.frames_since_detection >= self.flow_tracking_interval - 1 or \
+                previous_greyscale.shape != greyscale.shape:
+            timings['flow'] = timings.get('flow', 0) + timer() - t1
+            return None, None
+
+        points = {}
+        points['x_filtered'], points['y_filtered'] = track_points(previous_greyscale, greyscale, *self.flow_points)
+        # The side of the sky is taken from the last horizon, which the tracked horizon
+        # is close to: a point SKY_POINT_DISTANCE from the middle of the points towards the sky.
+        if points['x_filtered'].size:
+            roll_radians = radians(self.flow_roll)
+            points['avg_x'] = np.mean(points['x_filtered']) + SKY_POINT_DISTANCE * sin(roll_radians)
+            points['avg_y'] = np.mean(points['y_filtered']) - SKY_POINT_DISTANCE * cos(roll_radians)
+        horizon = self._fit_horizon(points, frame.shape)
+        timings['flow'] = timings.get('flow', 0) + timer() - t1
+        if horizon is None or not horizon[3]:
+            return None, None
+        self.frames_since_detection += 1
+        return points, horizon
+
+    def _find_horizon_in_band(self, frame: np.ndarray, reference: tuple, timings: dict) -> tuple:
+        """
+        Looks for the horizon only in a band of the frame around the reference horizon.
+        reference: roll, pitch and exclusion threshold in pixels
+        Returns the points and the output of _fit_horizon.
+        """
+        transform = self._get_band_transform(frame.shape, reference)
+        band = cv2.warpAffine(frame, transform, self.band_buffers.shape[::-1], dst=self.band_frame,
+                                flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        points = self._find_points(band, self.band_buffers, frame.shape, timings, reference, transform)
+        return points, self._fit_horizon(points, frame.shape)
+
+    def _find_horizon_in_pyramid(self, frame: np.ndarray, prediction: tuple, timings: dict) -> tuple:
+        """
+        Finds the horizon in a small copy of the frame (at pyramid_resolution), then refines it
+        in a strip of the frame that is PYRAMID_STRIP_PIXELS (of the small copy) to either side of it.
+        Roll and pitch do not depend on the scale of the image, so they carry over directly.
+        prediction: the predicted horizon, if there is one, as roll, pitch and exclusion threshold in pixels
+        Returns the points and the output of _fit_horizon, or None and None.
+        """
+        # shrink the frame to the pyramid resolution
+        cropping_start = self.pyramid_parameters['cropping_start']
+        cropping_end = self.pyramid_parameters['cropping_end']
+        pyramid_frame = cv2.resize(frame[:, cropping_start:cropping_end], self.pyramid_frame.shape[1::-1], 
+                                    dst=self.pyramid_frame, interpolation=cv2.INTER_AREA)
+
+        # find the horizon in the small frame
+        scale_factor = self.pyramid_parameters['scale_factor']
+        if prediction is not None:
+            prediction = (prediction[0], prediction[1], max(prediction[2] * scale_factor, 1))
+        points = self._find_points(pyramid_frame, self.pyramid_buffers, pyramid_frame.shape, timings, prediction)
+        horizon = self._fit_horizon(points, pyramid_frame.shape)
+        if horizon is None:
+            return None, None
+
+        # refine it in a strip of the full frame
+        strip_pixels = int(np.ceil(PYRAMID_STRIP_PIXELS / scale_factor))
+        return self._find_horizon_in_band(frame, (horizon[0], horizon[1], strip_pixels), timings)
+
+    def _filter_tiles(self, frame: np.ndarray, buffers: _BufferPlan, colors: tuple, timings: dict) -> tuple:
+        """
+        Filters the colors of the frame and smooths the blue filtered greyscale image in tiles side by side,
+        all at the same time on the thread pool (see tiled_detection.py). The columns each tile keeps
+        are copied into the buffers of the frame. The timings are summed over the tiles.
+        colors: the output of _filter_colors for the frame, if it has already been computed
+        Returns the output of _filter_colors and the smoothed image, for the whole frame.
+        """
+        plan = self.tile_plan
+        if plan is None or plan.shape != frame.shape[:2]:
+            plan = self.tile_plan = _TilePlan(frame.shape[0], frame.shape[1], self.tiles)
+        tile_timings = [{} for _ in plan.tiles]
+
+        def filter_tile(n: int):
+            start, end, own_start, own_end = plan.tiles[n]
+            tile_buffers = plan.buffers[n]
+            t1 = timer()
+            if colors is None:
+                bgr2gray, blue_filtered_greyscale = self._filter_colors(frame[:, start:end], tile_buffers)
+                buffers.bgr2gray[:, own_start:own_end] = bgr2gray[:, own_start - start:own_end - start]
+                buffers.blue_filtered_greyscale[:, own_start:own_end] = \
+                    blue_filtered_greyscale[:, own_start - start:own_end - start]
+            else:
+                blue_filtered_greyscale = colors[1][:, start:end]
+            t2 = timer()
+            blur = self.tile_smoothing_filters[n].apply(blue_filtered_greyscale, tile_buffers.blur)
+            buffers.blur[:, own_start:own_end] = blur[:, own_start - start:own_end - start]
+            tile_timings[n]['color'] = t2 - t1
+            tile_timings[n]['mask'] = timer() - t2
+        # (list, so that an exception in a tile is raised here)
+        list(self.tile_executor.map(filter_tile, range(len(plan.tiles))))
+
+        for tile in tile_timings:
+            for stage, elapsed_time in tile.items():
+                timings[stage] = timings.get(stage, 0) + elapsed_time
+        if colors is None:
+            colors = (buffers.bgr2gray, buffers.blue_filtered_greyscale)
+        return colors, buffers.blur
+
+    def _filter_colors(self, image: np.ndarray, buffers: _BufferPlan) -> tuple:
+        """
+        Returns the greyscale version of the image and the greyscale version
+        with the blue of the sky filtered out (set to white).
+        With a segmentation network, the second image is the probability of sky from the network instead.
+        """
         # get greyscale
-        bgr2gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        bgr2gray = self._get_greyscale(image, buffers.bgr2gray)
+
+        if self.sky_segmenter is not None:
+            # the network was trained on BGR frames
+            if self.color_space == 'yuv':
+                image = yuv_to_bgr(image)
+            return bgr2gray, self.sky_segmenter.segment(image, dst=buffers.blue_filtered_greyscale)
 
         # filter our blue from the sky
-        lower = np.array([109, 0, 116]) 
-        upper = np.array([153, 255, 255]) 
-        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-        hsv_mask = cv2.inRange(hsv, lower, upper)
-        blue_filtered_greyscale = cv2.add(bgr2gray, hsv_mask)
+        if self.sky_filter_lut is not None:
+            # the lookup table is rebuilt if the bounds have changed
+            self.sky_filter_lut.set_bounds(self.lower, self.upper)
+            blue_filtered_greyscale = self.sky_filter_lut.apply(image, bgr2gray, dst=buffers.blue_filtered_greyscale)
+            return bgr2gray, blue_filtered_greyscale
+        if self.color_space == 'yuv':
+            hsv_mask = cv2.inRange(image, SKY_LOWER_YUV, SKY_UPPER_YUV, dst=buffers.hsv_mask)
+        else:
+            hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=buffers.hsv)
+            hsv_mask = cv2.inRange(hsv, self.lower, self.upper, dst=buffers.hsv_mask)
+        blue_filtered_greyscale = cv2.add(bgr2gray, hsv_mask, dst=buffers.blue_filtered_greyscale)
+        return bgr2gray, blue_filtered_greyscale
+
+    def _get_greyscale(self, image: np.ndarray, dst: np.ndarray = None) -> np.ndarray:
+        """
+        Returns the greyscale version of the image: the Y plane of a YUV image, or converted from BGR.
+        """
+        if self.color_space == 'yuv':
+            return cv2.extractChannel(image, 0, dst=dst)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=dst)
+
+    def _find_points(self, image: np.ndarray, buffers: _BufferPlan, frame_shape: tuple, timings: dict, 
+                        reference: tuple = None, transform: np.ndarray = None, colors: tuple = None,
+                        blur: np.ndarray = None) -> dict:
+        """
+        Segments the image into sky and ground and finds the horizon points along the boundary.
+        image: the frame, or a band extracted from the frame
+        buffers: a _BufferPlan matching the size of image
+        frame_shape: the shape of the frame. Points are returned in the coordinates of the frame.
+        timings: dictionary the time spent in each stage gets added to
+        reference: the horizon the points have to be close to, if any, as roll, pitch 
+        and exclusion threshold in pixels (usually the predicted horizon)
+        transform: if image is a band, the affine transform that maps the frame onto the band
+        colors: the output of _filter_colors for the image, if it has already been computed
+        blur: the smoothed blue filtered greyscale image, if it has already been computed
+        """
+        t1 = timer()
+        if colors is None:
+            colors = self._filter_colors(image, buffers)
+        bgr2gray, blue_filtered_greyscale = colors
+        t2 = timer()
 
         # generate mask
-        blur = cv2.bilateralFilter(blue_filtered_greyscale,9,50,50)
-        _, mask = cv2.threshold(blur,250,255,cv2.THRESH_OTSU)
-        edges = cv2.Canny(image=bgr2gray, threshold1=200, threshold2=250) 
-        edges = skimage.measure.block_reduce(edges, (POOLING_KERNEL_SIZE , POOLING_KERNEL_SIZE), np.max)
-
-        # find contours
-        # chain = cv2.CHAIN_APPROX_SIMPLE
-        chain = cv2.CHAIN_APPROX_NONE 
-        if OPERATING_SYSTEM == "Linux": # for raspberry pi
-            _, contours, _ = cv2.findContours(mask, cv2.RETR_TREE, chain) 
-        else: # for windows
-            contours, _ = cv2.findContours(mask, cv2.RETR_TREE, chain)
-
-        # If there weren't any contours found (i.e. the image was all black),
-        # end early, returning None values and the mask.
-        if len(contours) == 0:
-            # predict the next horizon
-            self._predict_next_horizon()
-
-            # convert the diagnostic image to color
-            if diagnostic_mode:
-                mask = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
-            return roll, pitch, variance, is_good_horizon, mask
-
-        # find the contour with the largest area
-        largest_contour = sorted(contours, key=cv2.contourArea, reverse=True)[0] 
-
-        # extract x and y values from contour
-        x_original = np.array([i[0][0] for i in largest_contour])
-        y_original = np.array([i[0][1] for i in largest_contour])
-
-        # Separate the points that lie on the edge of the frame from all other points.
-        # Edge points will be used to find sky_is_up.
-        # All other points will be used to find the horizon.
-        x_abbr = []
-        y_abbr = []
-        x_edge_points = []
-        y_edge_points = []
-        for n, x_point in enumerate(x_original):
-            y_point = y_original[n]
-            if x_point == 0 or x_point == frame.shape[1] - 1 or \
-                y_point == 0 or y_point == frame.shape[0]- 1:
-                x_edge_points.append(x_point)
-                y_edge_points.append(y_point)
+        if self.sky_segmenter is not None:
+            # the output of the network is smooth already, and sky where it is more likely than not
+            blur = blue_filtered_greyscale
+            threshold, mask = cv2.threshold(blur, 127, 255, cv2.THRESH_BINARY, dst=buffers.mask)
+        else:
+            if blur is None:
+                blur = self.smoothing_filter.apply(blue_filtered_greyscale, buffers.blur)
+            # With the incremental threshold, the threshold is estimated once per frame and kept
+            # if the frame is searched again (the full frame after the band, or the strip after the pyramid),
+            # so that a frame can be replayed from its recorded threshold alone.
+            if self.frame_threshold is None and self.threshold_estimator is not None:
+                self.frame_threshold = self.threshold_estimator.update(blur)
+            if self.frame_threshold is not None:
+                threshold, mask = cv2.threshold(blur, self.frame_threshold, 255, cv2.THRESH_BINARY, dst=buffers.mask)
             else:
-                x_abbr.append(x_point)
-                y_abbr.append(y_point)
+                threshold, mask = cv2.threshold(blur,250,255,cv2.THRESH_OTSU, dst=buffers.mask)
+        t3 = timer()
+
+        # find the boundary between sky and ground, and the edge points
+        if transform is None:
+            if reference is not None and self.uses_predicted_roll:
+                boundary = self.find_full_frame_boundary(mask, blur, reference[0])
+            else:
+                boundary = self.find_full_frame_boundary(mask, blur)
+        else:
+            boundary = self.find_boundary(mask, blur)
+        t4 = timer()
+
+        points = {}
+        points['mask'] = mask
+        points['threshold'] = threshold
+        points['bgr2gray'] = bgr2gray
+        points['blue_filtered_greyscale'] = blue_filtered_greyscale
+        points['transform'] = transform
+        points['reference'] = reference
+        points['x_abbr'] = points['x_filtered'] = np.empty(0)
+        points['y_abbr'] = points['y_filtered'] = np.empty(0)
+
+        # If there wasn't any boundary found (i.e. the image was all black),
+        # end early, returning no points.
+        if boundary is None:
+            self._add_timings(timings, t1, t2, t3, t4, timer())
+            return points
+
+        # The edge points (on the edge of the image) will be used to find sky_is_up.
+        # All other points will be used to find the horizon.
+        x_original, y_original, is_edge_point = boundary
+
+        # If the image is a band, convert the points to the coordinates of the frame and
+        # drop the points that fall outside the frame. The band coordinates are
+        # kept for looking up the edges.
+        if transform is not None:
+            inverse_transform = cv2.invertAffineTransform(transform)
+            x_frame = inverse_transform[0, 0] * x_original + inverse_transform[0, 1] * y_original + inverse_transform[0, 2]
+            y_frame = inverse_transform[1, 0] * x_original + inverse_transform[1, 1] * y_original + inverse_transform[1, 2]
+            in_frame = (x_frame >= 0) & (x_frame <= frame_shape[1] - 1) & \
+                        (y_frame >= 0) & (y_frame <= frame_shape[0] - 1)
+            x_edge_points = x_frame[is_edge_point & in_frame]
+            y_edge_points = y_frame[is_edge_point & in_frame]
+            x_abbr = x_frame[~is_edge_point & in_frame]
+            y_abbr = y_frame[~is_edge_point & in_frame]
+            x_image = x_original[~is_edge_point & in_frame]
+            y_image = y_original[~is_edge_point & in_frame]
+        else:
+            x_edge_points = x_original[is_edge_point]
+            y_edge_points = y_original[is_edge_point]
+            x_abbr = x_image = x_original[~is_edge_point]
+            y_abbr = y_image = y_original[~is_edge_point]
 
         # Find the average position of the edge points.
         # This will help determine the direction of the sky.
@@ -112,12 +649,12 @@ class HorizonDetector:
         # Check if there are any edge points. If there are, take the average of them to determine
         # sky_is_up. If there aren't any edge points, take the average of the abbreviated point list
         # instead, since it is not possible to take the average of an empty list.
-        if x_edge_points:
-            avg_x = np.average(x_edge_points)
-            avg_y = np.average(y_edge_points)
-        else:
-            avg_x = np.average(x_abbr)
-            avg_y = np.average(y_abbr)
+        if x_edge_points.size:
+            points['avg_x'] = np.average(x_edge_points)
+            points['avg_y'] = np.average(y_edge_points)
+        elif x_abbr.size:
+            points['avg_x'] = np.average(x_abbr)
+            points['avg_y'] = np.average(y_abbr)
 
         # Reduce the number of horizon points to improve performance.
         maximum_number_of_points = 100
@@ -125,154 +662,87 @@ class HorizonDetector:
         if step_size > 1:
             x_abbr = x_abbr[::step_size]
             y_abbr = y_abbr[::step_size]  
+            x_image = x_image[::step_size]
+            y_image = y_image[::step_size]
+
+        # Move the points off the pixel grid, to where the smoothed image crosses the threshold
+        # (the mask is white above the threshold, so the boundary lies half a level above it).
+        # The edges are still looked up at the refined points, which stay within their pixel or next to it.
+        if self.subpixel:
+            x_image, y_image = refine_points(blur, threshold + .5, x_image, y_image)
+            if transform is not None:
+                x_abbr = inverse_transform[0, 0] * x_image + inverse_transform[0, 1] * y_image + inverse_transform[0, 2]
+                y_abbr = inverse_transform[1, 0] * x_image + inverse_transform[1, 1] * y_image + inverse_transform[1, 2]
+            else:
+                x_abbr, y_abbr = x_image, y_image
+        # Pixel n covers the span from n to n + 1, so its center lies at n + .5. Only with the points
+        # in these coordinates does the center of the frame lie at half its size at every inference
+        # resolution, as the pitch assumes. This goes for the refined points and for the backends whose points
+        # lie on the boundary itself (see horizon_backends.py), not for the sky pixels of the contour.
+        if self.subpixel or self.is_boundary_backend:
+            x_abbr = x_abbr + .5
+            y_abbr = y_abbr + .5
 
-        # define some values for checking distance to previous horizon
-        if self.predicted_roll is not None:
-            # convert predicted_roll to radians
-            predicted_roll_radians = radians(self.predicted_roll)
-
-            # find the distance 
-            distance = self.predicted_pitch / self.fov * frame.shape[0]
-
-            # define the line perpendicular to horizon
-            angle_perp = predicted_roll_radians + pi / 2
-            x_perp = distance * cos(angle_perp) + frame.shape[1]/2
-            y_perp = distance * sin(angle_perp) + frame.shape[0]/2
-
-            # convert from roll and pitch of predicted horizon to m and b
-            run = cos(predicted_roll_radians)
-            rise = sin(predicted_roll_radians) 
-            if run != 0:
-                predicted_m = rise / run
-                predicted_b = y_perp - predicted_m * x_perp            
-
-            # define two points on the line from the previous horizon
-            p1 = np.array([0, predicted_b])
-            p2 = np.array([frame.shape[1], predicted_m * frame.shape[1] + predicted_b])
-            p2_minus_p1 = p2 - p1 
-
-        # Initialize some lists to contain the new (filtered) x and y values.
-        x_filtered = []
-        y_filtered = []
         # Filter out points that don't lie on an edge.
-        for idx, x_point in enumerate(x_abbr):
-            y_point = y_abbr[idx]
-
-            # evaluate if the point exists on an edge
-            if edges[y_point//POOLING_KERNEL_SIZE][x_point//POOLING_KERNEL_SIZE] == 0:
-                continue # do not append the point
-
-            # If there is no predicted horizon, perform no further
-            # filtering on this point and accept it as valid.
-            if self.predicted_roll is None:
-                x_filtered.append(x_point)
-                y_filtered.append(y_point)
-                continue 
-
-            # If there is a predicted horizon, check if the current point
-            # is reasonably close to it.
-            p3 = np.array([x_point, y_point])
-            distance = norm(np.cross(p2_minus_p1, p1-p3))/norm(p2_minus_p1)
-            if distance < self.exclusion_thresh_pixels:
-                x_filtered.append(x_point)
-                y_filtered.append(y_point)
-
-        # convert to numpy array
-        x_filtered = np.array(x_filtered)
-        y_filtered = np.array(y_filtered)
-
-        # Draw the diagnostic information.
-        # Only use for diagnostics, as this slows down inferences. 
-        if diagnostic_mode:
-            # scale up the diagnostic image to make it easier to see
-            desired_height = 500
-            scale_factor = desired_height / frame.shape[0]
-            desired_width = int(np.round(frame.shape[1] * scale_factor))
-            desired_dimensions = (desired_width, desired_height)
-            mask = cv2.resize(mask, desired_dimensions)
-            # convert the diagnostic image to color
-            mask = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
-
-            # draw the abbreviated points
-            for n, i in enumerate(x_abbr):
-                circle_x = int(np.round(i * scale_factor))
-                circle_y = int(np.round(y_abbr[n] * scale_factor))
-                cv2.circle(mask, (circle_x, circle_y), 5, (0,0,255), -1)
-            # draw the filtered points
-            for n, i in enumerate(x_filtered):
-                circle_x = int(np.round(i * scale_factor))
-                circle_y = int(np.round(y_filtered[n] * scale_factor))
-                cv2.circle(mask, (circle_x, circle_y), 5, (0,255,0), -1)
-            # draw the predicted horizon, if there is one
-            if self.predicted_roll:
-                lower_pitch = self.predicted_pitch + self.exclusion_thresh
-                draw_horizon(mask, self.predicted_roll, lower_pitch, self.fov, (0,150,255),  False)
-                upper_pitch = self.predicted_pitch - self.exclusion_thresh
-                draw_horizon(mask, self.predicted_roll, upper_pitch, self.fov, (0,150,255),  False)
-                cv2.putText(mask, 'Horizon Lock',(20,40),cv2.FONT_HERSHEY_COMPLEX_SMALL,1,(0,150,255),1,cv2.LINE_AA)
-
-            # for testing
-            _, edges_binary = cv2.threshold(edges,10,255,cv2.THRESH_BINARY)
-            edges_binary = cv2.resize(edges_binary, desired_dimensions)
-            cv2.imshow('canny', edges_binary)
-            blue_filtered_greyscale = cv2.resize(blue_filtered_greyscale, desired_dimensions)
-            cv2.imshow('blue_filtered_greyscale', blue_filtered_greyscale)
-            mask = cv2.resize(mask, desired_dimensions)
-            cv2.imshow('mask', mask)
-                
+        # The gradient is only computed around these points (see edge_validation.py).
+        is_valid_point = is_on_edge(bgr2gray, x_image, y_image)
+
+        # If there is a reference horizon, also filter out the points
+        # that are not reasonably close to it.
+        if reference is not None:
+            x_center, y_center, reference_roll_radians = self._get_reference_point(frame_shape, reference)
+            # distance along the normal of the reference horizon
+            distances = np.abs((y_abbr - y_center) * cos(reference_roll_radians) - \
+                                (x_abbr - x_center) * sin(reference_roll_radians))
+            is_valid_point &= distances < reference[2]
+
+        points['x_abbr'] = x_abbr
+        points['y_abbr'] = y_abbr
+        points['x_filtered'] = x_abbr[is_valid_point]
+        points['y_filtered'] = y_abbr[is_valid_point]
+        self._add_timings(timings, t1, t2, t3, t4, timer())
+        return points
+
+    def _fit_horizon(self, points: dict, frame_shape: tuple):
+        """
+        Fits the horizon to the points found by _find_points.
+        Returns roll, pitch, variance and is_good_horizon, or None if 
+        too few points were found.
+        """
+        x_filtered = points['x_filtered']
+        y_filtered = points['y_filtered']
+
         # Return None values for horizon, since too few points were found.
         if x_filtered.shape[0] < 12:
-            self._predict_next_horizon()
-            return roll, pitch, variance, is_good_horizon, mask
-
-        # polyfit
-        m, b = np.polyfit(x_filtered, y_filtered, 1)
-        roll = atan2(m,1)
-        roll = degrees(roll)
-
-        # determine the direction of the sky (above or below)
-        if m * avg_x + b > avg_y:
-            sky_is_up = 1 # above
+            return None
+
+        # fit the line in normal form, which also works for vertical horizons
+        fit = fit_line(x_filtered, y_filtered, self.line_fit, self.inlier_threshold)
+        if np.count_nonzero(fit.inliers) < 12:
+            return None
+
+        # Determine the direction of the sky. The roll is the angle of the line, turned around
+        # by 180 degrees if the sky is on the positive side of the normal of the fitted line.
+        # The sky then always lies on the negative side of the normal (-sin(roll), cos(roll)).
+        if fit.signed_distance(points['avg_x'], points['avg_y']) < 0:
+            roll = degrees(fit.angle)
+            sky_side = 1
         else:
-            sky_is_up = 0 # below
+            roll = degrees(fit.angle) + FULL_ROTATION / 2
+            sky_side = -1
+        roll %= FULL_ROTATION
 
         # Get pitch
         # Take the distance from center point of the image to the horizon and find the pitch in degrees
         # based on field of view of the camera and the height of the image.
-        # Define two points along horizon.
-        p1 = np.array([0, b])
-        p2 = np.array([frame.shape[1], m * frame.shape[1] + b])
-        # Center of the image
-        p3 = np.array([frame.shape[1]//2, frame.shape[0]//2])
-        # Find distance to horizon
-        distance_to_horizon = norm(np.cross(p2-p1, p1-p3))/norm(p2-p1)
-        # Find out if plane is pointing above or below horizon
-        if p3[1] < m * frame.shape[1]//2 + b and sky_is_up:
-            plane_pointing_up = 1
-        elif p3[1] > m *frame.shape[1]//2 + b and sky_is_up == False:
-            plane_pointing_up = 1
-        else:
-            plane_pointing_up = 0
-        pitch = distance_to_horizon / frame.shape[0] * self.fov
-        if not plane_pointing_up:
-            pitch *= -1
+        # The pitch is positive when the center of the image lies on the sky side of the horizon.
+        # (the center of a frame of odd width or height lies in the middle of a pixel)
+        center_distance = fit.signed_distance(frame_shape[1]/2, frame_shape[0]/2) * sky_side
+        pitch = -center_distance / frame_shape[0] * self.fov
 
         # FIND VARIANCE 
         # This will be treated as a confidence score.
-        p1 = np.array([0, b])
-        p2 = np.array([frame.shape[1], m * frame.shape[1] + b])
-        p2_minus_p1 = p2 - p1
-        distance_list = []
-        for n, x_point in enumerate(x_filtered):
-            y_point = y_filtered[n]
-            p3 = np.array([x_point, y_point])
-            distance = norm(np.cross(p2_minus_p1, p1-p3))/norm(p2_minus_p1)
-            distance_list.append(distance)
-            
-        variance = np.average(distance_list) / frame.shape[0] * 100
-        
-        # adjust the roll within the range of 0 - 360 degrees
-        roll = self._adjust_roll(roll, sky_is_up) 
+        variance = fit.mean_distance / frame_shape[0] * 100
 
         # determine if the horizon is acceptable
         if variance < self.acceptable_variance: 
@@ -280,58 +750,82 @@ class HorizonDetector:
         else:
             is_good_horizon = 0
 
-        # predict the approximate position of the next horizon
-        self._predict_next_horizon(roll, pitch, is_good_horizon)
+        return roll, pitch, variance, is_good_horizon
 
-        # return the calculated values for horizon
-        return roll, pitch, variance, is_good_horizon, mask
-    
-    def _adjust_roll(self, roll: float, sky_is_up: bool) -> float:
+    def _get_reference_point(self, frame_shape: tuple, reference: tuple, snap_to_grid: bool = False) -> tuple:
         """
-        Adjusts the roll to be within the range of 0-360 degrees.
-        Removes negative values and values greater than 360 degrees.
+        Returns the point on the reference horizon (roll, pitch, ...) closest to the center of the frame
+        (x, y) and the reference roll in radians.
+        snap_to_grid: if True, the roll is rounded to whole degrees and the distance
+        from the center of the frame to whole pixels.
         """
-        roll = abs(roll % FULL_ROTATION)
-        in_sky_is_up_sector = (roll >= FULL_ROTATION * .75  or (roll > 0 and roll <= FULL_ROTATION * .25))
-        
-        if sky_is_up == in_sky_is_up_sector:
-            return roll
-        if roll < FULL_ROTATION / 2:
-            roll += FULL_ROTATION / 2
-        else:
-            roll -= FULL_ROTATION / 2
-        return roll
-
-    def _predict_next_horizon(self, current_roll=None, current_pitch=None, is_good_horizon=None):
+        # convert the roll to radians
+        reference_roll = reference[0]
+        if snap_to_grid:
+            reference_roll = round(reference_roll)
+        reference_roll_radians = radians(reference_roll)
+
+        # find the distance 
+        distance = reference[1] / self.fov * frame_shape[0]
+        if snap_to_grid:
+            distance = round(distance)
+
+        # define the line perpendicular to horizon
+        angle_perp = reference_roll_radians + pi / 2
+        x_perp = distance * cos(angle_perp) + frame_shape[1]/2
+        y_perp = distance * sin(angle_perp) + frame_shape[0]/2
+        return x_perp, y_perp, reference_roll_radians
+
+    def _get_exclusion_pixels(self, frame_shape: tuple) -> int:
         """
-        Based on the positions of recent horizons, predict the approximate
-        position of the next horizon.
-        Used to filter out noise in the next iteration.
+        Returns the distance from the predicted horizon, in whole pixels, beyond which horizon points
+        are filtered out. EXCLUSION_SIGMAS times the uncertainty of the prediction, where the
+        uncertainty of the roll counts as much as it moves the ends of the horizon.
         """
-        # if the current horizon is not good, mark it as None
-        if not is_good_horizon:
-            current_horizon = None
-        else:
-            current_horizon = (current_roll, current_pitch)
-
-        # update the list of recent horizons
-        self.recent_horizons.append(current_horizon)
-        del self.recent_horizons[0]
-        
-        # calculate the positions of the next horizon
-        if None in self.recent_horizons:
-            self.predicted_roll = None
-            self.predicted_pitch = None
-        else:
-            roll1 = self.recent_horizons[0][0]
-            roll2 = self.recent_horizons[1][0]
-            roll_delta = roll2 - roll1
-            self.predicted_roll =  roll2 + roll_delta
-
-            pitch1 = self.recent_horizons[0][1]
-            pitch2 = self.recent_horizons[1][1]
-            pitch_delta = pitch2 - pitch1
-            self.predicted_pitch = pitch2 + pitch_delta
+        roll_std, pitch_std = self.tracker.get_uncertainty()
+        pitch_std_pixels = pitch_std / self.fov * frame_shape[0]
+        roll_std_pixels = radians(roll_std) * np.hypot(frame_shape[0], frame_shape[1]) / 2
+        std_pixels = np.hypot(pitch_std_pixels, roll_std_pixels)
+        exclusion_pixels = int(np.ceil(EXCLUSION_SIGMAS * std_pixels))
+        return min(max(exclusion_pixels, MIN_EXCLUSION_PIXELS), self.exclusion_thresh_pixels)
+
+    def _get_band_transform(self, frame_shape: tuple, reference: tuple) -> np.ndarray:
+        """
+        Returns the affine transform that maps the frame onto a band centered
+        on the reference horizon, with the reference horizon running along the middle row of the band.
+        The band is as long as the diagonal of the frame, so that it covers the reference horizon
+        at any roll, and extends the exclusion threshold of the reference plus a margin to either side of it.
+        reference: roll, pitch and exclusion threshold in pixels
+        """
+        # select the band buffers for this frame size and band height, building them if needed
+        band_height = 2 * int(reference[2] + BAND_MARGIN)
+        key = (frame_shape[:2], band_height)
+        if key not in self.band_plans:
+            band_width = int(np.ceil(np.hypot(frame_shape[0], frame_shape[1])))
+            self.band_plans[key] = (_BufferPlan(band_height, band_width),
+                                    np.empty((band_height, band_width, 3), dtype=np.uint8))
+        self.band_buffers, self.band_frame = self.band_plans[key]
+        band_width = self.band_buffers.shape[1]
+
+        # The band is snapped to a grid, so that nearly identical predictions give exactly
+        # the same band. Otherwise tiny differences in the prediction would never die out,
+        # and a recording processed in chunks (see parallel_detection.py) could never
+        # reproduce the results of processing it in one go.
+        x_center, y_center, reference_roll_radians = self._get_reference_point(frame_shape, reference, snap_to_grid=True)
+        c = cos(reference_roll_radians)
+        s = sin(reference_roll_radians)
+        transform = np.array([[c, s, band_width/2 - c * x_center - s * y_center],
+                              [-s, c, band_height/2 + s * x_center - c * y_center]])
+        return transform
+
+    def _add_timings(self, timings: dict, t1: float, t2: float, t3: float, t4: float, t5: float):
+        """
+        Adds the time spent in each stage of _find_points to timings.
+        """
+        timings['color'] = timings.get('color', 0) + t2 - t1
+        timings['mask'] = timings.get('mask', 0) + t3 - t2
+        timings['boundary'] = timings.get('boundary', 0) + t4 - t3
+        timings['points'] = timings.get('points', 0) + t5 - t4
 
 if __name__ == "__main__":
     import numpy as np
@@ -362,7 +856,7 @@ if __name__ == "__main__":
     for n in range(ITERATIONS):
         # scale the images down
         frame_small = crop_and_scale(frame, **CROP_AND_SCALE_PARAM)
-        output = horizon_detector.find_horizon(frame_small, diagnostic_mode=False)
+        result = horizon_detector.find_horizon(frame_small, diagnostic_mode=False)
 
     t2 = timer()
     elapsed_time = t2 - t1
@@ -370,8 +864,9 @@ if __name__ == "__main__":
     print(f'Finished at {fps} FPS.')
 
     # draw the horizon
-    output = horizon_detector.find_horizon(frame_small, diagnostic_mode=True)
-    roll, pitch, variance, is_good_horizon, mask = output
+    from diagnostics import render_diagnostics
+    result = horizon_detector.find_horizon(frame_small, diagnostic_mode=True)
+    roll, pitch, mask = result.roll, result.pitch, render_diagnostics(result.snapshot)['mask']
     color = (255,0,0)
     draw_horizon(frame, roll, pitch, FOV, color, True)
     print(f'Calculated roll: {roll}')
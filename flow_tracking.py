@@ -0,0 +1,77 @@
+######## Optical flow tracking of the horizon points #########
+# With flow tracking, HorizonDetector only runs the full detection (color filter, smoothing, mask, boundary)
+# every flow_tracking_interval frames, or sooner when the tracked horizon is no longer good.
+# In between, the points of the last horizon are moved along with the image by sparse Lucas-Kanade
+# optical flow (cv2.calcOpticalFlowPyrLK) on the greyscale frame, and the line is fitted to them again.
+# The points lie on the edge between sky and ground, so the flow across the edge is well defined;
+# the flow along the edge is not, but a point that slides along the horizon stays on it.
+# The full detections correct the drift the tracked points build up.
+#
+# Results on synthetic 300 frame flights (python flow_tracking.py), measured on a desktop x86 core.
+# Times are the whole of find_horizon per frame. The cluttered flight has 10 buildings and trees along the horizon.
+#
+# flight     resolution  interval  time     good   roll err  pitch err
+# clear      100x100     1         0.73 ms  100%   0.17      0.17
+# clear      100x100     4         0.47 ms  100%   0.24      0.17
+# clear      100x100     8         0.42 ms  100%   0.30      0.17
+# clear      200x200     1         1.05 ms  100%   0.09      0.08
+# clear      200x200     4         0.65 ms  100%   0.13      0.08
+# clear      200x200     8         0.47 ms  100%   0.17      0.08
+# cluttered  100x100     1         0.95 ms   55%   0.69      0.44
+# cluttered  100x100     8         0.86 ms   61%   0.73      0.43
+# cluttered  200x200     1         1.50 ms   71%   0.62      0.29
+# cluttered  200x200     8         1.88 ms   76%   0.75      0.29
+#
+# On the clear flight, 85% of the frames are tracked at an interval of 8. A tracked frame costs about
+# 170 us at 100x100, most of it the optical flow of the 20 points. The rest go through the full detection.
+# With clutter, the horizon is rarely good enough to be tracked, so there is nothing to gain
+# (the times of the cluttered flight are within the noise of the measurement).
+# The roll error grows with the interval as the tracked points drift; the pitch error does not.
+# The synthetic frames draw new clouds and ground texture in every frame, which is harder on the flow
+# than real footage.
+
+import cv2
+import numpy as np
+
+# The cost of the optical flow grows with the number of points (about 2.5 us per point and pyramid level
+# on a desktop core), so only this many of the horizon points are followed. A line needs far fewer,
+# but _fit_horizon wants at least 12.
+MAX_FLOW_POINTS = 20
+# size of the window around each point that is followed from one frame to the next
+FLOW_WINDOW = (9, 9)
+# number of pyramid levels above the frame, for motion larger than the window
+FLOW_LEVELS = 1
+FLOW_CRITERIA = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, .03)
+# distance (in pixels) from the line towards the sky of the point that tells on which side the sky lies
+SKY_POINT_DISTANCE = 10
+
+def track_points(previous_greyscale: np.ndarray, greyscale: np.ndarray, x: np.ndarray, y: np.ndarray) -> tuple:
+    """
+    Returns where the points (x, y) of the previous greyscale frame are in the current one.
+    Only MAX_FLOW_POINTS of the points, evenly spread, are followed.
+    Points that could not be followed or that left the frame are dropped.
+    """
+    step = -(-x.size // MAX_FLOW_POINTS)
+    if step > 1:
+        x = x[::step]
+        y = y[::step]
+    previous_points = np.stack((x, y), axis=-1).astype(np.float32).reshape(-1, 1, 2)
+    points, status, _ = cv2.calcOpticalFlowPyrLK(previous_greyscale, greyscale, previous_points, None,
+                                                    winSize=FLOW_WINDOW, maxLevel=FLOW_LEVELS, criteria=FLOW_CRITERIA)
+    x = points[:, 0, 0]
+    y = points[:, 0, 1]
+    height, width = greyscale.shape
+    is_tracked = (status[:, 0] == 1) & (x >= 0) & (x <= width - 1) & (y >= 0) & (y <= height - 1)
+    return x[is_tracked], y[is_tracked]
+
+if __name__ == "__main__":
+    from horizon_benchmark import make_flight, run_benchmark, print_stats
+
+    print('Rendering synthetic flights...')
+    flights = {'clear': make_flight(), 'cluttered': make_flight(clutter=10)}
+    for flight_name, (frames, rolls, pitches) in flights.items():
+        for inference_resolution in [(100, 100), (200, 200)]:
+            for flow_tracking_interval in [1, 2, 4, 8]:
+                stats = run_benchmark(frames, rolls, pitches, inference_resolution,
+                                        flow_tracking_interval=flow_tracking_interval)
+                print_stats(f'{flight_name} {inference_resolution} every {flow_tracking_interval}', stats)
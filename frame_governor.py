@@ -0,0 +1,135 @@
+######## Frame budget governor #########
+# Keeps the main loop within its frame budget (1/FPS) by giving up work step by step
+# when the loop runs long, and taking the work back on when there is headroom again.
+# The steps are taken in the order of the ladder, so the cheapest things to give up come first.
+# The governor only decides which steps are active; main.py carries them out.
+
+from collections import deque
+from timeit import default_timer as timer
+
+# all steps, in the default order of the ladder
+HUD_OFF = 'hud_off' # stop rendering the real-time display
+HALF_RECORDING_FPS = 'half_recording_fps' # only record every other frame
+CHEAP_SMOOTHING_FILTER = 'cheap_smoothing_filter' # switch to a cheaper smoothing filter
+LOW_INFERENCE_RESOLUTION = 'low_inference_resolution' # lower the inference resolution
+ALTERNATE_FRAME_DETECTION = 'alternate_frame_detection' # only look for the horizon in every other frame
+LADDER = (HUD_OFF, HALF_RECORDING_FPS, CHEAP_SMOOTHING_FILTER, LOW_INFERENCE_RESOLUTION, ALTERNATE_FRAME_DETECTION)
+
+# Step down when the average busy time of the loop exceeds this fraction of the frame budget.
+DEGRADE_THRESHOLD = .9
+# Step back up when the average busy time plus the time the step saved stays below this fraction.
+RESTORE_THRESHOLD = .75
+# number of seconds over which the busy time is averaged, and that have to pass between two transitions
+WINDOW = 1
+
+class FrameGovernor:
+    """
+    Measures how long each stage of the main loop takes and moves up and down the ladder.
+
+    Usage, for every iteration of the main loop:
+        governor.start_frame()
+        ... capture ...
+        governor.mark('capture')
+        ... detection ...
+        governor.mark('detection')
+        ...
+        transition = governor.end_frame() # before sleeping for the rest of the frame
+    """
+    def __init__(self, fps: float, ladder: tuple = LADDER, degrade_threshold: float = DEGRADE_THRESHOLD,
+                    restore_threshold: float = RESTORE_THRESHOLD, window: float = WINDOW):
+        """
+        fps: the target frame rate, which sets the frame budget
+        ladder: the steps, in the order in which they are taken. Can be empty to turn off the governor.
+        """
+        for step in ladder:
+            if step not in LADDER:
+                raise ValueError(f'Unknown governor step: {step}. Known steps: {LADDER}')
+        self.frame_budget = 1 / fps
+        self.ladder = tuple(ladder)
+        self.degrade_threshold = degrade_threshold
+        self.restore_threshold = restore_threshold
+        self.window_size = max(int(round(window * fps)), 1)
+
+        # number of steps taken, i.e. the steps ladder[:level] are active
+        self.level = 0
+        # busy time of the recent frames, and of each stage of the recent frames
+        self.busy_times = deque(maxlen=self.window_size)
+        self.stage_times = {}
+        # for each step taken, the busy time before it was taken and the time it saved
+        # (None until a full window has been measured with the step active)
+        self.busy_times_before_step = []
+        self.savings = []
+
+        self.t_start = None
+        self.t_mark = None
+        self.frame_stage_times = {}
+
+    def is_active(self, step: str) -> bool:
+        """
+        Returns True if the step has been taken.
+        """
+        return step in self.ladder[:self.level]
+
+    def start_frame(self):
+        """
+        Call at the start of each iteration of the main loop.
+        """
+        self.t_start = self.t_mark = timer()
+        self.frame_stage_times = {}
+
+    def mark(self, stage: str):
+        """
+        Attributes the time since the last mark (or the start of the frame) to the stage.
+        """
+        t = timer()
+        self.frame_stage_times[stage] = self.frame_stage_times.get(stage, 0) + t - self.t_mark
+        self.t_mark = t
+
+    def end_frame(self):
+        """
+        Call at the end of each iteration of the main loop, before waiting for the next frame.
+        Returns None, or a dictionary describing the transition if a step was taken or given back:
+        step, active (True if the step was taken), level and the average busy time and
+        stage times in milliseconds that led to the transition.
+        """
+        self.busy_times.append(timer() - self.t_start)
+        for stage, stage_time in self.frame_stage_times.items():
+            if stage not in self.stage_times:
+                self.stage_times[stage] = deque(maxlen=self.window_size)
+            self.stage_times[stage].append(stage_time)
+
+        # only decide once a full window has been measured since the last transition
+        if len(self.busy_times) < self.window_size:
+            return None
+        busy_time = sum(self.busy_times) / len(self.busy_times)
+
+        # the first full window after taking a step shows how much time it saved
+        if self.level and self.savings[-1] is None:
+            self.savings[-1] = max(self.busy_times_before_step[-1] - busy_time, 0)
+
+        if busy_time > self.degrade_threshold * self.frame_budget and self.level < len(self.ladder):
+            step = self.ladder[self.level]
+            self.level += 1
+            self.busy_times_before_step.append(busy_time)
+            self.savings.append(None)
+            active = True
+        elif self.level and busy_time + self.savings[-1] < self.restore_threshold * self.frame_budget:
+            self.level -= 1
+            step = self.ladder[self.level]
+            self.busy_times_before_step.pop()
+            self.savings.pop()
+            active = False
+        else:
+            return None
+
+        transition = {}
+        transition['step'] = step
+        transition['active'] = active
+        transition['level'] = self.level
+        transition['busy_time'] = busy_time * 1000
+        transition['stage_times'] = {stage: sum(times) / len(times) * 1000 for stage, times in self.stage_times.items()}
+
+        # start measuring again with the new level
+        self.busy_times.clear()
+        self.stage_times = {}
+        return transition
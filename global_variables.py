@@ -19,7 +19,49 @@ settings_dict = {
     'exclusion_thresh': 4,       
     # FOV constant for Raspberry Pi Camera v2
     # for more info: https://www.raspberrypi.com/documentation/accessories/camera.html
-    'fov': 48.8       
+    'fov': 48.8,
+    # method used to filter out the blue of the sky: 'hsv' or 'lut' (lookup table)
+    'sky_filter': 'hsv',
+    # filter applied before thresholding: bilateral, guided, box, median, downscale or none
+    'smoothing_filter': 'bilateral',
+    # line fit for the horizon points: tls (total least squares), ransac or huber
+    'line_fit': 'tls',
+    # resolution of the first, coarse search of a coarse to fine search, e.g. (48,48), or None
+    'pyramid_resolution': 'None',
+    # 1 to only search a band around the predicted horizon while the horizon is locked, 0 to search the full frame.
+    # The band is faster, but less accurate in roll (see HorizonDetector).
+    'horizon_lock_band': 0,
+    # how the horizon points are found in the sky/ground mask: contour, scanline or hough
+    'backend': 'contour',
+    # path of an ONNX sky segmentation network (see sky_segmentation.py), or empty for the sky filter and Otsu threshold
+    'segmentation_model': '',
+    # 1 to refine the horizon points to a fraction of a pixel before the fit (see subpixel.py), 0 for whole pixels
+    'subpixel': 0,
+    # 1 to estimate the threshold of the mask incrementally from frame to frame (see otsu_threshold.py), 0 for Otsu on every frame
+    'incremental_threshold': 0,
+    # mean difference (in levels) between the thumbnails of two frames up to which a frame keeps the horizon
+    # of the previous one (see duplicate_frames.py), 0 to only skip frames the camera has repeated
+    'duplicate_frame_difference': 0.,
+    # the horizon is fully detected every this many frames and tracked with optical flow in between
+    # (see flow_tracking.py), 1 to detect it in every frame
+    'flow_tracking_interval': 1,
+    # number of tiles the full width of the frame is filtered in at the same time, one per core
+    # (see tiled_detection.py), 1 to search the center of the frame cropped to the inference resolution
+    'detection_tiles': 1,
+    # color space of the frames: bgr, or yuv to take raw YUYV frames from the camera and find the horizon
+    # in YUV without converting the frames to BGR (see yuv_frames.py). With yuv, the lut sky filter
+    # gives the same sky as hsv; the hsv filter becomes a box in U and V.
+    'color_space': 'bgr',
+    # path of a json camera calibration (see crop_and_scale.load_camera_calibration) to undistort the frames
+    # as they are cropped and scaled, or empty to not undistort them
+    'camera_calibration': '',
+    # 1 to crop and scale the frames in the capture thread, which delivers them to the main loop along with
+    # the full frames (a second stream of small frames), 0 to crop and scale them in the main loop
+    'dual_stream': 0,
+    # steps taken by the frame governor when the main loop runs long, in order (empty to turn it off)
+    'governor_ladder': 'hud_off,half_recording_fps,cheap_smoothing_filter,low_inference_resolution,alternate_frame_detection',
+    'governor_smoothing_filter': 'box',
+    'governor_inference_resolution': '(64,64)'
 }
 
 dtype_dict = {
@@ -35,7 +77,25 @@ dtype_dict = {
     'resolution': eval,
     'acceptable_variance': float,
     'exclusion_thresh': float,
-    'fov': float
+    'fov': float,
+    'sky_filter': str,
+    'smoothing_filter': str,
+    'line_fit': str,
+    'pyramid_resolution': eval,
+    'horizon_lock_band': int,
+    'backend': str,
+    'segmentation_model': str,
+    'subpixel': int,
+    'incremental_threshold': int,
+    'duplicate_frame_difference': float,
+    'flow_tracking_interval': int,
+    'detection_tiles': int,
+    'color_space': str,
+    'camera_calibration': str,
+    'dual_stream': int,
+    'governor_ladder': str,
+    'governor_smoothing_filter': str,
+    'governor_inference_resolution': eval
 }
 
 settings = Settings(path, settings_dict, dtype_dict)
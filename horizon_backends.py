@@ -0,0 +1,312 @@
+######## Backends that find the horizon points in the sky/ground mask #########
+# HorizonDetector thresholds each frame into a mask that is white in the sky and black in the ground.
+# A backend turns the mask (or the smoothed greyscale image it was thresholded from) into the points
+# of the boundary between the two, plus the points along the border of the image that tell on which side
+# the sky lies. Everything after that (edge validation, filtering against the predicted horizon,
+# the line fit, pitch and variance) is shared by all backends.
+#
+# contour: traces the outline of the largest white region with cv2.findContours (the original algorithm).
+# scanline: finds the sky/ground transition in each column, or in each row when the horizon is steep,
+#           from the number of sky pixels in each column. No contour tracing.
+# hough: finds the strongest straight edge with cv2.HoughLines and keeps the edge pixels on it.
+#        In the band around the predicted horizon only the angles that cross the band are searched,
+#        which keeps the accumulator tiny. It does not depend on the largest region of the mask,
+#        which wanders over cities and forests. In the full frame, only the angles within HOUGH_ROLL_WINDOW
+#        of the predicted roll are searched, and all angles only to acquire the horizon,
+#        which is far more expensive.
+#
+# Results on synthetic 300 frame flights (python horizon_backends.py), measured on a desktop x86 core,
+# in the full frame with the predicted horizon (horizon_lock_band off, as main.py runs by default).
+# The cluttered flight has 10 buildings and trees along the horizon (horizon_benchmark.make_flight).
+# Backend time is the backend alone on the mask of a full frame, for hough at all angles / with the predicted roll.
+# Times are the whole of find_horizon per frame.
+#
+# backend   resolution  backend time  clear: time  good   roll err  pitch err  cluttered: time  good   roll err  pitch err
+# contour   100x100      28 us              0.93 ms  100%   0.10      0.16                0.94 ms   52%   0.64      0.45
+# scanline  100x100      89 us              1.11 ms  100%   0.08      0.04                1.16 ms   90%   0.51      0.17
+# hough     100x100     572/231 us          1.15 ms  100%   0.10      0.04                1.15 ms  100%   0.26      0.07
+# contour   200x200      62 us              2.32 ms  100%   0.07      0.08                2.24 ms   67%   0.60      0.30
+# scanline  200x200     134 us              2.41 ms  100%   0.05      0.04                2.26 ms   93%   0.49      0.17
+# hough     200x200    1658/637 us          2.89 ms  100%   0.05      0.04                2.28 ms  100%   0.08      0.04
+#
+# With horizon_lock_band on, the search stays in the band around the predicted horizon whenever there is one:
+#
+# backend   resolution  clear: time  good   roll err  pitch err  cluttered: time  good   roll err  pitch err
+# contour   100x100         0.64 ms  100%   0.17      0.17                1.21 ms   55%   0.69      0.44
+# scanline  100x100         0.84 ms  100%   0.15      0.06                1.10 ms   92%   0.58      0.17
+# hough     100x100         0.81 ms  100%   0.12      0.05                0.79 ms  100%   0.28      0.08
+# contour   200x200         1.25 ms  100%   0.09      0.08                2.15 ms   71%   0.62      0.29
+# scanline  200x200         1.27 ms  100%   0.07      0.04                1.62 ms   94%   0.56      0.18
+# hough     200x200         1.34 ms  100%   0.05      0.04                1.33 ms  100%   0.09      0.05
+#
+# cv2.findContours is already very fast on the clean masks of the synthetic flight, and most of the cost
+# of scanline is the per call overhead of numpy, so on the clear flight the time of the whole of find_horizon
+# is about the same for both. scanline is more accurate in both roll and pitch: its points lie on the boundary
+# itself (moved into the coordinates of the pixel areas, see BOUNDARY_BACKENDS), while the contour
+# traces the outermost sky pixels, half a pixel inside the sky, which biases the pitch towards the sky.
+# With clutter, the contour wanders and many frames are not good. hough keeps the horizon in every frame
+# (in the band, where there are fewer angles and pixels to search, it costs about a third less), and
+# its points (the Canny edge pixels) are moved into the coordinates of the pixel areas like those of scanline.
+
+import cv2
+import numpy as np
+from functools import lru_cache
+from math import atan2, cos, sin, pi, radians
+
+# thresholds of the Canny edge detector of the hough backend, on the smoothed blue filtered greyscale image
+HOUGH_CANNY_THRESHOLDS = (50, 150)
+# angle resolution of the Hough accumulator (the distance resolution is one pixel)
+HOUGH_ANGLE_STEP = pi / 360
+# minimum number of edge pixels on the line, as a fraction of the length of the band
+HOUGH_MIN_VOTES = .2
+# edge pixels within this distance of the line (in pixels) are the horizon points
+HOUGH_LINE_DISTANCE = 1.5
+# In the full frame, with a predicted horizon, only lines within this many radians of the predicted roll are searched.
+HOUGH_ROLL_WINDOW = radians(10)
+
+def trace_largest_contour(mask: np.ndarray, greyscale: np.ndarray) -> tuple:
+    """
+    Returns the points (x, y) of the outline of the largest white region of the mask and a boolean array
+    of the points that lie on the border of the image. Returns None if the mask is all black.
+    """
+    # Find the contour of the largest region.
+    # Only the outer contours are traced (no hierarchy is built), and the largest one
+    # is found in a single pass instead of sorting all of them by area. This keeps
+    # noisy frames with hundreds of small regions (clouds, propeller, terrain) cheap.
+    # Indexing with [-2] works with both the OpenCV 3 and the OpenCV 4 return values.
+    # chain = cv2.CHAIN_APPROX_SIMPLE
+    chain = cv2.CHAIN_APPROX_NONE
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, chain)[-2]
+    if len(contours) == 0:
+        return None
+    largest_contour = max(contours, key=cv2.contourArea)
+
+    # extract x and y values from contour
+    x = largest_contour[:, 0, 0]
+    y = largest_contour[:, 0, 1]
+
+    # Separate the points that lie on the edge of the image from all other points.
+    # Edge points will be used to find sky_is_up.
+    # All other points will be used to find the horizon.
+    is_edge_point = (x == 0) | (x == mask.shape[1] - 1) | (y == 0) | (y == mask.shape[0] - 1)
+    return x, y, is_edge_point
+
+@lru_cache(maxsize=None)
+def _get_range(length: int) -> np.ndarray:
+    return np.arange(length)
+
+@lru_cache(maxsize=None)
+def _get_border(height: int, width: int) -> tuple:
+    """
+    Returns the coordinates (x, y) of the pixels along the top, bottom, left and right border of an image.
+    """
+    x = np.concatenate((np.arange(width), np.arange(width), np.zeros(height), np.full(height, width - 1)))
+    y = np.concatenate((np.zeros(width), np.full(width, height - 1), np.arange(height), np.arange(height)))
+    return x, y
+
+def _find_transitions(mask: np.ndarray, axis: int) -> tuple:
+    """
+    Finds the transition between sky and ground in each column (axis 0) or each row (axis 1) of the mask.
+    If a column is sky down to some row and ground below it, the number of sky pixels in the column
+    is the row of the transition, so it only takes a sum over each column (cv2.reduce), instead of tracing
+    or searching the boundary. Whether the sky lies above or below is told by the half of the column
+    with more sky. Columns where the pixels on either side of that row do not switch between
+    sky and ground (no horizon in the column, or too many specks) have no transition.
+    Returns the position of the transitions (the number of pixels before each one) and
+    which columns (rows) have a transition. The mask has to be contiguous.
+    """
+    length = mask.shape[axis]
+    # number of sky pixels in each column, and in the first half of each column
+    sky = cv2.reduce(mask, axis, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel() // 255
+    first_half = mask[:length // 2] if axis == 0 else mask[:, :length // 2]
+    sky_in_first_half = cv2.reduce(first_half, axis, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel() // 255
+    is_sky_first = 2 * sky_in_first_half > sky
+    positions = np.where(is_sky_first, sky, length - sky)
+
+    # check that the pixels on either side of the transition are sky and ground
+    # (positions at either end of the columns are out of range, but they do not count anyway)
+    if axis == 0:
+        index_before = (positions - 1) * mask.shape[1] + _get_range(mask.shape[1])
+        stride = mask.shape[1]
+    else:
+        index_before = _get_range(mask.shape[0]) * mask.shape[1] + positions - 1
+        stride = 1
+    is_sky_before = np.take(mask, index_before, mode='clip') > 0
+    is_sky_after = np.take(mask, index_before + stride, mode='clip') > 0
+    has_transition = (positions > 0) & (positions < length) & \
+                        (is_sky_before == is_sky_first) & (is_sky_after != is_sky_first)
+    return positions, has_transition
+
+def scan_transitions(mask: np.ndarray, greyscale: np.ndarray) -> tuple:
+    """
+    Returns the points (x, y) of the sky/ground transition in each column of the mask, or in each row
+    when more rows than columns have a transition (a steep horizon), followed by the sky pixels along
+    the border of the image, and a boolean array that tells the two apart (True for the border pixels).
+    The transitions lie half way between the last pixel of one side and the first of the other.
+    Returns None if the mask is all black.
+    """
+    height, width = mask.shape
+
+    # Scan the columns. If the horizon crosses fewer columns than there are rows,
+    # scan the rows too and keep whichever crosses the horizon more often.
+    rows, has_column_transition = _find_transitions(mask, 0)
+    x = np.flatnonzero(has_column_transition)
+    y = rows[has_column_transition] - .5
+    if x.size < height:
+        columns, has_row_transition = _find_transitions(mask, 1)
+        if np.count_nonzero(has_row_transition) > x.size:
+            y = np.flatnonzero(has_row_transition)
+            x = columns[has_row_transition] - .5
+
+    # the sky pixels along the border of the image, to tell on which side of the horizon the sky lies
+    x_border, y_border = _get_border(height, width)
+    is_sky = np.concatenate((mask[0], mask[-1], mask[:, 0], mask[:, -1])) > 0
+    x_border = x_border[is_sky]
+    y_border = y_border[is_sky]
+    if x.size == 0 and x_border.size == 0:
+        return None
+
+    is_edge_point = np.zeros(x.size + x_border.size, dtype=bool)
+    is_edge_point[x.size:] = True
+    return np.concatenate((x, x_border)), np.concatenate((y, y_border)), is_edge_point
+
+def _find_hough_points(greyscale: np.ndarray, min_theta: float, max_theta: float, min_votes: int,
+                        transpose: bool = False) -> tuple:
+    """
+    Returns the edge pixels (x, y) of the greyscale image that lie on the strongest straight edge
+    with a normal between min_theta and max_theta (radians, 0 for a vertical line), or None if no line
+    has at least min_votes edge pixels on it.
+    transpose: if True, the lines are searched in the transposed image (x and y swapped), where the normal
+    of a line at theta lies at pi/2 - theta. The range of angles cannot wrap around 0 and pi,
+    but in the transposed image a range around 0 lies around pi/2.
+    """
+    edges = cv2.Canny(greyscale, *HOUGH_CANNY_THRESHOLDS)
+    if transpose:
+        edges = cv2.transpose(edges)
+    lines = cv2.HoughLines(edges, 1, HOUGH_ANGLE_STEP, min_votes, min_theta=min_theta, max_theta=max_theta)
+    if lines is None:
+        return None
+
+    # the lines are sorted by their number of votes
+    rho, theta = lines[0, 0]
+    y_edges, x_edges = np.nonzero(edges)
+    is_on_line = np.abs(x_edges * cos(theta) + y_edges * sin(theta) - rho) <= HOUGH_LINE_DISTANCE
+    if transpose:
+        return y_edges[is_on_line], x_edges[is_on_line]
+    return x_edges[is_on_line], y_edges[is_on_line]
+
+def find_hough_line_in_band(mask: np.ndarray, greyscale: np.ndarray) -> tuple:
+    """
+    For a band around the predicted horizon, as built by HorizonDetector: the predicted horizon
+    runs along the middle row of the band, with the sky above it.
+    Returns the edge pixels (x, y) on the strongest straight edge of the greyscale image that crosses
+    the band from one end to the other, followed by the pixels of the top row of the band to tell on which
+    side the sky lies, and a boolean array that tells the two apart (True for the top row).
+    Returns None if there is no such edge.
+    """
+    height, width = greyscale.shape
+    # Only lines that cross the band end to end are possible, which limits the angles to a few degrees
+    # either side of the predicted horizon and keeps the accumulator small.
+    max_angle = atan2(height, width)
+    points = _find_hough_points(greyscale, pi/2 - max_angle, pi/2 + max_angle, int(HOUGH_MIN_VOTES * width))
+    if points is None:
+        return None
+    x, y = points
+
+    # the sky lies above the predicted horizon, and the line is within the band
+    is_edge_point = np.zeros(x.size + width, dtype=bool)
+    is_edge_point[x.size:] = True
+    return np.concatenate((x, _get_range(width))), np.concatenate((y, np.zeros(width))), is_edge_point
+
+def find_hough_line(mask: np.ndarray, greyscale: np.ndarray, roll: float = None) -> tuple:
+    """
+    For a full frame. Like find_hough_line_in_band, but with the sky pixels of the mask along the border
+    of the image to tell on which side the sky lies, and at any angle, unless roll is given.
+    roll: the roll of the predicted horizon in degrees, to only search lines within HOUGH_ROLL_WINDOW of it,
+    which keeps the accumulator small. If there is no such line, all angles are searched.
+    """
+    height, width = greyscale.shape
+    min_votes = int(HOUGH_MIN_VOTES * min(height, width))
+    points = None
+    if roll is not None:
+        # the normal of a horizon at roll points at roll + 90 degrees (see HorizonDetector._get_reference_point)
+        theta = (radians(roll) + pi / 2) % pi
+        # a range that wraps around 0 and pi is searched in the transposed image, where it lies around pi/2
+        transpose = theta < HOUGH_ROLL_WINDOW or theta > pi - HOUGH_ROLL_WINDOW
+        if transpose:
+            theta = (pi / 2 - theta) % pi
+        points = _find_hough_points(greyscale, theta - HOUGH_ROLL_WINDOW, theta + HOUGH_ROLL_WINDOW, min_votes, transpose)
+    if points is None:
+        points = _find_hough_points(greyscale, 0, pi, min_votes)
+    x_border, y_border = _get_border(height, width)
+    is_sky = np.concatenate((mask[0], mask[-1], mask[:, 0], mask[:, -1])) > 0
+    if points is None or not is_sky.any():
+        return None
+    x, y = points
+
+    is_edge_point = np.zeros(x.size + np.count_nonzero(is_sky), dtype=bool)
+    is_edge_point[x.size:] = True
+    return np.concatenate((x, x_border[is_sky])), np.concatenate((y, y_border[is_sky])), is_edge_point
+
+# the backends that can be selected with the backend setting, for the band around the predicted horizon
+BACKENDS = {
+    'contour': trace_largest_contour,
+    'scanline': scan_transitions,
+    'hough': find_hough_line_in_band
+}
+# the backends for the full frame, where they differ
+FULL_FRAME_BACKENDS = {
+    'hough': find_hough_line
+}
+# the backends for the full frame that also take the roll of the predicted horizon, when there is one
+PREDICTED_ROLL_BACKENDS = {'hough'}
+# The backends whose points lie on the boundary between sky and ground (the transitions, or the edge pixels),
+# in the coordinates of the pixel centers (pixel n at n). HorizonDetector moves them to the coordinates
+# of the pixel areas, as it does the refined points of subpixel.py. The contour traces the centers of
+# the outermost sky pixels instead, which lie half a pixel inside the sky.
+BOUNDARY_BACKENDS = {'scanline', 'hough'}
+
+if __name__ == "__main__":
+    from timeit import default_timer as timer
+    from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale
+    from find_horizon import HorizonDetector
+    from horizon_benchmark import make_flight, run_benchmark, print_stats
+
+    ITERATIONS = 20
+
+    print('Rendering synthetic flights...')
+    flights = {'clear': make_flight(), 'cluttered': make_flight(clutter=10)}
+    for inference_resolution in [(100, 100), (200, 200)]:
+        # collect the masks and smoothed images of the full frames of the clear flight
+        frames = flights['clear'][0]
+        crop_and_scale_parameters = get_cropping_and_scaling_parameters(frames[0].shape[1::-1], inference_resolution)
+        horizon_detector = HorizonDetector(4, 48.8, 1.3, inference_resolution, horizon_lock_band=False)
+        images = []
+        for frame in frames:
+            frame = crop_and_scale(frame, **crop_and_scale_parameters)
+            points = horizon_detector._find_points(frame, horizon_detector.buffers, frame.shape, {})
+            images.append((points['mask'].copy(), horizon_detector.buffers.blur.copy()))
+
+        for backend in BACKENDS:
+            # time the backend on its own, on the full frames
+            find_boundary = FULL_FRAME_BACKENDS.get(backend, BACKENDS[backend])
+            t1 = timer()
+            for n in range(ITERATIONS):
+                for mask, greyscale in images:
+                    find_boundary(mask, greyscale)
+            backend_time = (timer() - t1) / ITERATIONS / len(images) * 1e6
+            if backend in PREDICTED_ROLL_BACKENDS:
+                # and with the roll of the horizon as the prediction
+                rolls = flights['clear'][1]
+                t1 = timer()
+                for n in range(ITERATIONS):
+                    for (mask, greyscale), roll in zip(images, rolls):
+                        find_boundary(mask, greyscale, roll)
+                predicted_time = (timer() - t1) / ITERATIONS / len(images) * 1e6
+                print(f'{backend} {inference_resolution} with the predicted roll: {predicted_time:.0f} us')
+            for flight_name, (frames, rolls, pitches) in flights.items():
+                for horizon_lock_band in [True, False]:
+                    stats = run_benchmark(frames, rolls, pitches, inference_resolution, backend=backend,
+                                            horizon_lock_band=horizon_lock_band)
+                    band = 'band' if horizon_lock_band else 'full'
+                    print_stats(f'{backend} {inference_resolution} {flight_name} {band} ({backend_time:.0f} us)', stats)
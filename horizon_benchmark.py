@@ -0,0 +1,157 @@
+# standard libraries
+import cv2
+import numpy as np
+from math import cos, sin, pi, radians
+from timeit import default_timer as timer
+
+# my libraries
+from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale, CropScaler
+from find_horizon import HorizonDetector
+
+# defaults for the synthetic flight
+RESOLUTION = (640, 480)
+INFERENCE_RESOLUTION = (100, 100)
+FOV = 48.8
+EXCLUSION_THRESH = 4
+ACCEPTABLE_VARIANCE = 1.3
+SKY_COLOR = (230, 170, 120) # BGR
+GROUND_COLOR = (60, 100, 70) # BGR
+
+def make_frame(roll: float, pitch: float, fov: float = FOV, resolution: tuple = RESOLUTION,
+                rng: np.random.Generator = None, clutter: int = 0) -> np.ndarray:
+    """
+    Renders a frame with a known horizon, using the same roll and pitch conventions
+    as HorizonDetector and draw_horizon: a textured ground, a sky with a few clouds and some sensor noise.
+    clutter: number of buildings and trees along the horizon, like the skyline of a city or a forest.
+    Light roofs below the horizon look like sky and dark trees above it look like ground.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    width, height = resolution
+
+    # signed distance of every pixel from the horizon, negative in the sky
+    roll_radians = radians(roll)
+    distance = pitch / fov * height
+    angle_perp = roll_radians + pi / 2
+    x_perp = distance * cos(angle_perp) + width/2
+    y_perp = distance * sin(angle_perp) + height/2
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    signed_distance = (y - y_perp) * cos(roll_radians) - (x - x_perp) * sin(roll_radians)
+    is_sky = signed_distance < 0
+
+    # low frequency texture for the ground, lighter towards the horizon for the sky
+    texture = cv2.resize(rng.normal(0, 25, (height//16, width//16)).astype(np.float32), resolution)
+    frame = np.empty((height, width, 3), dtype=np.float32)
+    for channel in range(3):
+        ground = GROUND_COLOR[channel] + texture
+        sky = SKY_COLOR[channel] + np.minimum(-signed_distance, height) * .05
+        frame[:, :, channel] = np.where(is_sky, sky, ground)
+
+    # a few clouds in the sky
+    for _ in range(rng.integers(0, 4)):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        if not is_sky[center[1], center[0]]:
+            continue
+        axes = (int(rng.integers(10, 60)), int(rng.integers(5, 20)))
+        cv2.ellipse(frame, center, axes, 0, 0, 360, (245, 245, 245), -1)
+
+    # buildings and trees, as rectangles along the horizon
+    if clutter:
+        along_horizon = (x - x_perp) * cos(roll_radians) + (y - y_perp) * sin(roll_radians)
+        for _ in range(clutter):
+            start = rng.uniform(-width/2, width/2)
+            size = rng.uniform(5, 40)
+            if rng.random() < .5:
+                # a light roof just below the horizon
+                depth = rng.uniform(2, 30)
+                top = rng.uniform(0, 10)
+                color = (235, 225, 215)
+            else:
+                # a tree or a dark building reaching above the horizon
+                depth = rng.uniform(5, 25)
+                top = -depth
+                color = (40, 60, 45)
+            is_object = (along_horizon >= start) & (along_horizon < start + size) & \
+                        (signed_distance >= top) & (signed_distance < top + depth)
+            frame[is_object] = color
+
+    frame += rng.normal(0, 6, frame.shape).astype(np.float32)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+def make_flight(number_of_frames: int = 300, fov: float = FOV, resolution: tuple = RESOLUTION, seed: int = 0,
+                clutter: int = 0) -> tuple:
+    """
+    Renders a sequence of frames along a smooth random flight path.
+    clutter: number of buildings and trees along the horizon in each frame (see make_frame).
+    Returns the frames and the true roll and pitch of every frame.
+    """
+    rng = np.random.default_rng(seed)
+    roll_rate, pitch_rate = 0, 0
+    roll, pitch = rng.uniform(0, 360), rng.uniform(-5, 5)
+    frames, rolls, pitches = [], [], []
+    for _ in range(number_of_frames):
+        roll_rate = .9 * roll_rate + rng.normal(0, 1)
+        pitch_rate = .9 * pitch_rate + rng.normal(0, .2)
+        roll = (roll + roll_rate) % 360
+        pitch = np.clip(pitch + pitch_rate, -15, 15)
+        frames.append(make_frame(roll, pitch, fov, resolution, rng, clutter))
+        rolls.append(roll)
+        pitches.append(pitch)
+    return frames, np.array(rolls), np.array(pitches)
+
+def run_benchmark(frames: list, rolls: np.ndarray, pitches: np.ndarray, inference_resolution: tuple = INFERENCE_RESOLUTION,
+                    fov: float = FOV, calibration: dict = None, **detector_options) -> dict:
+    """
+    Runs a HorizonDetector over the frames and compares the results to the true roll and pitch.
+    calibration: if given, the frames are undistorted with this camera calibration (see crop_and_scale.CropScaler)
+    detector_options: keyword arguments for HorizonDetector, e.g. smoothing_filter
+    Returns the time per frame in milliseconds, the fraction of frames with a good horizon
+    and the mean and maximum roll and pitch errors in degrees (over the frames with a good horizon).
+    """
+    resolution = frames[0].shape[1::-1]
+    crop_and_scale_parameters = get_cropping_and_scaling_parameters(resolution, inference_resolution)
+    if calibration is None:
+        small_frames = [crop_and_scale(frame, **crop_and_scale_parameters) for frame in frames]
+    else:
+        crop_scaler = CropScaler(resolution, inference_resolution, calibration)
+        small_frames = [crop_scaler.crop_and_scale(frame).copy() for frame in frames]
+    horizon_detector = HorizonDetector(EXCLUSION_THRESH, fov, ACCEPTABLE_VARIANCE, inference_resolution, **detector_options)
+
+    detected_rolls = np.full(len(frames), np.nan)
+    detected_pitches = np.full(len(frames), np.nan)
+    elapsed_time = 0
+    for n, frame in enumerate(small_frames):
+        t1 = timer()
+        result = horizon_detector.find_horizon(frame)
+        elapsed_time += timer() - t1
+        if result.is_good_horizon:
+            detected_rolls[n] = result.roll
+            detected_pitches[n] = result.pitch
+
+    is_good = ~np.isnan(detected_rolls)
+    roll_errors = np.abs((detected_rolls[is_good] - rolls[is_good] + 180) % 360 - 180)
+    pitch_errors = np.abs(detected_pitches[is_good] - pitches[is_good])
+
+    stats = {}
+    stats['ms_per_frame'] = elapsed_time / len(frames) * 1000
+    stats['good_horizon_rate'] = np.mean(is_good)
+    stats['mean_roll_error'] = np.mean(roll_errors) if roll_errors.size else np.nan
+    stats['max_roll_error'] = np.max(roll_errors) if roll_errors.size else np.nan
+    stats['mean_pitch_error'] = np.mean(pitch_errors) if pitch_errors.size else np.nan
+    stats['max_pitch_error'] = np.max(pitch_errors) if pitch_errors.size else np.nan
+    return stats
+
+def print_stats(name: str, stats: dict):
+    """
+    Prints the output of run_benchmark as one row of a table.
+    """
+    print(f"{name:<28} {stats['ms_per_frame']:>6.2f} ms  good: {stats['good_horizon_rate']:>5.1%}  "\
+            f"roll err: {stats['mean_roll_error']:.2f} (max {stats['max_roll_error']:.2f})  "\
+            f"pitch err: {stats['mean_pitch_error']:.2f} (max {stats['max_pitch_error']:.2f})")
+
+if __name__ == "__main__":
+    print('Rendering synthetic flight...')
+    frames, rolls, pitches = make_flight()
+    for inference_resolution in [(100, 100), (200, 200)]:
+        stats = run_benchmark(frames, rolls, pitches, inference_resolution)
+        print_stats(f'default {inference_resolution}', stats)
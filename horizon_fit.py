@@ -0,0 +1,118 @@
+######## Line fitting for the horizon #########
+# The horizon is described by its angle and its offset (normal form) instead of y = mx + b,
+# so that steep and vertical horizons (roll near 90 or 270 degrees) are no special case.
+# A point (x, y) lies on the line when -sin(angle) * x + cos(angle) * y = offset.
+
+import numpy as np
+from math import atan2, cos, sin
+
+# number of candidate lines tried by the ransac fit
+RANSAC_ITERATIONS = 32
+# number of reweighting iterations of the huber fit
+HUBER_ITERATIONS = 3
+
+class LineFit:
+    """
+    The result of fit_line.
+    angle: direction of the line in radians, in the range (-pi/2, pi/2]
+    offset: signed distance of the line from the origin along its normal (-sin(angle), cos(angle))
+    residuals: signed distance of every point from the line
+    inliers: boolean array of the points that were used for the final fit
+    mean_distance: mean absolute residual of the inliers
+    """
+    __slots__ = ('angle', 'offset', 'residuals', 'inliers', 'mean_distance')
+
+    def __init__(self, angle: float, offset: float, residuals: np.ndarray, inliers: np.ndarray):
+        self.angle = angle
+        self.offset = offset
+        self.residuals = residuals
+        self.inliers = inliers
+        self.mean_distance = np.mean(np.abs(residuals[inliers]))
+
+    def signed_distance(self, x, y):
+        """
+        Signed distance of the point(s) from the line, positive on the side the normal points to.
+        """
+        return -sin(self.angle) * x + cos(self.angle) * y - self.offset
+
+def fit_line(x: np.ndarray, y: np.ndarray, method: str = 'tls', inlier_threshold: float = 2) -> LineFit:
+    """
+    Fits a line to the points (x, y).
+    method: 'tls' for a closed form total least squares fit (perpendicular distances),
+    'ransac' to fit only the largest set of points that agree on a line,
+    'huber' to reduce the weight of points far from the line.
+    inlier_threshold: distance in pixels beyond which a point counts as an outlier
+    for the ransac and huber fits
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if method == 'ransac':
+        inliers = _ransac_inliers(x, y, inlier_threshold)
+        angle, offset = _total_least_squares(x[inliers], y[inliers])
+    elif method == 'huber':
+        weights = np.ones_like(x)
+        for _ in range(HUBER_ITERATIONS):
+            angle, offset = _total_least_squares(x, y, weights)
+            distances = np.abs(-sin(angle) * x + cos(angle) * y - offset)
+            np.minimum(1, inlier_threshold / np.maximum(distances, 1e-9), out=weights)
+        inliers = np.ones(x.shape, dtype=bool)
+    else:
+        angle, offset = _total_least_squares(x, y)
+        inliers = np.ones(x.shape, dtype=bool)
+
+    residuals = -sin(angle) * x + cos(angle) * y - offset
+    return LineFit(angle, offset, residuals, inliers)
+
+def _total_least_squares(x: np.ndarray, y: np.ndarray, weights: np.ndarray = None) -> tuple:
+    """
+    Closed form (weighted) total least squares fit.
+    The line runs through the centroid of the points, along the major axis of their covariance.
+    """
+    if weights is None:
+        mean_x = np.mean(x)
+        mean_y = np.mean(y)
+        dx = x - mean_x
+        dy = y - mean_y
+        sxx = np.dot(dx, dx)
+        syy = np.dot(dy, dy)
+        sxy = np.dot(dx, dy)
+    else:
+        total_weight = np.sum(weights)
+        mean_x = np.dot(weights, x) / total_weight
+        mean_y = np.dot(weights, y) / total_weight
+        dx = x - mean_x
+        dy = y - mean_y
+        sxx = np.dot(weights * dx, dx)
+        syy = np.dot(weights * dy, dy)
+        sxy = np.dot(weights * dx, dy)
+
+    angle = .5 * atan2(2 * sxy, sxx - syy)
+    offset = -sin(angle) * mean_x + cos(angle) * mean_y
+    return angle, offset
+
+def _ransac_inliers(x: np.ndarray, y: np.ndarray, inlier_threshold: float) -> np.ndarray:
+    """
+    Tries RANSAC_ITERATIONS lines through pairs of points, all at once,
+    and returns the inliers of the line that has the most of them.
+    The pairs are drawn with a fixed seed, so the result is repeatable.
+    """
+    rng = np.random.default_rng(0)
+    first = rng.integers(0, x.size, RANSAC_ITERATIONS)
+    second = rng.integers(0, x.size, RANSAC_ITERATIONS)
+
+    # normal of the line through each pair of points
+    normal_x = y[first] - y[second]
+    normal_y = x[second] - x[first]
+    length = np.hypot(normal_x, normal_y)
+    is_valid_pair = length > 0 # a pair of identical points does not define a line
+    length[~is_valid_pair] = 1
+    normal_x /= length
+    normal_y /= length
+    offsets = normal_x * x[first] + normal_y * y[first]
+
+    # distance of every point from every candidate line
+    distances = np.abs(np.outer(normal_x, x) + np.outer(normal_y, y) - offsets[:, np.newaxis])
+    is_inlier = distances < inlier_threshold
+    is_inlier &= is_valid_pair[:, np.newaxis]
+    best = np.argmax(np.count_nonzero(is_inlier, axis=1))
+    return is_inlier[best]
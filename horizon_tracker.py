@@ -0,0 +1,152 @@
+######## Tracking of the horizon from frame to frame #########
+# A constant velocity Kalman filter over roll, pitch and their rates (in degrees and degrees per frame).
+# It predicts where the horizon will be in the next frame and how uncertain that prediction is,
+# which HorizonDetector uses to size the band it searches for the horizon.
+# The filter keeps predicting (coasting) through short dropouts and only lets go
+# of the horizon after MAX_MISSED_FRAMES frames in a row without a usable horizon.
+
+import numpy as np
+
+FULL_ROTATION = 360
+# standard deviation of the change in roll and pitch rate from one frame to the next (degrees per frame^2)
+ROLL_ACCELERATION_STD = 1.
+PITCH_ACCELERATION_STD = .3
+# standard deviation of the roll and pitch found by HorizonDetector (degrees)
+ROLL_MEASUREMENT_STD = .3
+PITCH_MEASUREMENT_STD = .3
+# standard deviation of the rates when a new horizon is acquired (degrees per frame)
+INITIAL_RATE_STD = 5.
+# number of frames in a row without a usable horizon before the horizon is lost
+MAX_MISSED_FRAMES = 5
+# Horizons further from the prediction than this (squared Mahalanobis distance) are
+# treated as missed frames. 99.9% of correct horizons fall within it (chi-squared, 2 degrees of freedom).
+GATE = 13.8
+# The state is rounded to this many decimals after every frame, so that two trackers
+# that have seen the same recent horizons end up in exactly the same state
+# (see parallel_detection.py). This is far below the precision of the detector.
+STATE_DECIMALS = 4
+
+# the state is [roll, roll rate, pitch, pitch rate]
+TRANSITION = np.array([[1., 1., 0., 0.],
+                       [0., 1., 0., 0.],
+                       [0., 0., 1., 1.],
+                       [0., 0., 0., 1.]])
+MEASUREMENT = np.array([[1., 0., 0., 0.],
+                        [0., 0., 1., 0.]])
+
+def _process_noise(roll_acceleration_std: float, pitch_acceleration_std: float) -> np.ndarray:
+    """
+    Process noise of a constant velocity model driven by a random acceleration,
+    for a time step of one frame.
+    """
+    block = np.array([[.25, .5],
+                      [.5, 1.]])
+    process_noise = np.zeros((4, 4))
+    process_noise[:2, :2] = block * roll_acceleration_std ** 2
+    process_noise[2:, 2:] = block * pitch_acceleration_std ** 2
+    return process_noise
+
+class HorizonTracker:
+    """
+    Predicts the roll and pitch of the next frame from the horizons found so far.
+    predicted_roll and predicted_pitch are None while there is no horizon to track.
+    """
+    def __init__(self, roll_acceleration_std: float = ROLL_ACCELERATION_STD,
+                    pitch_acceleration_std: float = PITCH_ACCELERATION_STD,
+                    roll_measurement_std: float = ROLL_MEASUREMENT_STD,
+                    pitch_measurement_std: float = PITCH_MEASUREMENT_STD,
+                    max_missed_frames: int = MAX_MISSED_FRAMES):
+        self.process_noise = _process_noise(roll_acceleration_std, pitch_acceleration_std)
+        self.measurement_noise = np.diag([roll_measurement_std ** 2, pitch_measurement_std ** 2])
+        self.max_missed_frames = max_missed_frames
+
+        # the predicted state for the next frame and its covariance
+        self.state = None
+        self.covariance = None
+        self.missed_frames = 0
+
+    @property
+    def predicted_roll(self):
+        return None if self.state is None else self.state[0]
+
+    @property
+    def predicted_pitch(self):
+        return None if self.state is None else self.state[2]
+
+    def get_uncertainty(self) -> tuple:
+        """
+        Returns the standard deviation of the roll and pitch that the detector is expected
+        to find in the next frame, i.e. the uncertainty of the prediction plus the measurement noise.
+        """
+        innovation_covariance = MEASUREMENT @ self.covariance @ MEASUREMENT.T + self.measurement_noise
+        return np.sqrt(innovation_covariance[0, 0]), np.sqrt(innovation_covariance[1, 1])
+
+    def update(self, roll: float = None, pitch: float = None, is_good_horizon: bool = None):
+        """
+        Corrects the prediction with the horizon found in the current frame (if it is good)
+        and predicts the horizon of the next frame.
+        """
+        if not is_good_horizon:
+            roll = None
+
+        if self.state is None:
+            # acquire a new horizon
+            if roll is None:
+                return
+            self.state = np.array([roll, 0., pitch, 0.])
+            self.covariance = np.diag([self.measurement_noise[0, 0], INITIAL_RATE_STD ** 2,
+                                        self.measurement_noise[1, 1], INITIAL_RATE_STD ** 2])
+            self.missed_frames = 0
+        else:
+            if roll is not None:
+                # the difference in roll is taken the short way around the circle
+                innovation = np.array([(roll - self.state[0] + FULL_ROTATION/2) % FULL_ROTATION - FULL_ROTATION/2,
+                                        pitch - self.state[2]])
+                innovation_covariance = MEASUREMENT @ self.covariance @ MEASUREMENT.T + self.measurement_noise
+                inverse_innovation_covariance = np.linalg.inv(innovation_covariance)
+                if innovation @ inverse_innovation_covariance @ innovation > GATE:
+                    roll = None
+            if roll is None:
+                # coast on the prediction, or let go of the horizon if it has been missing for too long
+                self.missed_frames += 1
+                if self.missed_frames > self.max_missed_frames:
+                    self.reset()
+                    return
+            else:
+                gain = self.covariance @ MEASUREMENT.T @ inverse_innovation_covariance
+                self.state = self.state + gain @ innovation
+                self.covariance = (np.eye(4) - gain @ MEASUREMENT) @ self.covariance
+                self.missed_frames = 0
+
+        # predict the next frame
+        self.state = np.round(TRANSITION @ self.state, STATE_DECIMALS)
+        self.state[0] %= FULL_ROTATION
+        self.covariance = TRANSITION @ self.covariance @ TRANSITION.T + self.process_noise
+        self.covariance = np.round(self.covariance, STATE_DECIMALS)
+
+    def reset(self):
+        """
+        Lets go of the horizon.
+        """
+        self.state = None
+        self.covariance = None
+        self.missed_frames = 0
+
+    def get_state(self) -> dict:
+        """
+        Returns the state of the tracker as a dictionary of plain python values
+        that can be pickled or saved as json.
+        """
+        state = {}
+        state['state'] = None if self.state is None else self.state.tolist()
+        state['covariance'] = None if self.covariance is None else self.covariance.tolist()
+        state['missed_frames'] = self.missed_frames
+        return state
+
+    def set_state(self, state: dict):
+        """
+        Restores a state obtained by get_state.
+        """
+        self.state = None if state['state'] is None else np.array(state['state'])
+        self.covariance = None if state['covariance'] is None else np.array(state['covariance'])
+        self.missed_frames = state['missed_frames']
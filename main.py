@@ -13,9 +13,15 @@ from datetime import datetime
 # my libraries
 from video_classes import CustomVideoCapture, CustomVideoWriter
 import global_variables as gv
-from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale
+from crop_and_scale import load_camera_calibration, CropScaler
+from tiled_detection import get_full_width_resolution
+from yuv_frames import bgr_to_yuv, yuyv_to_bgr
 from find_horizon import HorizonDetector
+from frame_governor import FrameGovernor, HUD_OFF, HALF_RECORDING_FPS, CHEAP_SMOOTHING_FILTER, \
+                            LOW_INFERENCE_RESOLUTION, ALTERNATE_FRAME_DETECTION
 from draw_display import draw_horizon, draw_hud, draw_roi
+from duplicate_frames import DuplicateFrameFilter, REPEAT, UNCHANGED
+from diagnostics import DiagnosticsDisplay
 from disable_wifi_and_bluetooth import disable_wifi_and_bluetooth
 from flight_controller import FlightController
 from global_variables import settings
@@ -42,6 +48,60 @@ def main():
     # contour points will be filtered out.
     EXCLUSION_THRESH = settings.get_value('exclusion_thresh')
     FOV = settings.get_value('fov')
+    # SKY_FILTER is the method used to filter out the blue of the sky, either 'hsv' or 'lut'
+    SKY_FILTER = settings.get_value('sky_filter')
+    # SMOOTHING_FILTER is the filter applied before the image is thresholded into sky and ground,
+    # see smoothing_filters.py for the options and how they compare
+    SMOOTHING_FILTER = settings.get_value('smoothing_filter')
+    # LINE_FIT is how the line is fitted to the horizon points: 'tls', 'ransac' or 'huber'
+    LINE_FIT = settings.get_value('line_fit')
+    # PYRAMID_RESOLUTION, if not None, is the resolution at which a frame is searched first
+    # when the horizon is not locked, before the horizon is refined at INFERENCE_RESOLUTION
+    PYRAMID_RESOLUTION = settings.get_value('pyramid_resolution')
+    # HORIZON_LOCK_BAND is True if only a band around the predicted horizon is searched
+    # while the horizon is locked, instead of the full frame
+    HORIZON_LOCK_BAND = bool(settings.get_value('horizon_lock_band'))
+    # BACKEND is how the horizon points are found in the sky/ground mask: 'contour', 'scanline' or 'hough'
+    # (see horizon_backends.py)
+    BACKEND = settings.get_value('backend')
+    # SEGMENTATION_MODEL, if set, is the path of the ONNX network that segments the sky
+    # in place of the sky filter and Otsu threshold (see sky_segmentation.py)
+    SEGMENTATION_MODEL = settings.get_value('segmentation_model') or None
+    # SUBPIXEL is True if the horizon points are refined to a fraction of a pixel before the fit,
+    # which keeps the accuracy at a lower INFERENCE_RESOLUTION (see subpixel.py)
+    SUBPIXEL = bool(settings.get_value('subpixel'))
+    # INCREMENTAL_THRESHOLD is True if the threshold of the mask is carried from frame to frame
+    # instead of searched from scratch on every frame (see otsu_threshold.py)
+    INCREMENTAL_THRESHOLD = bool(settings.get_value('incremental_threshold'))
+    # DUPLICATE_FRAME_DIFFERENCE is the mean difference between the thumbnails of two frames (in levels)
+    # up to which a new frame counts as unchanged and keeps the horizon of the previous frame.
+    # Repeated frames (the camera has not delivered a new one) are always skipped. See duplicate_frames.py.
+    DUPLICATE_FRAME_DIFFERENCE = settings.get_value('duplicate_frame_difference')
+    # FLOW_TRACKING_INTERVAL: the horizon is fully detected every this many frames, and tracked
+    # with optical flow in the frames in between (see flow_tracking.py). 1 to detect it in every frame.
+    FLOW_TRACKING_INTERVAL = settings.get_value('flow_tracking_interval')
+    # DETECTION_TILES: if more than 1, the full width of the frame is searched instead of its center,
+    # and filtered in this many tiles at the same time on a thread pool (see tiled_detection.py)
+    DETECTION_TILES = settings.get_value('detection_tiles')
+    # COLOR_SPACE is 'yuv' to take raw YUYV frames from the camera and find the horizon in YUV,
+    # converting the frames to BGR only for the display and the recording (see yuv_frames.py), or 'bgr'
+    COLOR_SPACE = settings.get_value('color_space')
+    # CAMERA_CALIBRATION is the camera calibration from the json file of the camera_calibration setting,
+    # with which the frames are undistorted as they are cropped and scaled (see crop_and_scale.CropScaler),
+    # or None to not undistort them
+    CAMERA_CALIBRATION = settings.get_value('camera_calibration')
+    CAMERA_CALIBRATION = load_camera_calibration(CAMERA_CALIBRATION) if CAMERA_CALIBRATION else None
+    # DUAL_STREAM is True if the frames are cropped and scaled in the capture thread, so that the main loop gets
+    # a small frame for the HorizonDetector along with the full frame for the display and the recording
+    # (see CustomVideoCapture.set_crop_scaler)
+    DUAL_STREAM = bool(settings.get_value('dual_stream'))
+    # GOVERNOR_LADDER is the comma separated list of steps the frame governor takes, in order,
+    # when the main loop cannot keep up with FPS (see frame_governor.py). Leave empty to turn it off.
+    GOVERNOR_LADDER = tuple(step.strip() for step in settings.get_value('governor_ladder').split(',') if step.strip())
+    # the smoothing filter and inference resolution used by the cheap_smoothing_filter
+    # and low_inference_resolution steps of the governor
+    GOVERNOR_SMOOTHING_FILTER = settings.get_value('governor_smoothing_filter')
+    GOVERNOR_INFERENCE_RESOLUTION = settings.get_value('governor_inference_resolution')
     OPERATING_SYSTEM = platform.system()
 
     # Validate inference_resolution
@@ -62,6 +122,11 @@ def main():
         inference_width = int(np.round(INFERENCE_RESOLUTION[1] * aspect_ratio))
         INFERENCE_RESOLUTION = (inference_width, inference_height)
         print(f'The inference resolution has been adjusted to: {INFERENCE_RESOLUTION}')
+    # with tiles, widen the inference resolutions to the full width of the frame
+    if DETECTION_TILES > 1:
+        INFERENCE_RESOLUTION = get_full_width_resolution(RESOLUTION, INFERENCE_RESOLUTION)
+        GOVERNOR_INFERENCE_RESOLUTION = get_full_width_resolution(RESOLUTION, GOVERNOR_INFERENCE_RESOLUTION)
+        print(f'Searching the full width of the frame in {DETECTION_TILES} tiles at {INFERENCE_RESOLUTION}.')
 
     # global variables
     actual_fps = 0
@@ -73,6 +138,37 @@ def main():
         render_image = True
 
     # functions
+    def make_horizon_detector(inference_resolution: tuple, smoothing_filter: str) -> HorizonDetector:
+        """
+        Defines a HorizonDetector for the given inference resolution and smoothing filter.
+        """
+        # the pyramid search only makes sense if it starts below the inference resolution
+        if PYRAMID_RESOLUTION is not None and PYRAMID_RESOLUTION[1] < inference_resolution[1]:
+            pyramid_resolution = PYRAMID_RESOLUTION
+        else:
+            pyramid_resolution = None
+        return HorizonDetector(EXCLUSION_THRESH, FOV, ACCEPTABLE_VARIANCE, inference_resolution,
+                                horizon_lock_band=HORIZON_LOCK_BAND, sky_filter=SKY_FILTER, smoothing_filter=smoothing_filter, line_fit=LINE_FIT,
+                                pyramid_resolution=pyramid_resolution, backend=BACKEND,
+                                segmentation_model=SEGMENTATION_MODEL, subpixel=SUBPIXEL,
+                                incremental_threshold=INCREMENTAL_THRESHOLD, flow_tracking_interval=FLOW_TRACKING_INTERVAL,
+                                tiles=DETECTION_TILES, color_space=COLOR_SPACE)
+
+    def crop_and_scale_frame(frame: np.ndarray, small_frame: np.ndarray = None) -> np.ndarray:
+        """
+        Crops and scales the frame to the inference resolution, in the color space of the HorizonDetector.
+        small_frame: the frame already cropped and scaled by the capture thread, if there is a second stream
+        """
+        # A small frame of the previous inference resolution (just after the governor changed it) is redone.
+        if small_frame is not None and small_frame.shape == crop_scaler.output.shape:
+            scaled_and_cropped_frame = small_frame
+        else:
+            scaled_and_cropped_frame = crop_scaler.crop_and_scale(frame)
+        # e.g. a video file, or a camera without YUYV
+        if COLOR_SPACE == 'yuv' and not video_capture.is_yuyv:
+            return bgr_to_yuv(scaled_and_cropped_frame)
+        return scaled_and_cropped_frame
+
     def finish_recording():
         """
         Finishes up the recording and saves the diagnostic data file.
@@ -89,6 +185,26 @@ def main():
         metadata['acceptable_variance'] = ACCEPTABLE_VARIANCE
         metadata['exclusion_thresh'] = EXCLUSION_THRESH
         metadata['fov'] = FOV
+        metadata['sky_filter'] = SKY_FILTER
+        metadata['smoothing_filter'] = SMOOTHING_FILTER
+        metadata['line_fit'] = LINE_FIT
+        metadata['pyramid_resolution'] = PYRAMID_RESOLUTION
+        metadata['horizon_lock_band'] = HORIZON_LOCK_BAND
+        metadata['backend'] = BACKEND
+        metadata['segmentation_model'] = SEGMENTATION_MODEL
+        metadata['subpixel'] = SUBPIXEL
+        metadata['incremental_threshold'] = INCREMENTAL_THRESHOLD
+        metadata['duplicate_frame_difference'] = DUPLICATE_FRAME_DIFFERENCE
+        metadata['flow_tracking_interval'] = FLOW_TRACKING_INTERVAL
+        metadata['detection_tiles'] = DETECTION_TILES
+        metadata['color_space'] = COLOR_SPACE
+        metadata['dual_stream'] = DUAL_STREAM
+        if CAMERA_CALIBRATION is not None:
+            # the calibration itself, since the file may not be there when the recording is replayed
+            metadata['camera_calibration'] = {key: np.asarray(value).tolist() for key, value in CAMERA_CALIBRATION.items()}
+        metadata['governor_ladder'] = GOVERNOR_LADDER
+        metadata['governor_smoothing_filter'] = GOVERNOR_SMOOTHING_FILTER
+        metadata['governor_inference_resolution'] = GOVERNOR_INFERENCE_RESOLUTION
 
         # wait for video_writer to finish recording      
         while video_writer.run:
@@ -125,17 +241,31 @@ def main():
     cv2.imshow("Real-time Display", paused_frame)
 
     # define VideoCapture
-    video_capture = CustomVideoCapture(RESOLUTION, SOURCE)
+    video_capture = CustomVideoCapture(RESOLUTION, SOURCE, yuv=COLOR_SPACE == 'yuv')
 
     # start VideoStreamer
     video_capture.start_stream()
     sleep(1)
 
-    # get some parameters for cropping and scaling
-    crop_and_scale_parameters = get_cropping_and_scaling_parameters(video_capture.resolution, INFERENCE_RESOLUTION)
+    # crops, undistorts and scales the frames, and keeps the parameters for cropping and scaling for draw_roi
+    crop_scaler = CropScaler(video_capture.resolution, INFERENCE_RESOLUTION, CAMERA_CALIBRATION, yuyv=video_capture.is_yuyv)
+    crop_and_scale_parameters = crop_scaler.parameters
+    # the second stream gets a CropScaler of its own, since the capture thread uses its buffers
+    if DUAL_STREAM:
+        video_capture.set_crop_scaler(CropScaler(video_capture.resolution, INFERENCE_RESOLUTION, CAMERA_CALIBRATION,
+                                                    yuyv=video_capture.is_yuyv))
     
     # define the HorizonDetector
-    horizon_detector = HorizonDetector(EXCLUSION_THRESH, FOV, ACCEPTABLE_VARIANCE, INFERENCE_RESOLUTION)
+    horizon_detector = make_horizon_detector(INFERENCE_RESOLUTION, SMOOTHING_FILTER)
+
+    # define the FrameGovernor, which keeps the main loop within its frame budget
+    governor = FrameGovernor(FPS, GOVERNOR_LADDER)
+
+    # renders the diagnostic images of the HorizonDetector at a low rate, off the main loop
+    diagnostics_display = DiagnosticsDisplay()
+
+    # tells when a frame is the same as the previous one, so that its horizon can be kept
+    duplicate_filter = DuplicateFrameFilter(DUPLICATE_FRAME_DIFFERENCE)
     
     # initialize some values related to the flight controller
     recording_switch_new_position = None
@@ -168,15 +298,40 @@ def main():
     t1 = timer() # for measuring frame rate
     n = 0 # frame number
     while video_capture.run:
+        governor.start_frame()
+
         # get a frame from the webcam or video
-        frame = video_capture.read_frame()
+        frame_number, frame, small_frame = video_capture.read_numbered_frame()
+        governor.mark('capture')
 
-        # crop and scale the image
-        scaled_and_cropped_frame = crop_and_scale(frame, **crop_and_scale_parameters)
+        # the governor may have turned off the display, or asked to record only every other frame
+        show_display = render_image and not governor.is_active(HUD_OFF)
+        record_frame = gv.recording and not (governor.is_active(HALF_RECORDING_FPS) and n % 2)
 
-        # find the horizon
-        output = horizon_detector.find_horizon(scaled_and_cropped_frame, diagnostic_mode=render_image)
-        roll, pitch, variance, is_good_horizon, _ = output
+        # Find the horizon. If the governor asks for it, every other frame
+        # keeps the horizon of the previous frame instead. So does a frame that is the same
+        # as the last one (REPEAT) or hardly differs from it (UNCHANGED).
+        skip_detection = governor.is_active(ALTERNATE_FRAME_DETECTION) and n % 2 == 1
+        duplicate_frame = None
+        if not skip_detection:
+            if duplicate_filter.is_repeat(frame_number):
+                duplicate_frame = REPEAT
+            else:
+                # crop and scale the image
+                scaled_and_cropped_frame = crop_and_scale_frame(frame, small_frame)
+                if duplicate_filter.is_unchanged(frame_number, scaled_and_cropped_frame):
+                    duplicate_frame = UNCHANGED
+                else:
+                    # only take a diagnostic snapshot when the display is ready to render a new one
+                    diagnostic_mode = show_display and diagnostics_display.wants_snapshot()
+                    result = horizon_detector.find_horizon(scaled_and_cropped_frame, diagnostic_mode=diagnostic_mode)
+                    roll, pitch, variance, is_good_horizon = result.roll, result.pitch, result.variance, result.is_good_horizon
+                    threshold = result.threshold
+                    is_tracked = result.is_tracked
+                    # tracked frames have no snapshot
+                    if diagnostic_mode and result.snapshot is not None:
+                        diagnostics_display.publish(result.snapshot)
+        governor.mark('detection')
             
         # run the flight controller
         if OPERATING_SYSTEM == "Linux":
@@ -186,9 +341,10 @@ def main():
                 adjusted_pitch = None
             ail_stick_val, elev_stick_val, ail_val, elev_val, ail_trim, elev_trim = flt_ctrl.run(roll, adjusted_pitch, is_good_horizon)
             flt_mode = flt_ctrl.program_id  
+        governor.mark('control')
 
         # save the horizon data for diagnostic purposes
-        if gv.recording:
+        if record_frame:
             # determine the number of the frame within the current recording
             recording_frame_num = next(recording_frame_iter)
 
@@ -198,6 +354,14 @@ def main():
             frame_data['pitch'] = pitch
             frame_data['variance'] = variance
             frame_data['is_good_horizon'] = is_good_horizon
+            # the threshold of the mask, to replay the frame with exactly the same mask
+            frame_data['threshold'] = threshold
+            # whether the horizon was kept from the previous frame, since this one was the same
+            frame_data['duplicate_frame'] = duplicate_frame
+            # whether this frame kept the horizon of the previous frame because the governor skipped its detection
+            frame_data['detection_skipped'] = skip_detection
+            # whether the horizon was tracked with optical flow instead of detected
+            frame_data['is_tracked'] = is_tracked
             frame_data['actual_fps'] = actual_fps
             frame_data['ail_val'] = ail_val
             frame_data['elev_val'] = elev_val
@@ -207,10 +371,20 @@ def main():
             frame_data['elev_trim'] = elev_trim
             frame_data['flt_mode'] = flt_mode
             frame_data['pitch_trim'] = pitch_trim 
+            frame_data['governor_level'] = governor.level
+            # number of frames of the main loop this recorded frame stands for, so that a recording made
+            # at half the frame rate can be produced at the speed of the flight (see video_producer.py)
+            frame_data['recording_interval'] = 2 if governor.is_active(HALF_RECORDING_FPS) else 1
             frames[recording_frame_num] = frame_data
          
-        if render_image:
-            frame_copy = frame.copy() # copy the frame so that we have an unmarked frame to draw on
+        # raw YUYV frames are only converted to BGR for the display and the recording
+        if video_capture.is_yuyv and (show_display or record_frame):
+            bgr_frame = yuyv_to_bgr(frame)
+        else:
+            bgr_frame = frame
+
+        if show_display:
+            frame_copy = bgr_frame.copy() # copy the frame so that we have an unmarked frame to draw on
             # draw roi
             draw_roi(frame_copy, crop_and_scale_parameters)
             
@@ -239,10 +413,13 @@ def main():
 
             # show image
             cv2.imshow("Real-time Display", frame_copy)
+            diagnostics_display.show()
+        governor.mark('display')
 
         # add frame to recording queue
-        if gv.recording:
-            video_writer.queue.put(frame)     
+        if record_frame:
+            video_writer.queue.put(bgr_frame)
+        governor.mark('recording')     
 
         # check for user input
         if OPERATING_SYSTEM == 'Linux':
@@ -290,8 +467,11 @@ def main():
             datadict = {} # top-level dictionary that contains all diagnostic data
             metadata = {} # metadata for the recording (resolution, fps, datetime, etc.)
             frames = {} # contains data for each frame of the recording
+            governor_transitions = [] # the steps taken and given back by the governor
             datadict['metadata'] = metadata
             datadict['frames'] = frames
+            datadict['governor_transitions'] = governor_transitions
+            recording_frame_num = -1
             
             # do a surface check
             if OPERATING_SYSTEM == 'Linux':
@@ -308,6 +488,36 @@ def main():
             if OPERATING_SYSTEM == 'Linux':
                 flt_ctrl.select_program(3)
 
+        governor.mark('input')
+
+        # Let the governor adjust the workload to the frame budget.
+        # The steps that are not handled here are checked at the top of the loop.
+        transition = governor.end_frame()
+        if transition is not None:
+            action = 'Taking' if transition['active'] else 'Giving back'
+            print(f"{action} governor step {transition['step']} "\
+                    f"(busy for {transition['busy_time']:.1f} ms of {1000/FPS:.1f} ms per frame)")
+            if transition['step'] == CHEAP_SMOOTHING_FILTER:
+                smoothing_filter = GOVERNOR_SMOOTHING_FILTER if transition['active'] else SMOOTHING_FILTER
+                horizon_detector.set_smoothing_filter(smoothing_filter)
+            elif transition['step'] == LOW_INFERENCE_RESOLUTION:
+                inference_resolution = GOVERNOR_INFERENCE_RESOLUTION if transition['active'] else INFERENCE_RESOLUTION
+                smoothing_filter = GOVERNOR_SMOOTHING_FILTER if governor.is_active(CHEAP_SMOOTHING_FILTER) else SMOOTHING_FILTER
+                # carry the tracked horizon over to the new HorizonDetector
+                tracker_state = horizon_detector.get_tracker_state()
+                horizon_detector = make_horizon_detector(inference_resolution, smoothing_filter)
+                horizon_detector.set_tracker_state(tracker_state)
+                crop_scaler = CropScaler(video_capture.resolution, inference_resolution, CAMERA_CALIBRATION,
+                                            yuyv=video_capture.is_yuyv)
+                crop_and_scale_parameters = crop_scaler.parameters
+                if DUAL_STREAM:
+                    video_capture.set_crop_scaler(CropScaler(video_capture.resolution, inference_resolution,
+                                                                CAMERA_CALIBRATION, yuyv=video_capture.is_yuyv))
+            # log the transition into the recording, at the last recorded frame
+            if gv.recording:
+                transition['frame'] = recording_frame_num
+                governor_transitions.append(transition)
+
         # DYNAMIC WAIT
         # Figure out how much longer we need to wait in order 
         # for the actual frame rate to be equal to the target frame rate.
@@ -332,6 +542,7 @@ def main():
         gv.recording = not gv.recording
         finish_recording()
     video_capture.release()
+    diagnostics_display.stop()
     cv2.destroyAllWindows()
     gv.recording = False
     gv.run = False
@@ -0,0 +1,178 @@
+######## Incremental Otsu threshold #########
+# HorizonDetector thresholds the smoothed blue filtered greyscale image into sky and ground with Otsu's method.
+# cv2.threshold with THRESH_OTSU builds the histogram of every pixel and searches all 256 levels on every frame,
+# although the brightness of the sky and the ground changes slowly over a flight.
+# IncrementalOtsu builds the histogram from a subsample of about SAMPLE_PIXELS pixels and starts from the previous
+# threshold. While the mean brightness of the sky and of the ground (the two classes at that threshold) stays put,
+# the threshold is kept without a search. When they move a little, only the levels within SEARCH_RADIUS
+# of the previous threshold are searched, which also keeps the threshold from jumping between two valleys
+# of the histogram from one frame to the next. When they move a lot (a turn towards the sun, a cloud),
+# the full search is run again.
+#
+# The threshold of each frame is reported with its HorizonResult and recorded with the frame,
+# so that a recording can be replayed with exactly the masks of the flight (see video_producer.py),
+# although the threshold now depends on the frames before it.
+#
+# Results on synthetic 300 frame flights (python otsu_threshold.py), measured on a desktop x86 core.
+# Time is the threshold alone (histogram, search and thresholding) on the smoothed full frame.
+# The dimming flight dims to 60% over its second half. Difference is the mean difference from Otsu's threshold.
+#
+# flight   resolution  Otsu    incremental  frames searched  difference
+# steady   100x100      7 us   22 us         97 of 300       2.5 levels
+# steady   200x200     21 us   23 us         73 of 300       0.8 levels
+# steady   400x400     82 us   47 us         73 of 300       0.6 levels
+# dimming  100x100      7 us   21 us         95 of 300       4.9 levels
+# dimming  400x400     88 us   48 us         82 of 300       2.3 levels
+#
+# The errors of the detector are the same with either threshold. cv2.THRESH_OTSU is a tight loop in C,
+# and the few numpy calls of the incremental threshold cost more than it does up to about 200x200,
+# so it is off by default and only pays at higher inference resolutions.
+
+import cv2
+import numpy as np
+
+# the histogram is built from about this many pixels, every n-th pixel of every n-th row
+SAMPLE_PIXELS = 2500
+# Shift of the mean brightness of the sky or the ground (the two classes at the current threshold),
+# in levels, since the last search, up to which the threshold is kept as it is,
+# and beyond which the full search is run again
+STEADY_SHIFT = 2
+MAX_SHIFT = 16
+# the threshold moves at most this many levels from one search to the next without a full search
+SEARCH_RADIUS = 8
+
+_LEVELS = np.arange(256, dtype=np.float32)
+
+def _search(histogram: np.ndarray, low: int = 0, high: int = 255) -> int:
+    """
+    Returns the threshold between low and high (inclusive) that maximizes the variance between the two classes
+    of the histogram, the values up to the threshold and the values above it (the same as cv2.THRESH_OTSU).
+    """
+    total = histogram.sum()
+    mean = np.dot(histogram, _LEVELS) / total
+    # number of values and sum of the values up to each threshold
+    weight = np.cumsum(histogram[:high + 1])[low:]
+    first_moment = np.cumsum(histogram[:high + 1] * _LEVELS[:high + 1])[low:]
+    # Between class variance, up to a constant factor: (mean * w0 - m0)^2 / (w0 * (total - w0)).
+    # Where one class is empty, the numerator is 0 as well; the denominator is kept off 0 (the counts are whole).
+    variance = (mean * weight - first_moment) ** 2 / np.maximum(weight * (total - weight), 1)
+    return low + int(np.argmax(variance))
+
+def _class_means(histogram: np.ndarray, threshold: int) -> tuple:
+    """
+    Returns the mean of the values up to the threshold and the mean of the values above it.
+    An empty class has the mean of the other.
+    """
+    total = histogram.sum()
+    first_moment = np.dot(histogram, _LEVELS)
+    weight = histogram[:threshold + 1].sum()
+    first_moment_below = np.dot(histogram[:threshold + 1], _LEVELS[:threshold + 1])
+    mean = first_moment / total
+    mean_below = first_moment_below / weight if weight else mean
+    mean_above = (first_moment - first_moment_below) / (total - weight) if total > weight else mean
+    return float(mean_below), float(mean_above)
+
+class IncrementalOtsu:
+    """
+    Otsu's threshold of a sequence of similar images, searched again in full only when the histogram shifts.
+    """
+    def __init__(self):
+        self.threshold = None
+        # the means of the two classes at the last search
+        self.means = None
+
+    def update(self, image: np.ndarray) -> int:
+        """
+        Returns the threshold for the image (the mask is white above it).
+        """
+        step = max(int(np.sqrt(image.size / SAMPLE_PIXELS)), 1)
+        # (ravel, since OpenCV versions differ in the shape of the histogram)
+        histogram = cv2.calcHist([image[::step, ::step]], [0], None, [256], [0, 256]).ravel()
+
+        # How far the brightness of the two classes has moved since the last search.
+        # The classes are the values on either side of the current threshold, so that a horizon
+        # that moves through the frame changes their weight but hardly their means.
+        if self.threshold is None:
+            shift = np.inf
+        else:
+            means = _class_means(histogram, self.threshold)
+            shift = max(abs(means[0] - self.means[0]), abs(means[1] - self.means[1]))
+
+        if shift <= STEADY_SHIFT:
+            return self.threshold
+        if shift <= MAX_SHIFT:
+            self.threshold = _search(histogram, max(self.threshold - SEARCH_RADIUS, 0),
+                                        min(self.threshold + SEARCH_RADIUS, 255))
+        else:
+            self.threshold = _search(histogram)
+        self.means = _class_means(histogram, self.threshold)
+        return self.threshold
+
+    def get_state(self) -> dict:
+        """
+        Returns the state carried from one frame to the next, as plain python values.
+        """
+        state = {}
+        state['threshold'] = self.threshold
+        state['means'] = self.means
+        return state
+
+    def set_state(self, state: dict):
+        """
+        Restores a state obtained by get_state.
+        """
+        self.threshold = state['threshold']
+        self.means = None if state['means'] is None else tuple(state['means'])
+
+if __name__ == "__main__":
+    from timeit import default_timer as timer
+    from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale
+    from find_horizon import HorizonDetector
+    from horizon_benchmark import make_flight, run_benchmark, print_stats
+
+    ITERATIONS = 20
+
+    print('Rendering synthetic flight...')
+    frames, rolls, pitches = make_flight()
+    # the same flight with the light dimming to 60% over the second half, as in a turn away from the sun
+    dimming = np.clip(1.8 - 1.6 * np.arange(len(frames)) / len(frames), .6, 1)
+    dimmed_frames = [cv2.convertScaleAbs(frame, alpha=alpha) for frame, alpha in zip(frames, dimming)]
+    for flight_name, flight_frames in [('steady', frames), ('dimming', dimmed_frames)]:
+        for inference_resolution in [(100, 100), (200, 200), (400, 400)]:
+            # the smoothed images of the full frames
+            crop_and_scale_parameters = get_cropping_and_scaling_parameters(frames[0].shape[1::-1], inference_resolution)
+            horizon_detector = HorizonDetector(4, 48.8, 1.3, inference_resolution, horizon_lock_band=False)
+            images = []
+            for frame in flight_frames:
+                frame = crop_and_scale(frame, **crop_and_scale_parameters)
+                horizon_detector._find_points(frame, horizon_detector.buffers, frame.shape, {})
+                images.append(horizon_detector.buffers.blur.copy())
+            mask = np.empty_like(images[0])
+
+            t1 = timer()
+            for n in range(ITERATIONS):
+                for image in images:
+                    cv2.threshold(image, 250, 255, cv2.THRESH_OTSU, dst=mask)
+            otsu_time = (timer() - t1) / ITERATIONS / len(images) * 1e6
+            t1 = timer()
+            for n in range(ITERATIONS):
+                threshold_estimator = IncrementalOtsu()
+                for image in images:
+                    cv2.threshold(image, threshold_estimator.update(image), 255, cv2.THRESH_BINARY, dst=mask)
+            incremental_time = (timer() - t1) / ITERATIONS / len(images) * 1e6
+
+            # how often the full search runs, and how far the thresholds are from Otsu's
+            threshold_estimator = IncrementalOtsu()
+            searches = 0
+            differences = []
+            for image in images:
+                means = threshold_estimator.means
+                threshold = threshold_estimator.update(image)
+                searches += threshold_estimator.means is not means
+                differences.append(abs(threshold - cv2.threshold(image, 250, 255, cv2.THRESH_OTSU)[0]))
+            print(f'{flight_name} {inference_resolution}: Otsu {otsu_time:.0f} us, incremental {incremental_time:.0f} us, '
+                    f'searched {searches} times, mean difference {np.mean(differences):.1f} levels')
+
+        for incremental_threshold in [False, True]:
+            stats = run_benchmark(flight_frames, rolls, pitches, incremental_threshold=incremental_threshold)
+            print_stats(f'{flight_name} {"incremental" if incremental_threshold else "Otsu"}', stats)
@@ -0,0 +1,152 @@
+# standard libraries
+import cv2
+import numpy as np
+from multiprocessing import Pool, cpu_count
+
+# my libraries
+from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale
+from find_horizon import HorizonDetector
+
+# Number of frames before the start of each chunk that are processed (and discarded)
+# so that the predicted horizon has settled by the time the chunk starts.
+# The Kalman filter of the HorizonTracker takes a little over a second of video
+# to forget where it started from.
+WARMUP_FRAMES = 40
+
+def _read_frames(source: str, start: int, stop: int, crop_and_scale_parameters: dict) -> list:
+    """
+    Reads frames start to stop (exclusive) from the video file, cropped and scaled
+    to the inference resolution. If stop is None, reads until the end of the video.
+    """
+    cap = cv2.VideoCapture(source)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    frames = []
+    frame_num = start
+    while stop is None or frame_num < stop:
+        ret, frame = cap.read()
+        if ret == False:
+            break
+        frames.append(crop_and_scale(frame, **crop_and_scale_parameters))
+        frame_num += 1
+    cap.release()
+    return frames
+
+def _process_chunk(job: dict) -> dict:
+    """
+    Finds the horizon in one chunk of a video. Runs in a worker process.
+    The frames from job['warmup_start'] to job['start'] are only used to build up the
+    tracker state, unless job['state'] is given, in which case that state is used directly.
+    """
+    horizon_detector = HorizonDetector(**job['detector_parameters'])
+    if job['state'] is not None:
+        horizon_detector.set_tracker_state(job['state'])
+
+    frames = _read_frames(job['source'], job['warmup_start'], job['stop'], job['crop_and_scale_parameters'])
+    number_of_warmup_frames = job['start'] - job['warmup_start']
+
+    output = {}
+    output['start'] = job['start']
+    if number_of_warmup_frames:
+        horizon_detector.find_horizons(np.stack(frames[:number_of_warmup_frames]))
+    output['state_at_start'] = horizon_detector.get_tracker_state()
+    frames = frames[number_of_warmup_frames:]
+    if frames:
+        output['columns'] = horizon_detector.find_horizons(np.stack(frames))
+    else:
+        output['columns'] = horizon_detector.find_horizons(())
+    output['final_state'] = horizon_detector.get_tracker_state()
+    return output
+
+def find_horizons_in_video(source: str, inference_resolution: tuple, exclusion_thresh: float, fov: float,
+                            acceptable_variance: float, processes: int = None, warmup_frames: int = WARMUP_FRAMES,
+                            **detector_options) -> dict:
+    """
+    Finds the horizon in every frame of a video file, splitting the video into one
+    chunk of frames per process.
+
+    Each chunk starts with a few warmup frames that overlap the previous chunk. If the tracker
+    state at the start of a chunk does not match the state at the end of the previous chunk,
+    the chunk is processed again starting from that state, so the results are always the same
+    as processing the whole video in order with a single HorizonDetector.
+
+    detector_options: any further keyword arguments for HorizonDetector, e.g. sky_filter
+    Returns a dictionary of arrays as returned by HorizonDetector.find_horizons.
+    """
+    if processes is None:
+        processes = cpu_count()
+
+    # get some information about the video
+    cap = cv2.VideoCapture(source)
+    number_of_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    resolution = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    cap.release()
+    crop_and_scale_parameters = get_cropping_and_scaling_parameters(resolution, inference_resolution)
+
+    detector_parameters = {}
+    detector_parameters['exclusion_thresh'] = exclusion_thresh
+    detector_parameters['fov'] = fov
+    detector_parameters['acceptable_variance'] = acceptable_variance
+    detector_parameters['frame_shape'] = inference_resolution
+    detector_parameters.update(detector_options)
+
+    # define one job per chunk
+    chunk_size = max(int(np.ceil(number_of_frames / processes)), warmup_frames, 1)
+    jobs = []
+    for start in range(0, max(number_of_frames, 1), chunk_size):
+        job = {}
+        job['source'] = source
+        job['start'] = start
+        job['warmup_start'] = max(start - warmup_frames, 0)
+        # the frame count reported for some videos is not exact, so the last chunk reads to the end
+        job['stop'] = start + chunk_size if start + chunk_size < number_of_frames else None
+        job['crop_and_scale_parameters'] = crop_and_scale_parameters
+        job['detector_parameters'] = detector_parameters
+        job['state'] = None
+        jobs.append(job)
+
+    with Pool(processes) as pool:
+        outputs = pool.map(_process_chunk, jobs)
+
+    # stitch the chunks together, reprocessing any chunk whose warmup
+    # did not end in the same state as the previous chunk
+    for n in range(1, len(outputs)):
+        previous_state = outputs[n - 1]['final_state']
+        if outputs[n]['state_at_start'] == previous_state:
+            continue
+        jobs[n]['warmup_start'] = jobs[n]['start']
+        jobs[n]['state'] = previous_state
+        outputs[n] = _process_chunk(jobs[n])
+
+    columns = {}
+    for key in outputs[0]['columns']:
+        columns[key] = np.concatenate([output['columns'][key] for output in outputs])
+    return columns
+
+if __name__ == "__main__":
+    import json
+    from timeit import default_timer as timer
+
+    # load a recording and its metadata
+    path = 'recordings/sample'
+    with open(f'{path}.json') as json_file:
+        metadata = json.load(json_file)['metadata']
+    source = f'{path}.avi'
+    parameters = {}
+    parameters['inference_resolution'] = tuple(metadata['inference_resolution'])
+    parameters['exclusion_thresh'] = metadata['exclusion_thresh']
+    parameters['fov'] = metadata['fov']
+    parameters['acceptable_variance'] = metadata['acceptable_variance']
+
+    print('Processing in parallel...')
+    t1 = timer()
+    parallel = find_horizons_in_video(source, **parameters)
+    t2 = timer()
+    print(f'Finished in {np.round(t2 - t1, decimals=2)} seconds.')
+
+    print('Processing sequentially...')
+    sequential = find_horizons_in_video(source, processes=1, **parameters)
+    t3 = timer()
+    print(f'Finished in {np.round(t3 - t2, decimals=2)} seconds.')
+
+    matches = all(np.array_equal(parallel[key], sequential[key], equal_nan=True) for key in parallel)
+    print(f'Results match: {matches}')
@@ -0,0 +1,145 @@
+import cv2
+import os
+import numpy as np
+from yuv_frames import yuv_to_bgr
+
+# number of colors in 24-bit BGR
+NUMBER_OF_COLORS = 256 ** 3
+CACHE_DIRECTORY = 'cache'
+
+class SkyFilterLUT:
+    """
+    Lookup table that tells for every 24-bit BGR color whether it falls within the
+    HSV bounds of the blue sky filter. Replaces the per-frame HSV conversion and inRange
+    of HorizonDetector with a single table lookup per pixel.
+
+    The table is built once per set of bounds and saved to disk bit-packed (2 MB),
+    so that it does not have to be rebuilt every time the program starts.
+    """
+    def __init__(self, lower: np.ndarray, upper: np.ndarray, cache_directory: str = CACHE_DIRECTORY,
+                    color_space: str = 'bgr'):
+        """
+        lower: lower HSV bounds of the sky filter
+        upper: upper HSV bounds of the sky filter
+        cache_directory: folder in which the tables are saved
+        color_space: the color space of the frames, 'bgr', or 'yuv' for three channel Y, U, V frames (see yuv_frames.py),
+        in which case the table is indexed by y | u << 8 | v << 16
+        """
+        self.cache_directory = cache_directory
+        self.color_space = color_space
+        self.bounds = None
+        self.table = None
+
+        # buffers, allocated for the first frame
+        self.padded_frame = None
+        self.colors = None
+        self.index = None
+        self.sky = None
+
+        self.set_bounds(lower, upper)
+
+    def set_bounds(self, lower: np.ndarray, upper: np.ndarray):
+        """
+        Loads or builds the table for the given bounds. Does nothing if the bounds
+        have not changed.
+        """
+        bounds = (tuple(int(value) for value in lower), tuple(int(value) for value in upper))
+        if bounds == self.bounds:
+            return
+        self.bounds = bounds
+
+        # load the table from disk if it has been built before
+        lower_string = '_'.join(str(value) for value in bounds[0])
+        upper_string = '_'.join(str(value) for value in bounds[1])
+        if self.color_space == 'yuv':
+            path = f'{self.cache_directory}/sky_filter_lut_yuv_{lower_string}_{upper_string}.npy'
+        else:
+            path = f'{self.cache_directory}/sky_filter_lut_{lower_string}_{upper_string}.npy'
+        if os.path.exists(path):
+            packed_table = np.load(path)
+        else:
+            print(f'Building sky filter lookup table for bounds {bounds}...')
+            packed_table = self._build_table(bounds)
+            if not os.path.exists(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            np.save(path, packed_table)
+
+        # Unpack to one byte per color (16 MB) for fast lookups,
+        # with 255 for sky colors and 0 for everything else.
+        self.table = np.unpackbits(packed_table, bitorder='little')
+        self.table *= 255
+
+    def apply(self, frame: np.ndarray, bgr2gray: np.ndarray, dst: np.ndarray = None) -> np.ndarray:
+        """
+        Returns the greyscale frame with the blue of the sky set to white,
+        i.e. the same as cv2.add(bgr2gray, cv2.inRange(hsv, lower, upper)).
+        frame: the BGR frame (or Y, U, V frame)
+        bgr2gray: the greyscale version of the frame
+        dst: optional output buffer
+        """
+        height, width = frame.shape[:2]
+        number_of_pixels = height * width
+        if self.sky is None or self.sky.shape != (height, width):
+            # One spare byte at the end so that a 4 byte word can be read at every pixel.
+            self.padded_frame = np.zeros(number_of_pixels * 3 + 1, dtype=np.uint8)
+            # Each word contains b | g << 8 | r << 16 | (first byte of the next pixel) << 24.
+            self.colors = np.ndarray((number_of_pixels,), dtype='<u4', buffer=self.padded_frame.data, strides=(3,))
+            self.index = np.empty(number_of_pixels, dtype=np.uint32)
+            self.sky = np.empty((height, width), dtype=np.uint8)
+
+        self.padded_frame[:-1] = frame.reshape(-1)
+        np.bitwise_and(self.colors, 0xFFFFFF, out=self.index)
+        np.take(self.table, self.index, out=self.sky.reshape(-1))
+        return cv2.max(bgr2gray, self.sky, dst=dst)
+
+    def _build_table(self, bounds: tuple) -> np.ndarray:
+        """
+        Runs every BGR color through the HSV conversion and inRange once.
+        Returns the bit-packed table, indexed by b | g << 8 | r << 16.
+        For YUV, every Y, U, V color is converted to BGR first.
+        """
+        lower = np.array(bounds[0])
+        upper = np.array(bounds[1])
+        table = np.empty(NUMBER_OF_COLORS, dtype=np.uint8)
+
+        # all combinations of blue and green, as one 256 x 256 image
+        colors = np.empty((256, 256, 3), dtype=np.uint8)
+        colors[:, :, 0] = np.arange(256)[np.newaxis, :]
+        colors[:, :, 1] = np.arange(256)[:, np.newaxis]
+        for red in range(256):
+            colors[:, :, 2] = red
+            if self.color_space == 'yuv':
+                hsv = cv2.cvtColor(yuv_to_bgr(colors), cv2.COLOR_BGR2HSV)
+            else:
+                hsv = cv2.cvtColor(colors, cv2.COLOR_BGR2HSV)
+            table[red * 65536:(red + 1) * 65536] = cv2.inRange(hsv, lower, upper).reshape(-1)
+
+        return np.packbits(table.astype(bool), bitorder='little')
+
+if __name__ == "__main__":
+    from timeit import default_timer as timer
+
+    ITERATIONS = 1000
+    lower = np.array([109, 0, 116])
+    upper = np.array([153, 255, 255])
+
+    t1 = timer()
+    sky_filter_lut = SkyFilterLUT(lower, upper)
+    t2 = timer()
+    print(f'Loaded lookup table in {np.round(t2 - t1, decimals=2)} seconds.')
+
+    # random frame at the inference resolution
+    frame = np.random.randint(0, 256, (100, 100, 3), dtype=np.uint8)
+    bgr2gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    t1 = timer()
+    for n in range(ITERATIONS):
+        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+        expected = cv2.add(bgr2gray, cv2.inRange(hsv, lower, upper))
+    t2 = timer()
+    for n in range(ITERATIONS):
+        output = sky_filter_lut.apply(frame, bgr2gray)
+    t3 = timer()
+    print(f'HSV: {np.round((t2 - t1) / ITERATIONS * 1e6, decimals=1)} us per frame.')
+    print(f'Lookup table: {np.round((t3 - t2) / ITERATIONS * 1e6, decimals=1)} us per frame.')
+    print(f'Results match: {np.array_equal(expected, output)}')
@@ -0,0 +1,109 @@
+######## Learned sky segmentation #########
+# An alternative to the blue filter and Otsu threshold of HorizonDetector, which are tuned by hand
+# and fail under haze and in the light of sunset. A tiny fully convolutional network, trained with
+# train_sky_segmentation.py and exported to ONNX, gives the probability that each pixel is sky.
+# It runs on the CPU through OpenCV's cv2.dnn module, so no other dependency is needed on the Pi.
+#
+# The network works at a quarter of the resolution of its input (two convolutions with a stride of 2)
+# and its output is scaled back up, so the boundary is smooth and no smoothing filter is needed.
+# Its output replaces the smoothed blue filtered greyscale image in HorizonDetector; the mask is
+# the output thresholded at one half, and the backend, line fit and pitch are unchanged.
+#
+# Compare the latency with the classic pipeline with python sky_segmentation.py [model path].
+# Latency does not depend on the weights, so it was measured with an untrained network of the
+# same architecture, on a desktop x86 core. Run it on the Pi before choosing it; the numbers do not carry over.
+#
+# resolution  classic (hsv, bilateral, Otsu)  network, single frame  network, batches of 32
+# 100x100     413 us                          481 us                 454 us per frame
+# 200x200     1382 us                         1555 us                2258 us per frame
+
+import cv2
+import numpy as np
+
+DEFAULT_MODEL_PATH = 'models/sky_segmentation.onnx'
+# the network works at 1/OUTPUT_STRIDE of the resolution of its input
+OUTPUT_STRIDE = 4
+# the pixels are scaled from 0-255 to 0-1 before they are fed to the network
+INPUT_SCALE = 1 / 255
+
+class SkySegmenter:
+    """
+    Runs the sky segmentation network on single frames (find_horizon) or on batches of frames (find_horizons).
+    """
+    def __init__(self, model_path: str = DEFAULT_MODEL_PATH):
+        self.net = cv2.dnn.readNetFromONNX(model_path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+
+    def segment(self, image: np.ndarray, dst: np.ndarray = None) -> np.ndarray:
+        """
+        Returns the probability that each pixel of the BGR image is sky, from 0 to 255.
+        dst: optional output buffer, the size of the image
+        """
+        return self.segment_batch(image[np.newaxis], None if dst is None else dst[np.newaxis])[0]
+
+    def segment_batch(self, images: np.ndarray, dst: np.ndarray = None) -> np.ndarray:
+        """
+        Like segment, for an N x H x W x 3 array of images, all run through the network at once.
+        dst: optional N x H x W output buffer
+        """
+        number_of_images, height, width = images.shape[:3]
+        if dst is None:
+            dst = np.empty((number_of_images, height, width), dtype=np.uint8)
+
+        # Size the input to a multiple of the output stride, so that the output lines up with it.
+        input_width = -(-width // OUTPUT_STRIDE) * OUTPUT_STRIDE
+        input_height = -(-height // OUTPUT_STRIDE) * OUTPUT_STRIDE
+        blob = cv2.dnn.blobFromImages(list(images), INPUT_SCALE, (input_width, input_height), swapRB=False, crop=False)
+        self.net.setInput(blob)
+        probabilities = self.net.forward()
+
+        # scale the output of each image back up to the size of the image
+        for n in range(number_of_images):
+            probability = cv2.resize(probabilities[n, 0], (width, height), interpolation=cv2.INTER_LINEAR)
+            cv2.convertScaleAbs(probability, dst=dst[n], alpha=255)
+        return dst
+
+if __name__ == "__main__":
+    import sys
+    from timeit import default_timer as timer
+    from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale
+    from find_horizon import HorizonDetector
+    from horizon_benchmark import make_flight, run_benchmark, print_stats
+
+    ITERATIONS = 200
+    BATCH_SIZE = 32
+    model_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_MODEL_PATH
+
+    print('Rendering synthetic flight...')
+    frames, rolls, pitches = make_flight()
+    sky_segmenter = SkySegmenter(model_path)
+    for inference_resolution in [(100, 100), (200, 200)]:
+        crop_and_scale_parameters = get_cropping_and_scaling_parameters(frames[0].shape[1::-1], inference_resolution)
+        small_frames = np.array([crop_and_scale(frame, **crop_and_scale_parameters) for frame in frames])
+
+        # latency of the color and mask stages of the classic pipeline on a single frame
+        horizon_detector = HorizonDetector(4, 48.8, 1.3, inference_resolution)
+        buffers = horizon_detector.buffers
+        t1 = timer()
+        for n in range(ITERATIONS):
+            bgr2gray, blue_filtered_greyscale = horizon_detector._filter_colors(small_frames[0], buffers)
+            blur = horizon_detector.smoothing_filter.apply(blue_filtered_greyscale, buffers.blur)
+            cv2.threshold(blur, 250, 255, cv2.THRESH_OTSU, dst=buffers.mask)
+        classic_time = (timer() - t1) / ITERATIONS * 1e6
+
+        # latency of the network on a single frame, and per frame in batches
+        t1 = timer()
+        for n in range(ITERATIONS):
+            probability = sky_segmenter.segment(small_frames[0])
+            cv2.threshold(probability, 127, 255, cv2.THRESH_BINARY)
+        single_time = (timer() - t1) / ITERATIONS * 1e6
+        t1 = timer()
+        for start in range(0, len(small_frames), BATCH_SIZE):
+            sky_segmenter.segment_batch(small_frames[start:start + BATCH_SIZE])
+        batch_time = (timer() - t1) / len(small_frames) * 1e6
+        print(f'{inference_resolution}: classic {classic_time:.0f} us, network {single_time:.0f} us per frame, '
+                f'{batch_time:.0f} us per frame in batches of {BATCH_SIZE}')
+
+        print_stats(f'classic {inference_resolution}', run_benchmark(frames, rolls, pitches, inference_resolution))
+        print_stats(f'network {inference_resolution}', run_benchmark(frames, rolls, pitches, inference_resolution,
+                                                                    segmentation_model=model_path))
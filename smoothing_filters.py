@@ -0,0 +1,145 @@
+######## Smoothing filters for the sky/ground mask #########
+# The blue filtered greyscale image is smoothed before it is thresholded into the sky/ground mask.
+# The bilateral filter gives the cleanest mask, but it is by far the most expensive step of
+# HorizonDetector.find_horizon and its cost grows with the square of the inference resolution.
+#
+# Results on a synthetic 300 frame flight (python smoothing_filters.py), measured on a desktop x86 core.
+# Time is the filter alone on a full frame at the inference resolution. Errors are the mean errors in degrees
+# against the true horizon, over the frames with a good horizon. Re-run on the Pi before choosing a filter;
+# the relative costs carry over better than the absolute ones.
+#
+# filter      resolution  filter time  good horizons  roll error  pitch error
+# bilateral   100x100     251 us       99.0%          0.20        0.17
+# guided      100x100      96 us       98.7%          0.19        0.18
+# box         100x100       7 us       98.7%          0.27        0.20
+# median      100x100      56 us       99.7%          0.22        0.18
+# downscale   100x100      40 us       98.0%          0.26        0.19
+# none        100x100       0 us       98.7%          0.19        0.17
+# bilateral   200x200     973 us       99.3%          0.13        0.08
+# guided      200x200     394 us       99.7%          0.13        0.09
+# box         200x200      26 us       98.3%          0.15        0.09
+# median      200x200     149 us       99.3%          0.12        0.09
+# downscale   200x200      95 us       98.7%          0.14        0.08
+# none        200x200       0 us       99.0%          0.11        0.09
+#
+# The synthetic frames have little texture in the ground, so they understate
+# how much the edge preserving filters help on real footage.
+
+import cv2
+import numpy as np
+
+class BilateralFilter:
+    """
+    Edge preserving smoothing. The original filter of the detector.
+    """
+    def apply(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        return cv2.bilateralFilter(src, 9, 50, 50, dst=dst)
+
+class GuidedFilter:
+    """
+    Edge preserving smoothing with the image as its own guide (He et al.), built from box filters,
+    so that its cost does not depend on the radius.
+    """
+    def __init__(self, radius: int = 4, eps: float = 50 ** 2):
+        self.ksize = (2 * radius + 1, 2 * radius + 1)
+        self.eps = eps
+        self.buffers = None
+
+    def apply(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        if self.buffers is None or self.buffers[0].shape != src.shape:
+            self.buffers = [np.empty(src.shape, dtype=np.float32) for _ in range(4)]
+        image, mean, mean_of_squares, variance = self.buffers
+
+        image[:] = src
+        cv2.boxFilter(image, -1, self.ksize, dst=mean)
+        cv2.sqrBoxFilter(image, cv2.CV_32F, self.ksize, dst=mean_of_squares)
+        cv2.multiply(mean, mean, dst=variance)
+        cv2.subtract(mean_of_squares, variance, dst=variance)
+
+        # a = variance / (variance + eps), b = mean - a * mean
+        a = mean_of_squares
+        cv2.add(variance, self.eps, dst=a)
+        cv2.divide(variance, a, dst=a)
+        b = variance
+        cv2.multiply(a, mean, dst=b)
+        cv2.subtract(mean, b, dst=b)
+
+        # output = mean(a) * image + mean(b)
+        cv2.boxFilter(a, -1, self.ksize, dst=a)
+        cv2.boxFilter(b, -1, self.ksize, dst=b)
+        cv2.multiply(a, image, dst=image)
+        cv2.add(image, b, dst=image)
+        return cv2.convertScaleAbs(image, dst=dst)
+
+class BoxFilter:
+    """
+    Plain averaging. Not edge preserving, but the Otsu threshold puts the boundary
+    back in the middle of the blurred edge.
+    """
+    def apply(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        return cv2.blur(src, (5, 5), dst=dst)
+
+class MedianFilter:
+    """
+    Removes small specks (noise, birds, propeller streaks) while keeping edges sharp.
+    """
+    def apply(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        return cv2.medianBlur(src, 5, dst=dst)
+
+class DownscaleFilter:
+    """
+    Approximates the bilateral filter by running a smaller bilateral filter
+    at half the resolution and scaling the result back up.
+    """
+    def __init__(self):
+        self.small = None
+        self.small_blur = None
+
+    def apply(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        small_shape = ((src.shape[0] + 1)//2, (src.shape[1] + 1)//2)
+        if self.small is None or self.small.shape != small_shape:
+            self.small = np.empty(small_shape, dtype=np.uint8)
+            self.small_blur = np.empty(small_shape, dtype=np.uint8)
+        cv2.resize(src, small_shape[::-1], dst=self.small, interpolation=cv2.INTER_AREA)
+        cv2.bilateralFilter(self.small, 5, 50, 50, dst=self.small_blur)
+        return cv2.resize(self.small_blur, src.shape[::-1], dst=dst, interpolation=cv2.INTER_LINEAR)
+
+class NoFilter:
+    """
+    No smoothing at all.
+    """
+    def apply(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        return src
+
+# the filters that can be selected with the smoothing_filter setting
+SMOOTHING_FILTERS = {
+    'bilateral': BilateralFilter,
+    'guided': GuidedFilter,
+    'box': BoxFilter,
+    'median': MedianFilter,
+    'downscale': DownscaleFilter,
+    'none': NoFilter
+}
+
+if __name__ == "__main__":
+    from timeit import default_timer as timer
+    from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale
+    from horizon_benchmark import make_flight, run_benchmark, print_stats
+
+    ITERATIONS = 1000
+
+    print('Rendering synthetic flight...')
+    frames, rolls, pitches = make_flight()
+    for inference_resolution in [(100, 100), (200, 200)]:
+        # time the filter on its own, on a full frame
+        crop_and_scale_parameters = get_cropping_and_scaling_parameters(frames[0].shape[1::-1], inference_resolution)
+        greyscale = cv2.cvtColor(crop_and_scale(frames[0], **crop_and_scale_parameters), cv2.COLOR_BGR2GRAY)
+        dst = np.empty_like(greyscale)
+        for name, smoothing_filter in SMOOTHING_FILTERS.items():
+            smoothing_filter = smoothing_filter()
+            t1 = timer()
+            for n in range(ITERATIONS):
+                smoothing_filter.apply(greyscale, dst)
+            filter_time = (timer() - t1) / ITERATIONS * 1e6
+            stats = run_benchmark(frames, rolls, pitches, inference_resolution, smoothing_filter=name)
+            print_stats(f'{name} {inference_resolution} ({filter_time:.0f} us)', stats)
@@ -0,0 +1,98 @@
+######## Sub-pixel refinement of the horizon points #########
+# The backends return the horizon points on the pixel grid of the mask (the outermost sky pixels
+# for contour, half way between two pixels for scanline, the Canny edge pixels for hough).
+# At 100x100 and a FOV of 48.8 degrees a pixel is half a degree of pitch, which is what held the
+# inference resolution up. The mask is the smoothed greyscale image thresholded at a single value,
+# so the boundary really lies where the smoothed image crosses that value. Each point is moved along
+# the gradient of the smoothed image to the crossing, interpolated between the two samples either side of it.
+# Only the ~100 abbreviated points are refined, with one cv2.remap for the gradient and one for the profiles.
+#
+# Results on a synthetic 300 frame flight (python subpixel.py), measured on a desktop x86 core.
+# Errors are the mean errors in degrees. The other backends gain about as much as contour.
+#
+# backend  resolution  points   time     roll err  pitch err
+# contour  48x48       pixels   0.60 ms  0.31      0.38
+# contour  48x48       refined  0.76 ms  0.21      0.08
+# contour  64x64       pixels   0.57 ms  0.23      0.28
+# contour  64x64       refined  0.89 ms  0.17      0.06
+# contour  100x100     pixels   0.73 ms  0.17      0.17
+# contour  100x100     refined  0.90 ms  0.13      0.05
+# contour  200x200     pixels   1.12 ms  0.09      0.08
+# contour  200x200     refined  1.21 ms  0.08      0.04
+#
+# Refined at 64x64 is as accurate as whole pixels at 100x100 (and refined at 48x48 has half the pitch error),
+# with less than half the pixels to filter and threshold. The refinement costs about 50 us per frame
+# here. On this core the time per frame hardly depends on the resolution below 100x100, so the gain
+# in frame rate from the lower resolution has to be measured on the Pi.
+#
+# Most of the gain in pitch is from placing the points in the right coordinates: pixel n covers the span
+# from n to n + 1, and only with the points at n + .5 does the center of the frame lie at half its size
+# at every resolution. With whole pixels, this half pixel is lost in the noise of the grid.
+
+import cv2
+import numpy as np
+
+# the profile along the gradient reaches this many pixels to either side of the point
+PROFILE_RADIUS = 2
+# points where the gradient of the smoothed image is weaker than this (per pixel) are left where they are
+MIN_GRADIENT = 2
+
+# offsets of the samples of the profile along the gradient, and of the samples for the gradient
+_PROFILE_OFFSETS = np.arange(-PROFILE_RADIUS, PROFILE_RADIUS + 1, dtype=np.float32)[:, np.newaxis]
+_GRADIENT_OFFSETS_X = np.array([-1, 1, 0, 0], dtype=np.float32)[:, np.newaxis]
+_GRADIENT_OFFSETS_Y = np.array([0, 0, -1, 1], dtype=np.float32)[:, np.newaxis]
+
+def _sample(image: np.ndarray, map_x: np.ndarray, map_y: np.ndarray) -> np.ndarray:
+    # bilinear samples of the image, with the border replicated
+    return cv2.remap(image, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+def refine_points(greyscale: np.ndarray, threshold: float, x: np.ndarray, y: np.ndarray) -> tuple:
+    """
+    Moves the points (x, y) of the boundary of a thresholded image to where the image crosses the threshold,
+    along the direction of its gradient, to a fraction of a pixel.
+    greyscale: the image that was thresholded (the smoothed blue filtered greyscale image)
+    threshold: the level of the boundary, half way between the last value of one side and the first of the other
+    Points without a crossing within PROFILE_RADIUS pixels, or without a clear gradient, are not moved.
+    Returns the refined x and y as float32 arrays.
+    """
+    x = x.astype(np.float32)
+    y = y.astype(np.float32)
+    if x.size == 0:
+        return x, y
+    # integer images are sampled in float, or remap would round the interpolated values
+    image = greyscale.astype(np.float32)
+
+    # the gradient at each point, by central differences (twice the gradient, only its direction is needed)
+    samples = _sample(image, x + _GRADIENT_OFFSETS_X, y + _GRADIENT_OFFSETS_Y)
+    dx = samples[1] - samples[0]
+    dy = samples[3] - samples[2]
+    magnitude = np.hypot(dx, dy)
+    has_gradient = magnitude >= 2 * MIN_GRADIENT
+    magnitude[~has_gradient] = 1
+    nx = dx / magnitude
+    ny = dy / magnitude
+
+    # The profile of the image along the gradient, which rises through the threshold.
+    # Where it rises steadily, the number of samples below the threshold tells between which two samples
+    # it crosses. Profiles that do not cross there (noise, or no crossing at all) are left alone.
+    profile = _sample(image, x + _PROFILE_OFFSETS * nx, y + _PROFILE_OFFSETS * ny) - threshold
+    step = np.count_nonzero(profile < 0, axis=0) - 1
+    np.clip(step, 0, 2 * PROFILE_RADIUS - 1, out=step)
+    columns = np.arange(x.size)
+    before = profile[step, columns]
+    after = profile[step + 1, columns]
+    is_crossing = has_gradient & (before < 0) & (after >= 0)
+    offsets = _PROFILE_OFFSETS[step, 0] - before / np.where(is_crossing, after - before, 1)
+    offsets[~is_crossing] = 0
+    return x + offsets * nx, y + offsets * ny
+
+if __name__ == "__main__":
+    from horizon_benchmark import make_flight, run_benchmark, print_stats
+
+    print('Rendering synthetic flight...')
+    frames, rolls, pitches = make_flight()
+    for backend in ['contour', 'scanline', 'hough']:
+        for inference_resolution in [(48, 48), (64, 64), (100, 100), (200, 200)]:
+            for subpixel in [False, True]:
+                stats = run_benchmark(frames, rolls, pitches, inference_resolution, backend=backend, subpixel=subpixel)
+                print_stats(f'{backend} {inference_resolution} {"refined" if subpixel else "pixels"}', stats)
@@ -0,0 +1,200 @@
+######## Training of the sky segmentation network #########
+# Trains the network of sky_segmentation.py and exports it to ONNX for cv2.dnn.
+# Needs PyTorch, which is only needed on the machine that trains the network, not on the Pi.
+#
+# Training data goes in training_data/segmentation:
+#   images/<name>.png: frames from the camera, any resolution
+#   masks/<name>.png: the matching masks, white for sky and black for ground
+# Frames from a recording can be labelled by saving the mask of their detected horizon
+# (draw_display.draw_horizon on a black image) and correcting the masks by hand where the detector was wrong.
+# --synthetic adds frames of horizon_benchmark.make_frame, with random haze and sunset colors.
+#
+# usage: python train_sky_segmentation.py [--synthetic 2000] [--epochs 30] [--output models/sky_segmentation.onnx]
+
+import argparse
+import os
+import cv2
+import numpy as np
+import torch
+from math import cos, sin, radians, pi
+from torch import nn
+
+from horizon_benchmark import make_frame, FOV, RESOLUTION
+from sky_segmentation import DEFAULT_MODEL_PATH, OUTPUT_STRIDE, INPUT_SCALE
+
+TRAINING_DATA_PATH = 'training_data/segmentation'
+# resolution the frames are trained at (the network is fully convolutional, so it runs at any resolution)
+TRAINING_RESOLUTION = (128, 128)
+BATCH_SIZE = 64
+LEARNING_RATE = 3e-3
+
+class SkySegmentationNet(nn.Module):
+    """
+    Two strided convolutions down to a quarter of the resolution, a dilated convolution
+    to see more of the frame, and a 1x1 convolution to the probability of sky.
+    About 3,700 weights, so that it runs in well under a millisecond per frame on a CPU.
+    """
+    def __init__(self, channels: int = 16):
+        super().__init__()
+        self.layers = nn.Sequential(
+            nn.Conv2d(3, channels // 2, 3, stride=2, padding=1),
+            nn.ReLU(),
+            nn.Conv2d(channels // 2, channels, 3, stride=2, padding=1),
+            nn.ReLU(),
+            nn.Conv2d(channels, channels, 3, padding=2, dilation=2),
+            nn.ReLU(),
+            nn.Conv2d(channels, 1, 1),
+            nn.Sigmoid()
+        )
+
+    def forward(self, x):
+        return self.layers(x)
+
+def load_training_data(path: str = TRAINING_DATA_PATH) -> tuple:
+    """
+    Returns the images and masks of the training data folder, scaled to TRAINING_RESOLUTION.
+    """
+    images, masks = [], []
+    image_folder = f'{path}/images'
+    if not os.path.exists(image_folder):
+        return images, masks
+    for file_name in sorted(os.listdir(image_folder)):
+        mask = cv2.imread(f'{path}/masks/{file_name}', cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            print(f'No mask for {file_name}, skipping it.')
+            continue
+        image = cv2.imread(f'{image_folder}/{file_name}')
+        images.append(cv2.resize(image, TRAINING_RESOLUTION, interpolation=cv2.INTER_AREA))
+        masks.append(cv2.resize(mask, TRAINING_RESOLUTION, interpolation=cv2.INTER_AREA))
+    return images, masks
+
+def make_synthetic_data(number_of_frames: int, rng: np.random.Generator) -> tuple:
+    """
+    Renders frames with a known horizon and their masks.
+    """
+    images, masks = [], []
+    width, height = RESOLUTION
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    for _ in range(number_of_frames):
+        roll = rng.uniform(0, 360)
+        pitch = rng.uniform(-20, 20)
+        image = make_frame(roll, pitch, rng=rng, clutter=int(rng.integers(0, 15)))
+
+        # the same horizon as make_frame: the sky lies on the negative side
+        roll_radians = radians(roll)
+        distance = pitch / FOV * height
+        x_perp = distance * cos(roll_radians + pi/2) + width/2
+        y_perp = distance * sin(roll_radians + pi/2) + height/2
+        signed_distance = (y - y_perp) * cos(roll_radians) - (x - x_perp) * sin(roll_radians)
+        mask = np.where(signed_distance < 0, 255, 0).astype(np.uint8)
+
+        images.append(cv2.resize(image, TRAINING_RESOLUTION, interpolation=cv2.INTER_AREA))
+        masks.append(cv2.resize(mask, TRAINING_RESOLUTION, interpolation=cv2.INTER_AREA))
+    return images, masks
+
+def augment(image: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """
+    Random changes of the light: brightness and contrast, haze (a blend towards a pale grey)
+    and the warm, dim colors of sunset. This is what the blue filter cannot cope with.
+    """
+    image = image.astype(np.float32)
+    image = image * rng.uniform(.6, 1.3) + rng.uniform(-30, 30)
+    if rng.random() < .3:
+        haze = rng.uniform(.2, .7)
+        image = image * (1 - haze) + rng.uniform(170, 230) * haze
+    if rng.random() < .3:
+        # less blue, more red
+        image *= np.array([rng.uniform(.4, .8), rng.uniform(.7, 1.), rng.uniform(1., 1.4)], dtype=np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+def to_batch(images: list, masks: list, rng: np.random.Generator, augment_images: bool = True) -> tuple:
+    """
+    Converts a list of images and masks into the input and target tensors of the network,
+    flipped and with the light changed at random if augment_images is True.
+    The images are scaled the same way as cv2.dnn.blobFromImages in SkySegmenter.
+    The masks are scaled down to the output resolution of the network.
+    """
+    inputs, targets = [], []
+    for image, mask in zip(images, masks):
+        if augment_images:
+            if rng.random() < .5:
+                image, mask = image[:, ::-1], mask[:, ::-1]
+            image = augment(image, rng)
+        inputs.append(image.transpose(2, 0, 1) * INPUT_SCALE)
+        output_size = (mask.shape[1] // OUTPUT_STRIDE, mask.shape[0] // OUTPUT_STRIDE)
+        targets.append(cv2.resize(np.ascontiguousarray(mask), output_size, interpolation=cv2.INTER_AREA)[np.newaxis] / 255)
+    inputs = torch.tensor(np.array(inputs), dtype=torch.float32)
+    targets = torch.tensor(np.array(targets), dtype=torch.float32)
+    return inputs, targets
+
+def train(images: list, masks: list, epochs: int, rng: np.random.Generator) -> SkySegmentationNet:
+    """
+    Trains the network on 90% of the frames and prints the accuracy on the other 10% after each epoch.
+    """
+    order = rng.permutation(len(images))
+    validation_size = max(len(images) // 10, 1)
+    validation = order[:validation_size]
+    training = order[validation_size:]
+
+    net = SkySegmentationNet()
+    optimizer = torch.optim.Adam(net.parameters(), lr=LEARNING_RATE)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs)
+    loss_function = nn.BCELoss()
+    for epoch in range(epochs):
+        net.train()
+        rng.shuffle(training)
+        total_loss = 0
+        for start in range(0, len(training), BATCH_SIZE):
+            batch = training[start:start + BATCH_SIZE]
+            inputs, targets = to_batch([images[n] for n in batch], [masks[n] for n in batch], rng)
+            optimizer.zero_grad()
+            loss = loss_function(net(inputs), targets)
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * len(batch)
+        scheduler.step()
+
+        net.eval()
+        with torch.no_grad():
+            inputs, targets = to_batch([images[n] for n in validation], [masks[n] for n in validation], rng, False)
+            accuracy = ((net(inputs) > .5) == (targets > .5)).float().mean().item()
+        print(f'epoch {epoch + 1}/{epochs}: loss {total_loss / len(training):.4f}, validation accuracy {accuracy:.2%}')
+    return net
+
+def export(net: SkySegmentationNet, output_path: str):
+    """
+    Exports the network to ONNX, with a variable batch size and resolution.
+    An old opset, so that the cv2.dnn of OpenCV 3.4 on the Pi can read it.
+    """
+    net.eval()
+    folder = os.path.dirname(output_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    dummy_input = torch.zeros(1, 3, TRAINING_RESOLUTION[1], TRAINING_RESOLUTION[0])
+    torch.onnx.export(net, dummy_input, output_path, opset_version=9, input_names=['image'], output_names=['sky'],
+                        dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                                      'sky': {0: 'batch', 2: 'height', 3: 'width'}})
+    print(f'Saved the network to {output_path}.')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Trains the sky segmentation network.')
+    parser.add_argument('--synthetic', type=int, default=0, help='number of synthetic frames to add')
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--output', default=DEFAULT_MODEL_PATH)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    torch.manual_seed(args.seed)
+    images, masks = load_training_data()
+    print(f'Loaded {len(images)} frames from {TRAINING_DATA_PATH}.')
+    if args.synthetic:
+        print(f'Rendering {args.synthetic} synthetic frames...')
+        synthetic_images, synthetic_masks = make_synthetic_data(args.synthetic, rng)
+        images += synthetic_images
+        masks += synthetic_masks
+    if not images:
+        raise SystemExit(f'No training data. Add frames to {TRAINING_DATA_PATH} or use --synthetic.')
+
+    net = train(images, masks, args.epochs, rng)
+    export(net, args.output)
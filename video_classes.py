@@ -1,18 +1,51 @@
 # standard libraries
 import cv2
 import os
+import numpy as np
 from queue import Queue
-from threading import Thread
+from threading import Thread, Lock
 from time import sleep
 from timeit import default_timer as timer
 import global_variables as gv
 import platform
+from yuv_frames import YUYV_FOURCC, as_yuyv
+
+# With the second stream, cropping and scaling a 640x480 frame to 100x100 (100-300 us on a desktop x86 core,
+# measured with a video file standing in for the camera, python video_classes.py) moves from the main loop
+# to the capture thread. The main loop only picks up the small frame. The camera hardware is not asked for
+# a second, scaled stream: OpenCV's VideoCapture has no way to ask for one.
+#
+# Number of small frames the capture thread writes into in turns: one held by the main loop, one published
+# for the main loop to pick up next, and one being written. The capture thread never writes into the first two,
+# however long the main loop takes.
+SMALL_FRAME_RING_SIZE = 3
 
 class CustomVideoCapture:
-    def __init__(self, resolution=None, source=0):
+    def __init__(self, resolution=None, source=0, yuv=False):
+        """
+        yuv: if True, a camera is asked for raw YUYV frames instead of MJPG frames converted to BGR
+        (see yuv_frames.py). is_yuyv tells whether the camera delivers them.
+
+        With set_crop_scaler, the capture delivers two streams of the same frames: the full frames, for the display
+        and the recording, and the frames cropped and scaled to the inference resolution in the capture thread,
+        for the HorizonDetector. The main loop then gets its small frame ready to use, and only touches
+        the full frame when it displays or records it.
+        """
         self.run = False
         self.source = source
         self.fps_list = []
+        # the latest frame from the camera, its sequence number and its small frame, replaced together,
+        # so that the main loop can tell when it gets the same frame again
+        self.numbered_frame = (None, None, None)
+        # the buffer of the ring of that small frame, and the buffer of the small frame the main loop holds
+        # (the one it read last), which the capture thread leaves alone. Both are handed over under ring_lock.
+        self.published_slot = None
+        self.held_slot = None
+        self.ring_lock = Lock()
+        self.frame_number = 0
+        # the CropScaler of the small frames and the ring of small frames it writes into, or None
+        self.small_frame_stream = None
+        self.ring_index = 0
 
         # determine if we are streaming from a webcam or a video file
         if source.isnumeric():
@@ -41,16 +74,37 @@ class CustomVideoCapture:
         self.cap.set(3,self.resolution[0])
         self.cap.set(4,self.resolution[1])
 
-        fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-        self.cap.set(cv2.CAP_PROP_FOURCC, fourcc)
+        # Ask for raw YUYV frames, and fall back to MJPG if the camera does not deliver them.
+        self.is_yuyv = False
+        if yuv and self.using_camera:
+            fourcc = cv2.VideoWriter_fourcc(*YUYV_FOURCC)
+            self.cap.set(cv2.CAP_PROP_FOURCC, fourcc)
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+            if int(self.cap.get(cv2.CAP_PROP_FOURCC)) == fourcc:
+                self.is_yuyv = True
+                # the size of the frames the camera delivers, to unpack the raw frames
+                self.yuyv_resolution = (int(self.cap.get(3)), int(self.cap.get(4)))
+            else:
+                print('The camera does not deliver YUYV frames. Using BGR frames instead.')
+                self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        if not self.is_yuyv:
+            fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+            self.cap.set(cv2.CAP_PROP_FOURCC, fourcc)
 
     def get_frames_from_camera(self):
         self.t1 = timer()
         self.number_of_frames = 0
         while self.run:
-            ret, self.frame = self.cap.read()
+            ret, frame = self.cap.read()
             if ret:
+                if self.is_yuyv:
+                    frame = as_yuyv(frame, self.yuyv_resolution)
+                self.frame = frame
                 self.number_of_frames += 1
+                small_frame, slot = self._scale_frame(frame)
+                with self.ring_lock:
+                    self.numbered_frame = (self.number_of_frames, self.frame, small_frame)
+                    self.published_slot = slot
             else:
                 print('Cannot get frames. Ending program.')
                 self.run = False
@@ -70,7 +124,39 @@ class CustomVideoCapture:
                 self.release()
                 break
             else:
-                self.queue.put(frame)
+                # the queue holds many frames, so their small frames cannot come from the ring
+                small_frame, _ = self._scale_frame(frame)
+                if small_frame is not None:
+                    small_frame = small_frame.copy()
+                self.queue.put((frame, small_frame))
+
+    def _scale_frame(self, frame):
+        """
+        Returns the small frame of the frame, in the next buffer of the ring that the main loop neither holds
+        nor can pick up, and the index of that buffer. Returns None and None without a second stream.
+        """
+        small_frame_stream = self.small_frame_stream
+        if small_frame_stream is None:
+            return None, None
+        crop_scaler, ring = small_frame_stream
+        with self.ring_lock:
+            self.ring_index = (self.ring_index + 1) % len(ring)
+            while self.ring_index in (self.held_slot, self.published_slot):
+                self.ring_index = (self.ring_index + 1) % len(ring)
+            slot = self.ring_index
+        return crop_scaler.crop_and_scale(frame, dst=ring[slot]), slot
+
+    def set_crop_scaler(self, crop_scaler):
+        """
+        Starts delivering the small frames of crop_scaler (a crop_and_scale.CropScaler) along with the frames,
+        or stops with None. The capture thread uses its buffers, so the CropScaler must not be used elsewhere.
+        Frames read before the change may still have small frames of the previous CropScaler.
+        """
+        if crop_scaler is None:
+            self.small_frame_stream = None
+        else:
+            ring = [np.empty_like(crop_scaler.output) for _ in range(SMALL_FRAME_RING_SIZE)]
+            self.small_frame_stream = (crop_scaler, ring)
 
     def read_frame(self):
         # if using webcam
@@ -78,12 +164,34 @@ class CustomVideoCapture:
             return self.frame
 
         # if streaming from a video file
+        return self._read_frame_from_queue()[0]
+
+    def _read_frame_from_queue(self):
         if self.queue.empty():
             print('No more frames left in the CustomVideoCapture queue.')
-            return None
+            return None, None
         else:
-            frame = self.queue.get()
-            return frame         
+            frame, small_frame = self.queue.get()
+            return frame, small_frame
+
+    def read_numbered_frame(self):
+        """
+        Returns the sequence number of the frame, the frame, like read_frame, and its small frame
+        (None without a second stream, see set_crop_scaler). The small frame stays as it is until
+        the next call, which hands it back to the capture thread.
+        The number stays the same when the camera has not delivered a new frame since the last call.
+        """
+        if self.using_camera:
+            with self.ring_lock:
+                self.held_slot = self.published_slot
+                return self.numbered_frame
+
+        # every frame of a video file is a new one
+        frame, small_frame = self._read_frame_from_queue()
+        if frame is None:
+            return None, None, None
+        self.frame_number += 1
+        return self.frame_number, frame, small_frame
 
     def start_stream(self):
         self.run = True
@@ -144,8 +252,38 @@ class CustomVideoWriter:
         fps = self.frames_written / self.time_spent_writing
         print(f'CustomVideoWriter fps: {fps}')
 
+if __name__ == "__main__":
+    import tempfile
+    from horizon_benchmark import make_flight, RESOLUTION
+    from crop_and_scale import CropScaler
 
+    # a video file of the synthetic flight stands in for the camera
+    print('Rendering synthetic flight...')
+    frames, _, _ = make_flight(100)
+    path = f'{tempfile.gettempdir()}/synthetic_flight.avi'
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, RESOLUTION)
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
 
-    
-
-
+    for dual_stream in [False, True]:
+        video_capture = CustomVideoCapture(source=path)
+        crop_scaler = CropScaler(video_capture.resolution, (100, 100))
+        if dual_stream:
+            video_capture.set_crop_scaler(CropScaler(video_capture.resolution, (100, 100)))
+        video_capture.start_stream()
+        sleep(3) # let the capture thread read the whole file
+        elapsed_time = 0
+        number_of_frames = 0
+        while True:
+            frame_number, frame, small_frame = video_capture.read_numbered_frame()
+            if frame is None:
+                break
+            # the time the main loop spends getting its small frame
+            t1 = timer()
+            if small_frame is None:
+                small_frame = crop_scaler.crop_and_scale(frame)
+            elapsed_time += timer() - t1
+            number_of_frames += 1
+        video_capture.run = False
+        print(f'dual stream {dual_stream}: {elapsed_time / number_of_frames * 1e6:.1f} us per frame in the main loop')
@@ -7,8 +7,11 @@ from timeit import default_timer as timer
 
 # my libraries
 from draw_display import draw_horizon, draw_surfaces, draw_hud, draw_roi, draw_stick
-from crop_and_scale import get_cropping_and_scaling_parameters, crop_and_scale
+from crop_and_scale import CropScaler
 from find_horizon import HorizonDetector
+from diagnostics import render_diagnostics
+from yuv_frames import bgr_to_yuv
+from frame_governor import CHEAP_SMOOTHING_FILTER, LOW_INFERENCE_RESOLUTION
 
 # constants
 BLUE = (255,0,0)
@@ -73,6 +76,31 @@ def main(output_res=(1280,720)):
         exclusion_thresh = datadict['metadata']['exclusion_thresh']
         acceptable_variance = datadict['metadata']['acceptable_variance']
         fov = datadict['metadata']['fov']
+        # older recordings do not have a sky_filter
+        sky_filter = datadict['metadata'].get('sky_filter', 'hsv')
+        smoothing_filter = datadict['metadata'].get('smoothing_filter', 'bilateral')
+        line_fit = datadict['metadata'].get('line_fit', 'tls')
+        pyramid_resolution = datadict['metadata'].get('pyramid_resolution')
+        horizon_lock_band = datadict['metadata'].get('horizon_lock_band', False)
+        backend = datadict['metadata'].get('backend', 'contour')
+        segmentation_model = datadict['metadata'].get('segmentation_model')
+        subpixel = datadict['metadata'].get('subpixel', False)
+        # with the incremental threshold, the recorded thresholds reproduce the masks of the flight
+        incremental_threshold = datadict['metadata'].get('incremental_threshold', False)
+        flow_tracking_interval = datadict['metadata'].get('flow_tracking_interval', 1)
+        # (the recorded inference resolution already covers the full width of the frame with tiles)
+        detection_tiles = datadict['metadata'].get('detection_tiles', 1)
+        # the recording is in BGR even when the flight took YUYV frames, so they are converted back for the detector
+        color_space = datadict['metadata'].get('color_space', 'bgr')
+        # the frames are undistorted the same way as in flight, if they were
+        camera_calibration = datadict['metadata'].get('camera_calibration')
+        if camera_calibration is not None:
+            camera_calibration = {key: np.array(value) for key, value in camera_calibration.items()}
+        # the steps of the governor, to replay each frame at the inference resolution and with the smoothing filter
+        # it was processed with in flight (see frame_governor.py)
+        governor_ladder = tuple(datadict['metadata'].get('governor_ladder', ()))
+        governor_smoothing_filter = datadict['metadata'].get('governor_smoothing_filter', smoothing_filter)
+        governor_inference_resolution = datadict['metadata'].get('governor_inference_resolution', inf_resolution)
 
         # define video_capture
         source = f'{recordings_path}/{video_name}.{video_extension}'
@@ -83,14 +111,35 @@ def main(output_res=(1280,720)):
         fourcc = cv2.VideoWriter_fourcc('X','V','I','D')
         writer = cv2.VideoWriter(output_video_path, fourcc, fps, output_res)
 
-        # get some parameters for cropping and scaling
-        # in this context, this will be used for draw_roi
-        crop_and_scale_parameters = get_cropping_and_scaling_parameters(resolution, inf_resolution)
+        def make_horizon_detector(inference_resolution: tuple, smoothing_filter: str) -> HorizonDetector:
+            """
+            Returns a HorizonDetector with the settings of the recording.
+            """
+            return HorizonDetector(exclusion_thresh, fov, acceptable_variance, inference_resolution,
+                                    horizon_lock_band=horizon_lock_band, sky_filter=sky_filter, smoothing_filter=smoothing_filter, line_fit=line_fit,
+                                    pyramid_resolution=pyramid_resolution, backend=backend,
+                                    segmentation_model=segmentation_model, subpixel=subpixel,
+                                    incremental_threshold=incremental_threshold,
+                                    flow_tracking_interval=flow_tracking_interval, tiles=detection_tiles,
+                                    color_space=color_space)
+
+        # crops, undistorts and scales the frames
+        crop_scaler = CropScaler(resolution, inf_resolution, camera_calibration)
+        # in this context, the parameters for cropping and scaling will be used for draw_roi
+        crop_and_scale_parameters = crop_scaler.parameters
 
         # define the HorizonDetector
-        horizon_detector = HorizonDetector(exclusion_thresh, fov, acceptable_variance, inf_resolution)
+        horizon_detector = make_horizon_detector(inf_resolution, smoothing_filter)
+        current_inference_resolution = tuple(inf_resolution)
+        current_smoothing_filter = smoothing_filter
+
+        # the result of the last frame the detector ran on, for the frames on which the main loop kept it
+        last_result = None
+        # in case the first frames keep a result before there is a mask
+        diagnostic_mask = np.zeros((inf_resolution[1], inf_resolution[0], 3), dtype=np.uint8)
 
         frame_num = 0
+        frames_written = 0
         while True:
             ret, frame = cap.read()
             if ret == False:
@@ -112,9 +161,44 @@ def main(output_res=(1280,720)):
             # Reverse some values if necessary
             ail_stick_val = -1 * ail_stick_val
 
-            scaled_and_cropped_frame = crop_and_scale(frame, **crop_and_scale_parameters)
-            output = horizon_detector.find_horizon(scaled_and_cropped_frame, diagnostic_mode=True)
-            roll, pitch, variance, is_good_horizon, diagnostic_mask = output
+            # follow the steps the governor had taken at this frame, as the main loop did
+            active_steps = governor_ladder[:datadict['frames'][dict_key].get('governor_level', 0)]
+            if LOW_INFERENCE_RESOLUTION in active_steps:
+                inference_resolution = tuple(governor_inference_resolution)
+            else:
+                inference_resolution = tuple(inf_resolution)
+            frame_smoothing_filter = governor_smoothing_filter if CHEAP_SMOOTHING_FILTER in active_steps else smoothing_filter
+            if inference_resolution != current_inference_resolution:
+                # carry the tracked horizon over to the new HorizonDetector
+                tracker_state = horizon_detector.get_tracker_state()
+                horizon_detector = make_horizon_detector(inference_resolution, frame_smoothing_filter)
+                horizon_detector.set_tracker_state(tracker_state)
+                crop_scaler = CropScaler(resolution, inference_resolution, camera_calibration)
+                crop_and_scale_parameters = crop_scaler.parameters
+            elif frame_smoothing_filter != current_smoothing_filter:
+                horizon_detector.set_smoothing_filter(frame_smoothing_filter)
+            current_inference_resolution = inference_resolution
+            current_smoothing_filter = frame_smoothing_filter
+
+            # On the frames where the governor skipped the detection, and on the frames that repeated
+            # or hardly differed from the last one (see duplicate_frames.py), the main loop kept the result
+            # of the previous frame without running the detector, so the replay does the same.
+            # (If the recording starts on such a frame, there is no previous result and the detector runs.)
+            kept_result = datadict['frames'][dict_key].get('detection_skipped') or \
+                          datadict['frames'][dict_key].get('duplicate_frame')
+            if kept_result and last_result is not None:
+                roll, pitch, variance, is_good_horizon = last_result
+            else:
+                scaled_and_cropped_frame = crop_scaler.crop_and_scale(frame)
+                if color_space == 'yuv':
+                    scaled_and_cropped_frame = bgr_to_yuv(scaled_and_cropped_frame)
+                threshold = datadict['frames'][dict_key].get('threshold') if incremental_threshold else None
+                result = horizon_detector.find_horizon(scaled_and_cropped_frame, diagnostic_mode=True, threshold=threshold)
+                roll, pitch, variance, is_good_horizon = result.roll, result.pitch, result.variance, result.is_good_horizon
+                last_result = roll, pitch, variance, is_good_horizon
+                # a horizon tracked with optical flow has no snapshot; keep the mask of the last full detection
+                if result.snapshot is not None:
+                    diagnostic_mask = render_diagnostics(result.snapshot)['mask']
 
             # determine flight mode color
             if flt_mode != 0:
@@ -197,8 +281,11 @@ def main(output_res=(1280,720)):
             stacked = cv2.vconcat([stats_canvas, resized_diagnostic_mask, surface_canvas])
             frame = cv2.hconcat([resized_frame, stacked])
 
-            # send the frame to the queue to be recorded
-            writer.write(frame)
+            # send the frame to the queue to be recorded, once for every frame of the flight it stands for
+            # (twice while the governor recorded only every other frame)
+            for _ in range(datadict['frames'][dict_key].get('recording_interval', 1)):
+                writer.write(frame)
+                frames_written += 1
             
             # show results
             cv2.imshow(f'Producing {output_video_name}...', frame)
@@ -215,7 +302,7 @@ def main(output_res=(1280,720)):
         t2 = timer()
         elapsed_time = t2 - t1 # seconds
         production_time = np.round((elapsed_time / 60), decimals=2) # minutes
-        duration = np.round((frame_num / fps / 60), decimals=2) # minutes
+        duration = np.round((frames_written / fps / 60), decimals=2) # minutes
         print(f'Finished producing {output_video_name}.')
         print(f'Video duration: {duration} minutes.')
         print(f'Production time: {production_time} minutes.')
@@ -0,0 +1,156 @@
+######## YUV frames #########
+# The camera delivers its frames as YUV (or as MJPG, which decodes to YUV), and OpenCV converts every frame
+# to BGR at the full resolution of the camera. HorizonDetector then only needs a greyscale image and a test
+# for the blue of the sky, for which it converted the small frame to greyscale and to HSV.
+# With the color_space setting at 'yuv', CustomVideoCapture asks the camera for raw YUYV frames
+# (CAP_PROP_CONVERT_RGB off), CropScaler (crop_and_scale.py, with yuyv=True) crops and scales them straight
+# into a small three channel Y, U, V image, and HorizonDetector takes the Y plane as its greyscale image and tests the U and V planes
+# against a box (SKY_LOWER_YUV to SKY_UPPER_YUV) for the sky. The main loop only converts a frame to BGR
+# when it is displayed or recorded.
+#
+# The conversions are those of OpenCV for YUYV (cv2.COLOR_YUV2BGR_YUYV): BT.601 with Y from 16 to 235,
+# so that a recording (in BGR) can be converted back with bgr_to_yuv to replay it (see video_producer.py).
+#
+# The blue of the sky is a wedge of hue in HSV, which a box in U and V can only approximate. The box was fitted
+# to the HSV bounds of HorizonDetector over all the YUV colors within the BGR gamut: it agrees on 93% of them,
+# and finds 80% of the colors the HSV filter calls sky, with 12% of its own sky colors not sky in HSV.
+# With sky_filter at 'lut', the lookup table gives exactly the decisions of the HSV filter from YUV instead
+# (see sky_filter.py).
+#
+# Results on a synthetic 300 frame flight (python yuv_frames.py), measured on a desktop x86 core.
+# The camera frames are 640x480, and the YUYV frames are made from them. Time from the camera frame
+# to the greyscale and blue filtered greyscale images at the inference resolution:
+#
+# path               resolution  to BGR   crop and scale  colors   total    good   roll err  pitch err
+# BGR, hsv filter    100x100     271 us   48 us           49 us    368 us   100%   0.11      0.15
+# YUV, hsv filter    100x100     -        143 us          26 us    169 us   100%   0.08      0.21
+# YUV, lut filter    100x100     -        134 us          57 us    191 us   100%   0.11      0.15
+# BGR, hsv filter    200x200     297 us   192 us          175 us   664 us   100%   0.07      0.08
+# YUV, hsv filter    200x200     -        377 us          85 us    462 us   100%   0.06      0.14
+# YUV, lut filter    200x200     -        399 us          196 us   595 us   100%   0.07      0.08
+#
+# Most of the gain is the conversion of the full frame to BGR. Scaling the YUYV pairs costs more than
+# cv2.resize on a BGR frame, since they are sampled with cv2.remap, which has no fast path for it. The decoding of MJPG, which the
+# YUYV frames do away with as well, is not included.
+# The sky of the synthetic flight lies just outside the HSV bounds, where the box and the HSV filter
+# disagree, which raises the pitch error of the box by half or more. Use the lut filter with YUV unless the box has been
+# checked against real footage.
+
+import cv2
+import numpy as np
+
+# the fourcc of the raw frames requested from the camera
+YUYV_FOURCC = 'YUYV'
+# box of the blue of the sky in Y, U and V
+SKY_LOWER_YUV = np.array([38, 154, 96])
+SKY_UPPER_YUV = np.array([255, 255, 200])
+
+# BT.601 with Y from 16 to 235 and U and V from 16 to 240, as affine transforms for cv2.transform
+_BGR_TO_YUV = np.array([[.098, .504, .257, 16],
+                        [.439, -.291, -.148, 128],
+                        [-.071, -.368, .439, 128]])
+_YUV_TO_BGR = np.array([[1.164, 2.018, 0, -1.164 * 16 - 2.018 * 128],
+                        [1.164, -.391, -.813, -1.164 * 16 + (.391 + .813) * 128],
+                        [1.164, 0, 1.596, -1.164 * 16 - 1.596 * 128]])
+# the channels of a pair of YUYV pixels (Y0, U, Y1, V) that make up Y, U and V, for cv2.mixChannels
+PAIR_CHANNELS = [0, 0, 1, 1, 3, 2]
+
+def as_yuyv(frame: np.ndarray, resolution: tuple) -> np.ndarray:
+    """
+    Returns the raw YUYV frame as a height x width x 2 image (Y, and U or V in turns).
+    Depending on the version and backend, OpenCV returns raw frames as one long row of bytes.
+    resolution: (width, height) of the frame
+    """
+    return frame.reshape(resolution[1], resolution[0], 2)
+
+def yuyv_to_bgr(frame: np.ndarray) -> np.ndarray:
+    """
+    Converts a raw YUYV frame to BGR, for the display and the recording.
+    """
+    return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_YUYV)
+
+def bgr_to_yuv(image: np.ndarray) -> np.ndarray:
+    """
+    Converts a BGR image to a three channel Y, U, V image, e.g. the frames of a recording.
+    """
+    return cv2.transform(image, _BGR_TO_YUV)
+
+def yuv_to_bgr(image: np.ndarray) -> np.ndarray:
+    """
+    Converts a three channel Y, U, V image to BGR, the same way as cv2.COLOR_YUV2BGR_YUYV.
+    """
+    return cv2.transform(image, _YUV_TO_BGR)
+
+def make_yuyv(frame: np.ndarray) -> np.ndarray:
+    """
+    Returns the raw YUYV frame a camera would deliver for a BGR frame, with the U and V of each pair
+    of pixels averaged. For testing and benchmarks.
+    """
+    yuv = bgr_to_yuv(frame).astype(np.float32)
+    height, width = frame.shape[:2]
+    yuyv = np.empty((height, width, 2), dtype=np.uint8)
+    yuyv[:, :, 0] = yuv[:, :, 0]
+    yuyv[:, 0::2, 1] = np.round((yuv[:, 0::2, 1] + yuv[:, 1::2, 1]) / 2)
+    yuyv[:, 1::2, 1] = np.round((yuv[:, 0::2, 2] + yuv[:, 1::2, 2]) / 2)
+    return yuyv
+
+if __name__ == "__main__":
+    from timeit import default_timer as timer
+    from crop_and_scale import CropScaler
+    from find_horizon import HorizonDetector
+    from horizon_benchmark import make_flight, run_benchmark, print_stats
+
+    ITERATIONS = 5
+
+    # how well the box agrees with the HSV filter, over all YUV colors within the BGR gamut
+    y, u, v = np.meshgrid(np.arange(16, 236), np.arange(16, 241), np.arange(16, 241), indexing='ij')
+    yuv = np.stack((y, u, v), axis=-1).reshape(-1, 1, 3).astype(np.uint8)
+    bgr = cv2.transform(yuv.astype(np.float32), _YUV_TO_BGR)
+    in_gamut = np.all((bgr >= 0) & (bgr <= 255), axis=-1)[:, 0]
+    hsv = cv2.cvtColor(np.clip(np.round(bgr), 0, 255).astype(np.uint8), cv2.COLOR_BGR2HSV)
+    is_sky_hsv = (cv2.inRange(hsv, np.array([109, 0, 116]), np.array([153, 255, 255]))[:, 0] > 0)[in_gamut]
+    is_sky_yuv = (cv2.inRange(yuv, SKY_LOWER_YUV, SKY_UPPER_YUV)[:, 0] > 0)[in_gamut]
+    print(f'The box agrees with the HSV filter on {np.mean(is_sky_hsv == is_sky_yuv):.1%} of the colors, '
+            f'finds {np.mean(is_sky_yuv[is_sky_hsv]):.1%} of its sky colors, '
+            f'{np.mean(~is_sky_hsv[is_sky_yuv]):.1%} of its own sky colors are not sky in HSV.')
+
+    print('Rendering synthetic flight...')
+    frames, rolls, pitches = make_flight()
+    yuyv_frames = [make_yuyv(frame) for frame in frames]
+    # the frames as the BGR path sees them, converted from YUYV by OpenCV
+    bgr_frames = [yuyv_to_bgr(frame) for frame in yuyv_frames]
+    for inference_resolution in [(100, 100), (200, 200)]:
+        crop_scaler = CropScaler(frames[0].shape[1::-1], inference_resolution)
+        yuyv_crop_scaler = CropScaler(frames[0].shape[1::-1], inference_resolution, yuyv=True)
+        for color_space, sky_filter in [('bgr', 'hsv'), ('yuv', 'hsv'), ('yuv', 'lut')]:
+            horizon_detector = HorizonDetector(4, 48.8, 1.3, inference_resolution, sky_filter=sky_filter,
+                                                color_space=color_space)
+            conversion_time, scaling_time, color_time = 0, 0, 0
+            for n in range(ITERATIONS):
+                for frame in yuyv_frames:
+                    t1 = timer()
+                    if color_space == 'bgr':
+                        frame = yuyv_to_bgr(frame)
+                        t2 = timer()
+                        small_frame = crop_scaler.crop_and_scale(frame)
+                    else:
+                        t2 = timer()
+                        small_frame = yuyv_crop_scaler.crop_and_scale(frame)
+                    t3 = timer()
+                    horizon_detector._filter_colors(small_frame, horizon_detector.buffers)
+                    t4 = timer()
+                    conversion_time += t2 - t1
+                    scaling_time += t3 - t2
+                    color_time += t4 - t3
+            number_of_frames = ITERATIONS * len(frames)
+            print(f'{color_space} {sky_filter} {inference_resolution}: to BGR {conversion_time / number_of_frames * 1e6:.0f} us, '
+                    f'crop and scale {scaling_time / number_of_frames * 1e6:.0f} us, '
+                    f'colors {color_time / number_of_frames * 1e6:.0f} us')
+
+        # accuracy, with the full frames in the color space of the detector
+        stats = run_benchmark(bgr_frames, rolls, pitches, inference_resolution)
+        print_stats(f'bgr hsv {inference_resolution}', stats)
+        yuv_frames = [bgr_to_yuv(frame) for frame in bgr_frames]
+        for sky_filter in ['hsv', 'lut']:
+            stats = run_benchmark(yuv_frames, rolls, pitches, inference_resolution, sky_filter=sky_filter, color_space='yuv')
+            print_stats(f'yuv {sky_filter} {inference_resolution}', stats)